@@ -13,50 +13,222 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+from collections import deque
+import json
 import logging
+import time
+from typing import Awaitable, Callable, Dict, Optional
 
-from homeassistant.const import CONTENT_TYPE_JSON
+import aiohttp
 
 BASE_URL = "https://api.opendata.metlink.org.nz/v1"
 PREDICTIONS_URL = BASE_URL + "/stop-predictions"
 SERVICE_ALERTS_URL = BASE_URL + "/gtfs-rt/servicealerts"
+STOPS_URL = BASE_URL + "/gtfs/stops"
+ROUTES_URL = BASE_URL + "/gtfs/routes"
 STOP_PARAM = "stop_id"
 APIKEY_HEADER = "X-Api-Key"
+CONTENT_TYPE_JSON = "application/json"
+
+# Per endpoint timeouts in seconds.  The alerts feed can be large during
+# disruptions, so it gets longer to download.
+PREDICTIONS_TIMEOUT = 10
+SERVICE_ALERTS_TIMEOUT = 30
+STOPS_TIMEOUT = 30
+ROUTES_TIMEOUT = 30
+# Limits on the connection pool of a dedicated session.
+MIN_POOL_SIZE = 2
+MAX_POOL_SIZE = 10
+KEEPALIVE_TIMEOUT = 60
+DNS_CACHE_TTL = 600
+# A hedged request is sent when the first has taken longer than this
+# percentile of recent response times from the same endpoint.
+HEDGE_PERCENTILE = 95
+HEDGE_SAMPLES = 50
+HEDGE_MIN_SAMPLES = 10
+# Responses larger than this many bytes are decoded in an executor, so a
+# huge alerts feed does not hold up the event loop.
+LARGE_PAYLOAD = 256 * 1024
 
 _LOGGER = logging.getLogger(__name__)
 
 
+def accept_encoding() -> str:
+    """Return the content encodings that aiohttp can decode here."""
+    try:
+        from aiohttp.compression_utils import HAS_BROTLI
+    except ImportError:
+        HAS_BROTLI = False
+
+    return "gzip, deflate, br" if HAS_BROTLI else "gzip, deflate"
+
+
+def create_session(pool_size: int = MIN_POOL_SIZE, ssl=True) -> aiohttp.ClientSession:
+    """Create a session tuned for polling the Metlink API.
+
+    Connections to the API host are kept alive between polls and its
+    address is cached, so regular requests skip the DNS lookup and TLS
+    handshake.  The pool is sized to the requests made at once, within
+    MIN_POOL_SIZE and MAX_POOL_SIZE.
+    """
+    pool_size = max(MIN_POOL_SIZE, min(pool_size, MAX_POOL_SIZE))
+    connector = aiohttp.TCPConnector(
+        limit=pool_size,
+        limit_per_host=pool_size,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+        use_dns_cache=True,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        ssl=ssl,
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+class LatencyTracker(object):
+    """Recent response times from one endpoint."""
+
+    def __init__(self, size: int = HEDGE_SAMPLES):
+        self._samples = deque(maxlen=size)
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        """Return the given percentile, or None if there are too few samples."""
+        if len(self._samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+        return ordered[index]
+
+
 class Metlink(object):
-    def __init__(self, session, apikey):
+    def __init__(
+        self, session, apikey, owns_session: bool = False, hedge: bool = False
+    ):
         """
         interface to Metlink API.
 
         Args:
+          session (aiohttp.ClientSession) : The session to make requests with
           apikey (str) : The API key registered at opendata.metlink.org.nz
+          owns_session (bool) : Close the session when the client is closed
+          hedge (bool) : Send a duplicate request when a response is slow
         """
         self._session = session
         self._key = apikey
+        self._owns_session = owns_session
+        self.hedge = hedge
+        # Called for each duplicate request sent, so that whoever counts
+        # the requests made with the key can count those too.
+        self.on_hedge: Optional[Callable[[], None]] = None
+        self.latency: Dict[str, LatencyTracker] = {}
+        self._headers = {
+            "Accept": CONTENT_TYPE_JSON,
+            "Accept-Encoding": accept_encoding(),
+            APIKEY_HEADER: self._key,
+        }
 
-    async def get_predictions(self, stop_id):
-        """Get arrival/departure predictions for the specified stop."""
-        headers = {"Accept": CONTENT_TYPE_JSON, APIKEY_HEADER: self._key}
-        query = {STOP_PARAM: stop_id}
-        _LOGGER.debug(f"Metlink request for {stop_id}")
+    async def close(self) -> None:
+        """Close the session if it is dedicated to this client."""
+        if self._owns_session and not self._session.closed:
+            await self._session.close()
+
+    async def _get(self, url: str, timeout: float, params: Optional[dict] = None):
         async with self._session.get(
-            PREDICTIONS_URL,
-            params=query,
-            headers=headers,
+            url,
+            params=params,
+            headers=self._headers,
+            timeout=aiohttp.ClientTimeout(total=timeout),
         ) as r:
             r.raise_for_status()
-            return await r.json()
+            body = await r.read()
+        if len(body) > LARGE_PAYLOAD:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, json.loads, body)
+        return json.loads(body)
+
+    async def _request(
+        self,
+        url: str,
+        timeout: float,
+        params: Optional[dict] = None,
+        deadline: Optional[float] = None,
+    ):
+        """Make a request, hedging it if enabled, within an overall deadline.
 
-    async def get_service_alerts(self):
+        Raises asyncio.TimeoutError if the deadline passes first.
+        """
+        tracker = self.latency.setdefault(url, LatencyTracker())
+
+        async def attempt():
+            start = time.monotonic()
+            result = await self._get(url, timeout, params)
+            tracker.record(time.monotonic() - start)
+            return result
+
+        if self.hedge:
+            request = self._hedged(attempt, tracker.percentile(HEDGE_PERCENTILE))
+        else:
+            request = attempt()
+        if deadline is None:
+            return await request
+        return await asyncio.wait_for(request, deadline)
+
+    async def _hedged(
+        self, attempt: Callable[[], Awaitable], delay: Optional[float]
+    ):
+        """Return the first successful result of up to two attempts.
+
+        The second attempt is only started if the first has not completed
+        within delay seconds.
+        """
+        first = asyncio.ensure_future(attempt())
+        attempts = [first]
+        try:
+            if delay is None:
+                return await first
+            done, _ = await asyncio.wait(attempts, timeout=delay)
+            if not done:
+                _LOGGER.debug(f"No response after {delay:.2f}s, hedging request")
+                attempts.append(asyncio.ensure_future(attempt()))
+                if self.on_hedge is not None:
+                    self.on_hedge()
+            pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+            # Every attempt failed, so report the original failure.
+            return first.result()
+        finally:
+            for task in attempts:
+                task.cancel()
+
+    async def get_predictions(self, stop_id, deadline: Optional[float] = None):
+        """Get arrival/departure predictions for the specified stop."""
+        query = {STOP_PARAM: stop_id}
+        _LOGGER.debug(f"Metlink request for {stop_id}")
+        return await self._request(
+            PREDICTIONS_URL, PREDICTIONS_TIMEOUT, query, deadline
+        )
+
+    async def get_service_alerts(self, deadline: Optional[float] = None):
         """Information about unforeseen events affecting routes, stops, or the network."""
-        headers = {"Accept": CONTENT_TYPE_JSON, APIKEY_HEADER: self._key}
         _LOGGER.debug(f"Metlink request for service alerts")
-        async with self._session.get(
-            SERVICE_ALERTS_URL,
-            headers=headers,
-        ) as r:
-            r.raise_for_status()
-            return await r.json()
+        return await self._request(
+            SERVICE_ALERTS_URL, SERVICE_ALERTS_TIMEOUT, deadline=deadline
+        )
+
+    async def get_stops(self, deadline: Optional[float] = None):
+        """The catalogue of all stops, with their ids and names."""
+        _LOGGER.debug("Metlink request for stops")
+        return await self._request(STOPS_URL, STOPS_TIMEOUT, deadline=deadline)
+
+    async def get_routes(self, deadline: Optional[float] = None):
+        """The catalogue of all routes, with their ids and short names."""
+        _LOGGER.debug("Metlink request for routes")
+        return await self._request(ROUTES_URL, ROUTES_TIMEOUT, deadline=deadline)
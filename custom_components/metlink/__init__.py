@@ -1,16 +1,22 @@
 """Metlink Wellington Transport integration."""
 import asyncio
 import logging
-
-from homeassistant import config_entries, core
+from typing import TYPE_CHECKING
 
 from .const import DOMAIN
 
+if TYPE_CHECKING:
+    # Only needed for annotations, so the standalone client can be imported
+    # from the package without Home Assistant.
+    from homeassistant import config_entries, core
+
 _LOGGER = logging.getLogger(__name__)
 
+PLATFORMS = ["sensor", "calendar"]
+
 
 async def async_setup_entry(
-    hass: core.HomeAssistant, entry: config_entries.ConfigEntry
+    hass: "core.HomeAssistant", entry: "config_entries.ConfigEntry"
 ) -> bool:
     """Set up platform from a ConfigEntry."""
     hass.data.setdefault(DOMAIN, {})
@@ -20,29 +26,38 @@ async def async_setup_entry(
     data["unsub_options_update_listener"] = update_listener
     hass.data[DOMAIN][entry.entry_id] = data
 
-    # Forward the setup to the sensor platform.
+    # Forward the setup to the sensor and calendar platforms.
     _LOGGER.debug(f"Setting up based on {entry.data}")
-    await hass.config_entries.async_forward_entry_setups(entry, ["sensor"])
+    await hass.config_entries.async_forward_entry_setups(entry, PLATFORMS)
 
     return True
 
 
 async def options_update_listener(
-    hass: core.HomeAssistant, config_entry: config_entries.ConfigEntry
+    hass: "core.HomeAssistant", config_entry: "config_entries.ConfigEntry"
 ):
     """Handle options update."""
+    # The sensor platform is already loaded by the time options change.
+    from .sensor import async_update_stops
+
+    if await async_update_stops(hass, config_entry):
+        _LOGGER.debug("Updated stops in place after options update")
+        return
     _LOGGER.debug("Reloading config after options update")
     await hass.config_entries.async_reload(config_entry.entry_id)
 
 
 async def async_unload_entry(
-    hass: core.HomeAssistant, entry: config_entries.ConfigEntry
+    hass: "core.HomeAssistant", entry: "config_entries.ConfigEntry"
 ) -> bool:
     """Unload a config entry."""
     _LOGGER.debug("Unloading")
     unload_ok = all(
         await asyncio.gather(
-            *[hass.config_entries.async_forward_entry_unload(entry, "sensor")]
+            *[
+                hass.config_entries.async_forward_entry_unload(entry, platform)
+                for platform in PLATFORMS
+            ]
         )
     )
     # Remove the listener
@@ -57,8 +72,20 @@ async def async_unload_entry(
     return unload_ok
 
 
-async def async_setup(hass: core.HomeAssistant, config: dict) -> bool:
+async def async_setup(hass: "core.HomeAssistant", config: dict) -> bool:
     """Setup the Metlink component from yaml configuration."""
     _LOGGER.debug("Setting up from YAML config")
     hass.data.setdefault(DOMAIN, {})
+    # Loaded here, as the services bring in the engine, which the config
+    # flow does not need.
+    from .services import async_setup_services
+
+    async_setup_services(hass)
+    if hass.http is not None:
+        # Only load the HTTP and websocket modules when they are running.
+        from .views import MetlinkBoardView
+        from .websocket import async_register_commands
+
+        hass.http.register_view(MetlinkBoardView())
+        async_register_commands(hass)
     return True
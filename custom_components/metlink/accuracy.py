@@ -0,0 +1,123 @@
+"""Accuracy of departure predictions, by how far ahead they were made."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import homeassistant.util.dt as dt_util
+
+from .const import ATTR_DEPARTURE, ATTR_DEPARTURES, ATTR_EXPECTED, ATTR_SERVICE
+from .polling import trip_key
+
+# Upper bounds, in minutes, of the lead times that errors are grouped by.
+# Predictions made further ahead than the last are not tracked.
+LEAD_BUCKETS = (2, 5, 10, 20, 30, 60)
+# Bounds on the memory used by the tracker.
+SAMPLES_PER_BUCKET = 64
+MAX_ROUTES = 200
+
+
+class ErrorRing:
+    """The most recent prediction errors, in seconds, in a fixed array."""
+
+    __slots__ = ("_values", "_next", "count")
+
+    def __init__(self, size: int = SAMPLES_PER_BUCKET):
+        self._values = array("f", [0.0]) * size
+        self._next = 0
+        self.count = 0
+
+    def append(self, value: float) -> None:
+        self._values[self._next] = value
+        self._next = (self._next + 1) % len(self._values)
+        self.count = min(self.count + 1, len(self._values))
+
+    def percentile(self, pct: float) -> Optional[float]:
+        """Return the given percentile, or None if there are no samples."""
+        if not self.count:
+            return None
+        ordered = sorted(self._values[: self.count])
+        return ordered[min(self.count - 1, int(self.count * pct / 100))]
+
+
+class AccuracyTracker:
+    """How far predicted departures are from when services actually left.
+
+    Each trip's first prediction in each lead time bucket is kept until the
+    trip leaves a stop's predictions, and its last expected time is taken
+    as the actual departure.  Errors are positive when services left later
+    than predicted.
+    """
+
+    def __init__(self):
+        # stop_id -> trip key -> (route, bucket -> prediction, last expected)
+        self._trips: Dict[str, Dict[Tuple, Tuple[str, Dict[int, datetime], datetime]]] = {}
+        self._routes: "OrderedDict[Tuple[str, str], List[ErrorRing]]" = OrderedDict()
+
+    def observe(self, stop_id: str, data: Dict[str, Any], now: datetime) -> None:
+        """Record the predictions for a stop, and the errors of departed trips."""
+        previous = self._trips.get(stop_id, {})
+        current = {}
+        for departure in data.get(ATTR_DEPARTURES, []):
+            expected = dt_util.parse_datetime(
+                departure[ATTR_DEPARTURE].get(ATTR_EXPECTED) or ""
+            )
+            if expected is None:
+                continue
+            key = trip_key(stop_id, departure)
+            _, predictions, _ = previous.get(key, (None, {}, None))
+            lead = (expected - now).total_seconds() / 60
+            bucket = bisect_left(LEAD_BUCKETS, lead)
+            if lead >= 0 and bucket < len(LEAD_BUCKETS):
+                predictions.setdefault(bucket, expected)
+            current[key] = (departure[ATTR_SERVICE], predictions, expected)
+
+        for key, (route, predictions, actual) in previous.items():
+            if key in current or actual > now:
+                continue
+            rings = self._rings(stop_id, route)
+            for bucket, predicted in predictions.items():
+                rings[bucket].append((actual - predicted).total_seconds())
+        self._trips[stop_id] = current
+
+    def _rings(self, stop_id: str, route: str) -> List[ErrorRing]:
+        rings = self._routes.pop((stop_id, route), None)
+        if rings is None:
+            rings = [ErrorRing() for _ in LEAD_BUCKETS]
+        self._routes[(stop_id, route)] = rings
+        if len(self._routes) > MAX_ROUTES:
+            self._routes.popitem(last=False)
+        return rings
+
+    def summary(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """Return error percentiles, in seconds, by route and lead time."""
+        summary = {}
+        for (stop_id, route), rings in self._routes.items():
+            buckets = {}
+            low = 0
+            for high, ring in zip(LEAD_BUCKETS, rings):
+                if ring.count:
+                    buckets[f"{low}-{high} min"] = {
+                        "samples": ring.count,
+                        "p10": ring.percentile(10),
+                        "p50": ring.percentile(50),
+                        "p90": ring.percentile(90),
+                    }
+                low = high
+            summary[f"{stop_id} {route}"] = buckets
+        return summary
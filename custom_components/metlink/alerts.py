@@ -0,0 +1,126 @@
+"""Events for service alerts affecting the configured stops and routes."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+from typing import Any, Collection, Dict, Optional
+
+from homeassistant import core
+
+from .const import (
+    ATTR_ALERT,
+    ATTR_CAUSE,
+    ATTR_DESCRIPTION_TEXT,
+    ATTR_EFFECT,
+    ATTR_ENTITY,
+    ATTR_HEADER_TEXT,
+    ATTR_ID,
+    ATTR_INFORMED_ENTITY,
+    ATTR_ROUTE_ID,
+
+    ATTR_SEVERITY_LEVEL,
+    ATTR_STOP,
+    ATTR_URL,
+    EVENT_ALERT,
+)
+from .helpers import get_translation
+
+_LOGGER = logging.getLogger(__name__)
+
+ALERT_ADDED = "added"
+ALERT_CHANGED = "changed"
+ALERT_CLEARED = "cleared"
+
+
+def alert_event(
+    alert_id: str,
+    change: str,
+    alert: Dict[str, Any],
+    stops: Collection[str],
+    routes: Collection[str],
+    route_names: Optional[Dict[str, str]] = None,
+) -> Optional[Dict[str, Any]]:
+    """Return the event data for an alert, if it affects the stops or routes.
+
+    Alerts give the GTFS route id of the routes they affect, which
+    route_names maps to the short names that departures and filters use.
+    """
+    route_names = route_names or {}
+    informed = alert.get(ATTR_INFORMED_ENTITY, [])
+    affected_stops = sorted({i.get(ATTR_STOP) for i in informed} & set(stops))
+    informed_routes = {
+        route_names.get(i.get(ATTR_ROUTE_ID), i.get(ATTR_ROUTE_ID)) for i in informed
+    }
+    affected_routes = sorted(informed_routes & set(routes))
+    if not affected_stops and not affected_routes:
+        return None
+    return {
+        ATTR_ID: alert_id,
+        "change": change,
+        "stops": affected_stops,
+        "routes": affected_routes,
+        "header": get_translation(alert.get(ATTR_HEADER_TEXT, {})),
+        "description": get_translation(alert.get(ATTR_DESCRIPTION_TEXT, {})),
+        ATTR_URL: get_translation(alert.get(ATTR_URL, {})),
+        ATTR_CAUSE: alert.get(ATTR_CAUSE, ""),
+        ATTR_EFFECT: alert.get(ATTR_EFFECT, ""),
+        ATTR_SEVERITY_LEVEL: alert.get(ATTR_SEVERITY_LEVEL, ""),
+    }
+
+
+class AlertTracker:
+    """Fire an event when an alert is added, changed or cleared.
+
+    Each alerts feed is compared with the last by the alerts' entity ids,
+    and events are only fired for alerts that affect the configured stops
+    or routes.  The first feed only records the alerts already in force,
+    so a restart does not repeat them.
+    """
+
+    def __init__(self, hass: core.HomeAssistant):
+        self.hass = hass
+        self._alerts: Optional[Dict[str, Dict[str, Any]]] = None
+
+    @core.callback
+    def async_update(
+        self,
+        feed: Dict[str, Any],
+        stops: Collection[str],
+        routes: Collection[str],
+        route_names: Optional[Dict[str, str]] = None,
+    ) -> None:
+        """Compare a new alerts feed with the last, and fire the changes."""
+        current = {
+            entity[ATTR_ID]: entity[ATTR_ALERT]
+            for entity in feed.get(ATTR_ENTITY, [])
+            if ATTR_ID in entity and ATTR_ALERT in entity
+        }
+        previous, self._alerts = self._alerts, current
+        if previous is None:
+            return
+        changes = []
+        for alert_id, alert in current.items():
+            old = previous.get(alert_id)
+            if old is None:
+                changes.append((alert_id, ALERT_ADDED, alert))
+            elif old != alert:
+                changes.append((alert_id, ALERT_CHANGED, alert))
+        for alert_id in previous.keys() - current.keys():
+            changes.append((alert_id, ALERT_CLEARED, previous[alert_id]))
+
+        for alert_id, change, alert in changes:
+            data = alert_event(alert_id, change, alert, stops, routes, route_names)
+            if data is not None:
+                _LOGGER.debug(f"Alert {alert_id} {change}")
+                self.hass.bus.async_fire(EVENT_ALERT, data)
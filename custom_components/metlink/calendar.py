@@ -0,0 +1,302 @@
+"""Calendar platform showing upcoming Metlink departures."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import heapq
+import logging
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from homeassistant import config_entries, core
+from homeassistant.components.calendar import CalendarEntity, CalendarEvent
+from homeassistant.const import CONF_API_KEY
+from homeassistant.helpers import entity_registry as er
+import homeassistant.util.dt as dt_util
+
+from .const import (
+    ATTR_AIMED,
+    ATTR_DEPARTURE,
+    ATTR_DEPARTURES,
+    ATTR_DESTINATION,
+    ATTR_NAME,
+    ATTR_SERVICE,
+    ATTR_STATUS,
+    ATTR_TRIP_ID,
+    CONF_GROUP,
+    CONF_STOP_ID,
+    CONF_STOPS,
+    DEFAULT_STATUS,
+    DOMAIN,
+)
+from .engine import async_get_shared_engine
+from .filters import DepartureFilter, departure_time, merge_departures
+from .helpers import metlink_unique_id, split_list
+from .service_hours import service_day
+from .timetable import ScheduledDeparture
+
+_LOGGER = logging.getLogger(__name__)
+
+# Departures are shown as events this long.
+EVENT_DURATION = timedelta(minutes=1)
+# The learnt timetable is only projected this far ahead.
+TIMETABLE_HORIZON = timedelta(days=7)
+# Windows of events kept for each calendar, so paging back and forth in
+# the calendar view does not build them again.
+MAX_CACHED_WINDOWS = 8
+# How far ahead to look for the calendar's next event.
+NEXT_EVENT_WINDOW = timedelta(hours=6)
+
+
+async def async_setup_entry(
+    hass: core.HomeAssistant,
+    config_entry: config_entries.ConfigEntry,
+    async_add_entities,
+):
+    """Set up a calendar for each stop in a config entry."""
+    config = hass.data[DOMAIN][config_entry.entry_id]
+    stops = {**config_entry.data, **config_entry.options}[CONF_STOPS]
+    # The engine is shared with the sensor platform, which keeps it fed.
+    engine = await async_get_shared_engine(hass, config[CONF_API_KEY])
+    calendars = [MetlinkCalendar(engine, stop) for stop in stops]
+    # Kept so that options changes can add and remove calendars in place.
+    config["calendars"] = {calendar.unique_id: calendar for calendar in calendars}
+    config["add_calendars"] = async_add_entities
+    async_add_entities(calendars)
+
+
+async def async_update_calendars(
+    hass: core.HomeAssistant,
+    config: Dict[str, Any],
+    wanted: Dict[str, Dict],
+    changed: Set[str],
+) -> None:
+    """Add, remove and replace calendars for a change of stops, by unique id.
+
+    The calendars of stops whose config changed are replaced under the
+    same entity id.
+    """
+    calendars: Dict[str, MetlinkCalendar] = config["calendars"]
+    entity_registry = er.async_get(hass)
+    for uid in [uid for uid in calendars if uid not in wanted or uid in changed]:
+        calendar = calendars.pop(uid)
+        if uid in changed:
+            if calendar.hass is not None:
+                await calendar.async_remove()
+        elif calendar.entity_id and entity_registry.async_get(calendar.entity_id):
+            entity_registry.async_remove(calendar.entity_id)
+        elif calendar.hass is not None:
+            await calendar.async_remove()
+    engine = config["engine"]
+    added = [
+        MetlinkCalendar(engine, stop)
+        for uid, stop in wanted.items()
+        if uid not in calendars
+    ]
+    for calendar in added:
+        calendars[calendar.unique_id] = calendar
+    if added:
+        config["add_calendars"](added)
+
+
+def departure_event(departure: Dict[str, Any]) -> Optional[CalendarEvent]:
+    """Return the event for a predicted departure."""
+    start = dt_util.parse_datetime(departure_time(departure) or "")
+    if start is None:
+        return None
+    destination = departure[ATTR_DESTINATION].get(ATTR_NAME)
+    status = departure.get(ATTR_STATUS) or DEFAULT_STATUS
+    return CalendarEvent(
+        start=start,
+        end=start + EVENT_DURATION,
+        summary=f"{departure[ATTR_SERVICE]} {destination}",
+        description=f"Realtime departure, {status}",
+        location=departure.get(ATTR_NAME),
+        uid=departure.get(ATTR_TRIP_ID),
+    )
+
+
+def scheduled_event(stop_id: str, scheduled: ScheduledDeparture) -> CalendarEvent:
+    """Return the event for a departure from the learnt timetable."""
+    return CalendarEvent(
+        start=scheduled.time,
+        end=scheduled.time + EVENT_DURATION,
+        summary=f"{scheduled.service_id} {scheduled.destination}",
+        description="Timetabled departure",
+        location=stop_id,
+    )
+
+
+class MetlinkCalendar(CalendarEntity):
+    """Upcoming departures from a stop, or group of stops, as events.
+
+    Events come from the engine's cached predictions, then from the
+    timetable learnt from past predictions beyond the last one, so reading
+    the calendar never makes a request.  The state is only written when
+    an update to the stops changes the next event.  They are only built for the
+    window asked for, and the last few windows are kept until the
+    predictions or timetable of the stops change.
+    """
+
+    def __init__(self, engine, stop: Dict[str, Any]):
+        self.engine = engine
+        self.stop_ids = list(
+            dict.fromkeys([stop[CONF_STOP_ID]] + split_list(stop.get(CONF_GROUP)))
+        )
+        self.filter = DepartureFilter.from_config(stop)
+        self._attr_name = "Metlink " + ", ".join(self.stop_ids)
+        self._attr_unique_id = metlink_unique_id(stop)
+        self._attr_should_poll = False
+        # The next event when the state was last written.
+        self._next_event: Optional[CalendarEvent] = None
+        # (start, end) -> (stamp, events), least recently used first.
+        self._windows: "OrderedDict[Tuple[datetime, datetime], Tuple]" = OrderedDict()
+
+    async def async_added_to_hass(self) -> None:
+        await super().async_added_to_hass()
+        self.async_on_remove(self.engine.async_listen(self._async_stop_updated))
+
+    @core.callback
+    def _async_stop_updated(self, stop_id: str) -> None:
+        if stop_id not in self.stop_ids:
+            return
+        event = self.event
+        if event != self._next_event:
+            self._next_event = event
+            self.async_write_ha_state()
+
+    @property
+    def event(self) -> Optional[CalendarEvent]:
+        """Return the next departure, or the one leaving now."""
+        # Only the first event is built, and not cached, as the window
+        # moves with every call.
+        now = dt_util.utcnow()
+        events = self._generate(now - EVENT_DURATION, now + NEXT_EVENT_WINDOW)
+        return next(events, None)
+
+    async def async_get_events(
+        self, hass: core.HomeAssistant, start_date: datetime, end_date: datetime
+    ) -> List[CalendarEvent]:
+        """Return the departures in a window."""
+        return self._events(start_date, end_date)
+
+    def _stamp(self) -> Tuple:
+        """Return what the events depend on, to tell when they are stale."""
+        timetable = self.engine.timetable
+        stamp = []
+        for stop_id in self.stop_ids:
+            cached = self.engine.predictions.get(stop_id)
+            stamp.append(None if cached is None else cached.updated)
+            stamp.append(None if timetable is None else timetable.version(stop_id))
+        return tuple(stamp)
+
+    def _events(self, start: datetime, end: datetime) -> List[CalendarEvent]:
+        stamp = self._stamp()
+        cached = self._windows.get((start, end))
+        if cached is not None and cached[0] == stamp:
+            self._windows.move_to_end((start, end))
+            return cached[1]
+        events = list(self._generate(start, end))
+        self._windows[start, end] = (stamp, events)
+        if len(self._windows) > MAX_CACHED_WINDOWS:
+            self._windows.popitem(last=False)
+        return events
+
+    def _generate(self, start: datetime, end: datetime) -> Iterator[CalendarEvent]:
+        """Build the events that end after start and begin before end.
+
+        A stop's timetable can take over before the predictions for another
+        of the group's stops run out, so the realtime and timetabled events
+        are merged in time order.
+        """
+        now = dt_util.utcnow()
+        departure_lists = []
+        # Past the last prediction for each stop, the timetable takes over.
+        horizons: Dict[str, datetime] = {}
+        for stop_id in self.stop_ids:
+            cached = self.engine.predictions.get(stop_id)
+            if cached is None:
+                continue
+            departures = cached.data.get(ATTR_DEPARTURES, [])
+            departure_lists.append(self.filter.select(departures, now))
+            aimed = [
+                dt_util.parse_datetime(d[ATTR_DEPARTURE].get(ATTR_AIMED) or "")
+                for d in departures
+            ]
+            aimed = [time for time in aimed if time is not None]
+            if aimed:
+                horizons[stop_id] = max(aimed)
+
+        yield from heapq.merge(
+            self._realtime(departure_lists, start, end),
+            self._scheduled(start, end, now, horizons),
+            key=lambda event: event.start,
+        )
+
+    def _realtime(
+        self,
+        departure_lists: List[Iterator[Dict[str, Any]]],
+        start: datetime,
+        end: datetime,
+    ) -> Iterator[CalendarEvent]:
+        """Build the events for the predicted departures, in time order."""
+        for departure in merge_departures(departure_lists):
+            event = departure_event(departure)
+            if event is None or event.end <= start:
+                continue
+            if event.start >= end:
+                return
+            yield event
+
+    def _scheduled(
+        self,
+        start: datetime,
+        end: datetime,
+        now: datetime,
+        horizons: Dict[str, datetime],
+    ) -> Iterator[CalendarEvent]:
+        """Project the timetable over the window, one service day at a time."""
+        timetable = self.engine.timetable
+        if timetable is None:
+            return
+        end = min(end, now + TIMETABLE_HORIZON)
+        day, _ = service_day(max(start, now))
+        while day < end:
+            scheduled = heapq.merge(
+                *(
+                    (
+                        (departure, stop_id)
+                        for departure in timetable.departures(stop_id, day)
+                        if departure.time > horizons.get(stop_id, now)
+                        and self._scheduled_matches(departure)
+                    )
+                    for stop_id in self.stop_ids
+                )
+            )
+            for departure, stop_id in scheduled:
+                if departure.time + EVENT_DURATION <= start:
+                    continue
+                if departure.time >= end:
+                    return
+                yield scheduled_event(stop_id, departure)
+            day = day + timedelta(days=1)
+
+    def _scheduled_matches(self, departure: ScheduledDeparture) -> bool:
+        """Apply the route and destination filters, which the timetable has."""
+        if self.filter.routes and departure.service_id not in self.filter.routes:
+            return False
+        return (
+            not self.filter.destinations
+            or departure.destination in self.filter.destinations
+        )
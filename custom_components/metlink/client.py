@@ -0,0 +1,288 @@
+"""Standalone client for Metlink departures, for use outside Home Assistant.
+
+The client shares the integration's polling core, so only depends on
+aiohttp.  Importing it does not import Home Assistant.
+"""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+import logging
+from typing import Any, AsyncIterator, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from .MetlinkAPI import MIN_POOL_SIZE, Metlink, create_session
+from .const import (
+    ATTR_ACCESSIBLE,
+    ATTR_AIMED,
+    ATTR_CLOSED,
+    ATTR_DEPARTURE,
+    ATTR_DEPARTURES,
+    ATTR_DESTINATION,
+    ATTR_DIRECTION,
+    ATTR_EXPECTED,
+    ATTR_MONITORED,
+    ATTR_NAME,
+    ATTR_OPERATOR,
+    ATTR_SERVICE,
+    ATTR_STATUS,
+    ATTR_STOP,
+    ATTR_TRIP_ID,
+    ATTR_VEHICLE,
+)
+from .filters import DepartureFilter
+from .key_pool import KeyPool, mask_key, parse_api_keys
+from .polling import Backoff, SharedFetches, next_poll, parse_time, trip_key
+
+_LOGGER = logging.getLogger(__name__)
+
+# Predictions this recent are served from the cache.
+CACHE_MAX_AGE = timedelta(seconds=30)
+# Seconds allowed for a fetch.
+FETCH_DEADLINE = 25
+# watch() polls a stop no more often than this, as the engine's refresh
+# cycle does, however close its next departure.
+MIN_POLL_INTERVAL = timedelta(seconds=30)
+# A stop whose fetch failed is tried again after this long, doubling with
+# each further failure up to the maximum.
+MIN_BACKOFF = timedelta(seconds=30)
+MAX_BACKOFF = timedelta(minutes=10)
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class Departure(NamedTuple):
+    """A predicted departure from a stop."""
+
+    stop_id: str
+    trip_id: Optional[str]
+    service_id: str
+    operator: Optional[str]
+    destination_id: Optional[str]
+    destination_name: Optional[str]
+    direction: Optional[str]
+    aimed: Optional[datetime]
+    expected: Optional[datetime]
+    status: Optional[str]
+    monitored: Optional[bool]
+    accessible: Optional[bool]
+    vehicle_id: Optional[str]
+    key: Tuple
+
+    @classmethod
+    def from_api(cls, stop_id: str, data: Dict[str, Any]) -> "Departure":
+        """Create a departure from an entry in a predictions response."""
+        destination = data.get(ATTR_DESTINATION) or {}
+        times = data.get(ATTR_DEPARTURE) or {}
+        return cls(
+            stop_id=stop_id,
+            trip_id=data.get(ATTR_TRIP_ID),
+            service_id=data[ATTR_SERVICE],
+            operator=data.get(ATTR_OPERATOR),
+            destination_id=destination.get(ATTR_STOP),
+            destination_name=destination.get(ATTR_NAME),
+            direction=data.get(ATTR_DIRECTION),
+            aimed=parse_time(times.get(ATTR_AIMED)),
+            expected=parse_time(times.get(ATTR_EXPECTED)),
+            status=data.get(ATTR_STATUS),
+            monitored=data.get(ATTR_MONITORED),
+            accessible=data.get(ATTR_ACCESSIBLE),
+            vehicle_id=data.get(ATTR_VEHICLE),
+            key=trip_key(stop_id, data),
+        )
+
+    @property
+    def time(self) -> Optional[datetime]:
+        """Return the expected departure time, or the timetabled one."""
+        return self.expected or self.aimed
+
+
+class StopDepartures(NamedTuple):
+    """The departures from a stop, as fetched and as typed models."""
+
+    stop_id: str
+    data: Dict[str, Any]
+    departures: Tuple[Departure, ...]
+    fetched: datetime
+
+    @classmethod
+    def from_api(
+        cls, stop_id: str, data: Dict[str, Any], fetched: datetime
+    ) -> "StopDepartures":
+        departures = data.get(ATTR_DEPARTURES, [])
+        return cls(
+            stop_id,
+            data,
+            tuple(Departure.from_api(stop_id, d) for d in departures),
+            fetched,
+        )
+
+    @property
+    def closed(self) -> bool:
+        return bool(self.data.get(ATTR_CLOSED))
+
+    def select(
+        self, departure_filter: Optional[DepartureFilter], now: datetime
+    ) -> List[Departure]:
+        """Return the departures that pass a filter, in time order."""
+        if departure_filter is None:
+            return list(self.departures)
+        raw = self.data.get(ATTR_DEPARTURES, [])
+        return [
+            departure
+            for data, departure in zip(raw, self.departures)
+            if departure_filter.matches(data, now)
+        ]
+
+
+class DepartureUpdate(NamedTuple):
+    """The departures from a stop that changed since the last update."""
+
+    stop_id: str
+    added: List[Departure]
+    changed: List[Departure]
+    removed: List[Departure]
+
+
+def departures_diff(
+    stop_id: str, old: Iterable[Departure], new: Iterable[Departure]
+) -> Optional[DepartureUpdate]:
+    """Return what changed between two lists of departures, if anything."""
+    old_keys = {d.key: d for d in old}
+    new_keys = {d.key: d for d in new}
+    added = [d for k, d in new_keys.items() if k not in old_keys]
+    changed = [d for k, d in new_keys.items() if k in old_keys and old_keys[k] != d]
+    removed = [d for k, d in old_keys.items() if k not in new_keys]
+    if not (added or changed or removed):
+        return None
+    return DepartureUpdate(stop_id, added, changed, removed)
+
+
+class MetlinkClient:
+    """Cached, coalescing access to Metlink departures.
+
+    Departures are cached for CACHE_MAX_AGE, and concurrent requests for a
+    stop share a single fetch.  A stop whose fetch fails is not tried again
+    until its backoff has passed, and in the meantime its last departures
+    are returned, or the error raised again if there are none.
+
+    metlink is a Metlink client, or a KeyPool of them.
+    """
+
+    def __init__(self, metlink: Metlink, cache_max_age: timedelta = CACHE_MAX_AGE):
+        self.metlink = metlink
+        self.cache_max_age = cache_max_age
+        self._cache: Dict[str, StopDepartures] = {}
+        self._errors: Dict[str, BaseException] = {}
+        self._fetches = SharedFetches()
+        self._backoffs: Dict[str, Backoff] = {}
+
+    @classmethod
+    def create(cls, api_key: str, pool_size: int = MIN_POOL_SIZE) -> "MetlinkClient":
+        """Create a client with its own session.
+
+        api_key can be several comma separated keys, each optionally with a
+        weight, as in the integration's config.
+        """
+        session = create_session(pool_size)
+        return cls(
+            KeyPool(
+                [
+                    (mask_key(key), Metlink(session, key, True, hedge=True), weight)
+                    for key, weight in parse_api_keys(api_key).items()
+                ]
+            )
+        )
+
+    async def close(self) -> None:
+        await self.metlink.close()
+
+    def _backoff(self, stop_id: str) -> Backoff:
+        return self._backoffs.setdefault(stop_id, Backoff(MIN_BACKOFF, MAX_BACKOFF))
+
+    async def get_departures(
+        self, stop_id: str, max_age: Optional[timedelta] = None
+    ) -> StopDepartures:
+        """Return the departures from a stop, from the cache if fresh enough."""
+        if max_age is None:
+            max_age = self.cache_max_age
+        now = utcnow()
+        cached = self._cache.get(stop_id)
+        if cached is not None and now - cached.fetched <= max_age:
+            return cached
+        if not self._backoff(stop_id).ready(now):
+            if cached is not None:
+                return cached
+            raise self._errors[stop_id]
+        return await self._fetches.fetch(stop_id, lambda: self._async_fetch(stop_id))
+
+    async def _async_fetch(self, stop_id: str) -> StopDepartures:
+        try:
+            data = await self.metlink.get_predictions(stop_id, deadline=FETCH_DEADLINE)
+        except Exception as err:
+            self._errors[stop_id] = err
+            wait = self._backoff(stop_id).failed(utcnow())
+            _LOGGER.debug(f"Fetching {stop_id} failed, retrying in {wait}: {err!r}")
+            raise
+        self._backoff(stop_id).succeeded()
+        self._errors.pop(stop_id, None)
+        stop = StopDepartures.from_api(stop_id, data, utcnow())
+        self._cache[stop_id] = stop
+        return stop
+
+    async def watch(
+        self,
+        stop_ids: Iterable[str],
+        departure_filter: Optional[DepartureFilter] = None,
+    ) -> AsyncIterator[DepartureUpdate]:
+        """Poll some stops, yielding their departures whenever they change.
+
+        The first update for each stop has all its departures as added.
+        Each stop is polled on the integration's schedule, more often as its
+        next departure approaches, and departure_filter, if given, selects
+        the departures of interest.
+        """
+        stop_ids = list(dict.fromkeys(stop_ids))
+        seen: Dict[str, List[Departure]] = {stop_id: [] for stop_id in stop_ids}
+        due = {stop_id: utcnow() for stop_id in stop_ids}
+        while True:
+            now = utcnow()
+            polling = [stop_id for stop_id, when in due.items() if when <= now]
+            results = await asyncio.gather(
+                *(self.get_departures(s, max_age=timedelta(0)) for s in polling),
+                return_exceptions=True,
+            )
+            now = utcnow()
+            for stop_id, result in zip(polling, results):
+                backoff = self._backoff(stop_id)
+                if isinstance(result, BaseException) or not backoff.ready(now):
+                    # Departures served from the cache while backing off
+                    # have been seen already.
+                    due[stop_id] = backoff.retry_at or now + MIN_BACKOFF
+                    continue
+                departures = result.select(departure_filter, now)
+                next_departure = departures[0].time if departures else None
+                due[stop_id] = max(
+                    next_poll(next_departure, now, result.closed),
+                    now + MIN_POLL_INTERVAL,
+                )
+                update = departures_diff(stop_id, seen[stop_id], departures)
+                seen[stop_id] = departures
+                if update is not None:
+                    yield update
+            await asyncio.sleep(
+                max(0, (min(due.values()) - utcnow()).total_seconds())
+            )
@@ -0,0 +1,124 @@
+"""Commute windows, when a stop's departures must be kept fresh."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, time, timedelta
+from typing import Any, Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+
+import homeassistant.util.dt as dt_util
+import voluptuous as vol
+
+from .const import CONF_COMMUTE_MAX_AGE, CONF_COMMUTE_WINDOWS, DEFAULT_COMMUTE_MAX_AGE
+from .helpers import split_list
+
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+EVERY_DAY = frozenset(range(7))
+# Days are joined with + and ranges given with -, e.g. mon-wed+fri
+DAY_SEPARATOR = "+"
+RANGE_SEPARATOR = "-"
+TIME_FORMAT = "%H:%M"
+
+
+class CommuteWindow(NamedTuple):
+    """A time of day, on some days of the week, to keep departures fresh."""
+
+    days: FrozenSet[int]
+    start: time
+    end: time
+
+
+def parse_days(text: str) -> FrozenSet[int]:
+    """Parse days of the week such as mon-fri or sat+sun."""
+    days = set()
+    for item in text.lower().split(DAY_SEPARATOR):
+        first, _, last = item.strip().partition(RANGE_SEPARATOR)
+        if first not in WEEKDAYS or (last and last not in WEEKDAYS):
+            raise ValueError(f"Unknown day: {item}")
+        start = WEEKDAYS.index(first)
+        end = WEEKDAYS.index(last or first)
+        if end < start:
+            raise ValueError(f"Days run backwards: {item}")
+        days.update(range(start, end + 1))
+    return frozenset(days)
+
+
+def parse_windows(text: Optional[str]) -> List[CommuteWindow]:
+    """Parse comma separated windows such as "mon-fri 07:30-08:30".
+
+    The days can be left out for a window every day.  Raises a ValueError
+    for windows that cannot be understood.
+    """
+    windows = []
+    for item in split_list(text):
+        parts = item.split()
+        if len(parts) not in (1, 2):
+            raise ValueError(f"Expected [days] HH:MM-HH:MM: {item}")
+        days = parse_days(parts[0]) if len(parts) == 2 else EVERY_DAY
+        start, _, end = parts[-1].partition(RANGE_SEPARATOR)
+        window = CommuteWindow(
+            days,
+            datetime.strptime(start, TIME_FORMAT).time(),
+            datetime.strptime(end, TIME_FORMAT).time(),
+        )
+        if window.end <= window.start:
+            raise ValueError(f"Window ends before it starts: {item}")
+        windows.append(window)
+    return windows
+
+
+def commute_windows(value: str) -> str:
+    """Validate the commute windows for a stop from the config."""
+    try:
+        parse_windows(value)
+    except ValueError as err:
+        raise vol.Invalid(str(err)) from err
+    return ", ".join(split_list(value))
+
+
+class CommuteSchedule:
+    """The commute windows for a stop, and how fresh its data must be in them.
+
+    Times are in Home Assistant's time zone.
+    """
+
+    def __init__(self, windows: List[CommuteWindow], max_age: int):
+        self.windows = windows
+        self.max_age = max_age
+
+    @classmethod
+    def from_config(cls, stop: Dict[str, Any]) -> Optional["CommuteSchedule"]:
+        """Return the schedule for a configured stop, if it has windows."""
+        windows = parse_windows(stop.get(CONF_COMMUTE_WINDOWS))
+        if not windows:
+            return None
+        return cls(windows, stop.get(CONF_COMMUTE_MAX_AGE, DEFAULT_COMMUTE_MAX_AGE))
+
+    def next_window(self, now: datetime) -> Optional[Tuple[datetime, datetime]]:
+        """Return the start and end of the window in force or coming next."""
+        local = dt_util.as_local(now)
+        # Every day of the week is looked at, starting from today.
+        for offset in range(8):
+            day = local.date() + timedelta(days=offset)
+            spans = sorted(
+                (
+                    datetime.combine(day, window.start, tzinfo=local.tzinfo),
+                    datetime.combine(day, window.end, tzinfo=local.tzinfo),
+                )
+                for window in self.windows
+                if day.weekday() in window.days
+            )
+            for start, end in spans:
+                if end > local:
+                    return start, end
+        return None
@@ -13,13 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 from copy import deepcopy
+import csv
+import io
 import logging
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 from aiohttp import ClientResponseError
 from homeassistant import config_entries, core
-from homeassistant.const import CONF_API_KEY
+from homeassistant.const import CONF_API_KEY, Platform
 from homeassistant.core import callback
 from homeassistant.helpers.aiohttp_client import async_get_clientsession
 import homeassistant.helpers.config_validation as cv
@@ -27,46 +30,261 @@ from homeassistant.helpers.entity_registry import (
     async_entries_for_config_entry,
     async_get,
 )
+from homeassistant.helpers.selector import TextSelector, TextSelectorConfig
 import voluptuous as vol
 
 from .MetlinkAPI import Metlink
 from .const import (
+    ATTR_STOP,
+    CONF_ACCESSIBLE,
+    CONF_COMMUTE_MAX_AGE,
+    CONF_COMMUTE_WINDOWS,
+    CONF_DEPARTURE_OFFSETS,
     CONF_DEST,
+    CONF_DIRECTION,
+    CONF_GROUP,
+    CONF_MIN_LEAD,
     CONF_NUM_DEPARTURES,
+    CONF_OPERATOR,
     CONF_ROUTE,
+    CONF_STARTUP_WINDOW,
     CONF_STOP_ID,
     CONF_STOPS,
+    DEFAULT_COMMUTE_MAX_AGE,
+    DEFAULT_DEPARTURE_OFFSETS,
+    DEFAULT_STARTUP_WINDOW,
+    DIRECTIONS,
     DOMAIN,
+    MIN_COMMUTE_MAX_AGE,
 )
-from .sensor import metlink_unique_id
+from .commute import commute_windows
+from .helpers import metlink_unique_id, split_list
+from .key_pool import KeyPool, mask_key, parse_api_keys
 
 _LOGGER = logging.getLogger(__name__)
 
-AUTH_SCHEMA = vol.Schema({vol.Required(CONF_API_KEY): cv.string})
+# Fields for importing a list of stops at once.
+BULK_IMPORT = "bulk_import"
+STOP_LIST = "stop_list"
+# Maximum number of stops checked against the API at once, when the stop
+# catalogue cannot be downloaded.
+MAX_CONCURRENT_VALIDATIONS = 8
+# Seconds allowed for each request when validating stops.
+VALIDATION_DEADLINE = 20
+
+
+def route_list(value: str) -> str:
+    """Validate a comma separated list of routes."""
+    routes = split_list(value)
+    if any(len(route) > 3 for route in routes):
+        raise vol.Invalid("Routes are at most 3 characters")
+    return ", ".join(routes)
+
+
+def group_list(value: str) -> str:
+    """Validate a comma separated list of stops to group with a stop."""
+    stops = split_list(value)
+    if any(not 3 <= len(stop) <= 4 for stop in stops):
+        raise vol.Invalid("Stop ids are 3 to 4 characters")
+    return ", ".join(stops)
+
+
+def offset_list(value: str) -> str:
+    """Validate a comma separated list of minutes before departure."""
+    offsets = split_list(value)
+    if not all(offset.isdigit() for offset in offsets):
+        raise vol.Invalid("Offsets are whole minutes")
+    return ", ".join(offsets)
+
+
+# Optional filters on the departures, other stops to merge them with, and
+# when to keep them fresh, shared by the config and options flows
+FILTER_SCHEMA = {
+    vol.Optional(CONF_ROUTE, default=""): vol.All(cv.string, route_list),
+    vol.Optional(CONF_DEST, default=""): cv.string,
+    vol.Optional(CONF_DIRECTION, default=""): vol.In([""] + DIRECTIONS),
+    vol.Optional(CONF_OPERATOR, default=""): cv.string,
+    vol.Optional(CONF_ACCESSIBLE, default=False): cv.boolean,
+    vol.Optional(CONF_MIN_LEAD, default=0): cv.positive_int,
+    vol.Optional(CONF_GROUP, default=""): vol.All(cv.string, group_list),
+    vol.Optional(CONF_COMMUTE_WINDOWS, default=""): vol.All(
+        cv.string, commute_windows
+    ),
+    vol.Optional(CONF_COMMUTE_MAX_AGE, default=DEFAULT_COMMUTE_MAX_AGE): vol.All(
+        vol.Coerce(int), vol.Range(min=MIN_COMMUTE_MAX_AGE)
+    ),
+}
+
+AUTH_SCHEMA = vol.Schema(
+    {
+        vol.Required(CONF_API_KEY): cv.string,
+        vol.Optional(BULK_IMPORT, default=False): cv.boolean,
+    }
+)
 STOP_SCHEMA = vol.Schema(
     {
         vol.Required(CONF_STOP_ID): vol.All(cv.string, vol.Length(min=3, max=4)),
-        vol.Optional(CONF_ROUTE, default=""): vol.All(cv.string, vol.Length(max=3)),
-        vol.Optional(CONF_DEST, default=""): cv.string,
+        **FILTER_SCHEMA,
         vol.Optional(CONF_NUM_DEPARTURES, default=1): cv.positive_int,
         vol.Optional("add_another", default=False): cv.boolean,
     }
 )
+# A stop in a pasted list: stop_id[,route][,destination][,num_departures]
+STOP_LINE_SCHEMA = vol.Schema(
+    {
+        vol.Required(CONF_STOP_ID): vol.All(cv.string, vol.Length(min=3, max=4)),
+        vol.Optional(CONF_ROUTE): vol.All(cv.string, route_list),
+        vol.Optional(CONF_DEST): cv.string,
+        vol.Optional(CONF_NUM_DEPARTURES): cv.positive_int,
+    }
+)
+STOP_LINE_FIELDS = (CONF_STOP_ID, CONF_ROUTE, CONF_DEST, CONF_NUM_DEPARTURES)
+STOP_LIST_SELECTOR = TextSelector(TextSelectorConfig(multiline=True))
 
 
-async def validate_auth(apikey: str, hass: core.HomeAssistant) -> None:
-    """Validate a Metlink API key.
+def stop_config(user_input: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the config for a stop from the submitted form.
+
+    The newer filters are only stored when set, so stops that do not use
+    them are stored as before.
+    """
+    stop = {
+        CONF_STOP_ID: user_input[CONF_STOP_ID],
+        CONF_ROUTE: user_input.get(CONF_ROUTE),
+        CONF_DEST: user_input.get(CONF_DEST),
+        CONF_NUM_DEPARTURES: user_input.get(CONF_NUM_DEPARTURES, 1),
+    }
+    for key in (
+        CONF_DIRECTION,
+        CONF_OPERATOR,
+        CONF_ACCESSIBLE,
+        CONF_MIN_LEAD,
+        CONF_GROUP,
+        CONF_COMMUTE_WINDOWS,
+    ):
+        if user_input.get(key):
+            stop[key] = user_input[key]
+    # The max age only matters with commute windows.
+    if stop.get(CONF_COMMUTE_WINDOWS):
+        stop[CONF_COMMUTE_MAX_AGE] = user_input.get(
+            CONF_COMMUTE_MAX_AGE, DEFAULT_COMMUTE_MAX_AGE
+        )
+    return stop
+
 
-    Raises a ValueError if the api key is invalid.
+def parse_stop_list(text: str) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """Parse a pasted list or CSV of stops, one per line.
+
+    Returns the stops that could be parsed, and a message for each line
+    that could not.
+    """
+    stops = []
+    errors = []
+    for number, row in enumerate(csv.reader(io.StringIO(text)), 1):
+        fields = [field.strip() for field in row]
+        if not any(fields):
+            continue
+        if len(fields) > len(STOP_LINE_FIELDS):
+            errors.append(f"line {number}: too many fields")
+            continue
+        line = {key: value for key, value in zip(STOP_LINE_FIELDS, fields) if value}
+        try:
+            stops.append(stop_config(STOP_LINE_SCHEMA(line)))
+        except vol.Invalid as err:
+            errors.append(f"line {number}: {err}")
+    return stops, errors
+
+
+async def validate_stops(
+    hass: core.HomeAssistant, apikey: str, stops: List[Dict[str, Any]]
+) -> List[str]:
+    """Check that stops exist, returning a message for each that does not.
+
+    The stops are looked up in Metlink's stop catalogue, which is a single
+    request however many stops there are.  If it is unavailable, the
+    stops' predictions are requested instead, a few at a time.  Requests
+    are spread over the API keys, so a throttled or refused key is retried
+    with another.
     """
     session = async_get_clientsession(hass)
-    metlink = Metlink(session, apikey)
+    metlink = KeyPool(
+        [
+            (mask_key(key), Metlink(session, key), weight)
+            for key, weight in parse_api_keys(apikey).items()
+        ]
+    )
+    stop_ids = list(dict.fromkeys(stop[CONF_STOP_ID] for stop in stops))
+    try:
+        catalogue = await metlink.get_stops(deadline=VALIDATION_DEADLINE)
+    except Exception:
+        _LOGGER.warning("Unable to download the stop catalogue", exc_info=True)
+    else:
+        known = {stop.get(ATTR_STOP) for stop in catalogue}
+        return [
+            f"{stop_id}: unknown stop" for stop_id in stop_ids if stop_id not in known
+        ]
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_VALIDATIONS)
 
+    async def validate(stop_id: str) -> None:
+        async with semaphore:
+            await metlink.get_predictions(stop_id, deadline=VALIDATION_DEADLINE)
+
+    results = await asyncio.gather(
+        *(validate(stop_id) for stop_id in stop_ids), return_exceptions=True
+    )
+    errors = []
+    for stop_id, result in zip(stop_ids, results):
+        if isinstance(result, ClientResponseError):
+            errors.append(f"{stop_id}: rejected by the API ({result.status})")
+        elif isinstance(result, Exception):
+            errors.append(f"{stop_id}: could not be checked")
+    return errors
+
+
+async def async_import_stop_list(
+    hass: core.HomeAssistant, apikey: str, text: str
+) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """Parse and validate a pasted list of stops, collecting all the errors."""
+    stops, errors = parse_stop_list(text)
+    if stops:
+        errors.extend(await validate_stops(hass, apikey, stops))
+    elif not errors:
+        errors.append("no stops given")
+    _LOGGER.info(f"Imported {len(stops)} stops with {len(errors)} errors")
+    return stops, errors
+
+
+async def validate_auth(apikey: str, hass: core.HomeAssistant) -> None:
+    """Validate one or more comma separated Metlink API keys.
+
+    The keys are checked concurrently.  Raises a ValueError if any of them
+    is invalid.
+    """
     try:
-        await metlink.get_predictions("9999")
-    except ClientResponseError:
-        _LOGGER.error("Metlink API Key rejected by server")
+        keys = parse_api_keys(apikey)
+    except ValueError:
+        _LOGGER.error("Unable to parse the Metlink API keys")
+        raise
+    session = async_get_clientsession(hass)
+
+    async def validate(key: str) -> None:
+        await Metlink(session, key).get_predictions("9999")
+
+    results = await asyncio.gather(
+        *(validate(key) for key in keys), return_exceptions=True
+    )
+    rejected = [
+        mask_key(key)
+        for key, result in zip(keys, results)
+        if isinstance(result, ClientResponseError)
+    ]
+    if rejected:
+        _LOGGER.error(f"Metlink API Key rejected by server: {', '.join(rejected)}")
         raise ValueError
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
 
 
 class MetlinkNZConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
@@ -85,10 +303,13 @@ class MetlinkNZConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
                 errors["base"] = "auth"
 
             if not errors:
+                bulk_import = user_input.pop(BULK_IMPORT, False)
                 self.data = user_input
                 self.data[CONF_STOPS] = []
                 # Return the form for the next step
                 _LOGGER.info("Proceeding to configure stops")
+                if bulk_import:
+                    return await self.async_step_bulk()
                 return await self.async_step_stop()
 
         _LOGGER.info("Starting configuration process")
@@ -101,14 +322,7 @@ class MetlinkNZConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
         errors: Dict[str, str] = {}
         if user_input is not None:
             _LOGGER.info(f"Adding stop {user_input[CONF_STOP_ID]} to config.")
-            self.data[CONF_STOPS].append(
-                {
-                    CONF_STOP_ID: user_input[CONF_STOP_ID],
-                    CONF_ROUTE: user_input.get(CONF_ROUTE),
-                    CONF_DEST: user_input.get(CONF_DEST),
-                    CONF_NUM_DEPARTURES: user_input.get(CONF_NUM_DEPARTURES, 1),
-                }
-            )
+            self.data[CONF_STOPS].append(stop_config(user_input))
             # show the form again if add_another is ticked
             if user_input.get("add_another", False):
                 _LOGGER.debug("Continuing to add another stop.")
@@ -124,6 +338,32 @@ class MetlinkNZConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
             step_id="stop", data_schema=STOP_SCHEMA, errors=errors
         )
 
+    async def async_step_bulk(self, user_input: Optional[Dict[str, Any]] = None):
+        """Alternative second step, to add a pasted list of stops at once."""
+        errors: Dict[str, str] = {}
+        placeholders = {"errors": ""}
+        text = ""
+        if user_input is not None:
+            text = user_input[STOP_LIST]
+            stops, problems = await async_import_stop_list(
+                self.hass, self.data[CONF_API_KEY], text
+            )
+            if not problems:
+                self.data[CONF_STOPS].extend(stops)
+                _LOGGER.info(f"Saving config with {len(stops)} stops.")
+                return self.async_create_entry(title="Metlink", data=self.data)
+            errors["base"] = "stop_list"
+            placeholders["errors"] = "; ".join(problems)
+
+        return self.async_show_form(
+            step_id="bulk",
+            data_schema=vol.Schema(
+                {vol.Required(STOP_LIST, default=text): STOP_LIST_SELECTOR}
+            ),
+            errors=errors,
+            description_placeholders=placeholders,
+        )
+
     @staticmethod
     @callback
     def async_get_options_flow(config_entry):
@@ -146,48 +386,71 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
             entity_registry, self.config_entry.entry_id
         )
         errors: Dict[str, str] = {}
-        all_stops = {e.entity_id: e.original_name for e in entries}
-        stop_map = {e.entity_id: e for e in entries}
+        # Each stop also has a calendar, which goes with its sensor.
+        sensors = [e for e in entries if e.domain == Platform.SENSOR]
+        all_stops = {e.entity_id: e.original_name for e in sensors}
+        stop_map = {e.entity_id: e for e in sensors}
         # Merge initial config and later modifications
         config = {**self.config_entry.data, **self.config_entry.options}
 
-        if user_input is not None:
+        placeholders = {"errors": ""}
+        imported: List[Dict[str, Any]] = []
+        if user_input is not None and user_input.get(STOP_LIST):
+            imported, problems = await async_import_stop_list(
+                self.hass, config[CONF_API_KEY], user_input[STOP_LIST]
+            )
+            if problems:
+                errors["base"] = "stop_list"
+                placeholders["errors"] = "; ".join(problems)
+
+        if user_input is not None and not errors:
             _LOGGER.debug(f"Starting reconfiguration for {user_input}")
             updated_stops = deepcopy(config.get(CONF_STOPS))
             _LOGGER.debug(f"Stops before reconfiguration: {updated_stops}")
 
+            new_stops = imported
+            if user_input.get(CONF_STOP_ID):
+                new_stops = [stop_config(user_input)] + imported
+            # Stops added again with the same unique id replace the old
+            # config, keeping their entities.
+            replaced = {metlink_unique_id(stop) for stop in new_stops}
+
             # Remove unchecked stops.
             removed_entities = [
                 entity_id
                 for entity_id in stop_map.keys()
                 if entity_id not in user_input["stops"]
             ]
+            removed_stops = set()
             for entity_id in removed_entities:
-                # Unregister from HA
-                entity_registry.async_remove(entity_id)
-                # Remove from our configured stops.
-                entry = stop_map[entity_id]
-                entry_stop = entry.unique_id
-                _LOGGER.info(f"Removing stop {entry_stop}")
-                updated_stops = [
-                    e for e in updated_stops if metlink_unique_id(e) != entry_stop
-                ]
+                removed_stops.add(stop_map[entity_id].unique_id)
+            for entry in entries:
+                if entry.unique_id in removed_stops - replaced:
+                    # Unregister from HA
+                    entity_registry.async_remove(entry.entity_id)
+            # Remove from our configured stops, in one pass for all of them.
+            _LOGGER.info(f"Removing stops {removed_stops}")
+            updated_stops = [
+                e
+                for e in updated_stops
+                if metlink_unique_id(e) not in removed_stops | replaced
+            ]
 
             _LOGGER.debug(f"Stops after removals: {updated_stops}")
-            if user_input.get(CONF_STOP_ID):
-                updated_stops.append(
-                    {
-                        CONF_STOP_ID: user_input[CONF_STOP_ID],
-                        CONF_ROUTE: user_input.get(CONF_ROUTE),
-                        CONF_DEST: user_input.get(CONF_DEST),
-                        CONF_NUM_DEPARTURES: user_input.get(CONF_NUM_DEPARTURES, 1),
-                    }
-                )
+            updated_stops.extend(new_stops)
 
             _LOGGER.debug(f"Reconfigured stops: {updated_stops}")
             return self.async_create_entry(
                 title="",
-                data={CONF_STOPS: updated_stops},
+                data={
+                    CONF_STOPS: updated_stops,
+                    CONF_STARTUP_WINDOW: user_input.get(
+                        CONF_STARTUP_WINDOW, DEFAULT_STARTUP_WINDOW
+                    ),
+                    CONF_DEPARTURE_OFFSETS: user_input.get(
+                        CONF_DEPARTURE_OFFSETS, DEFAULT_DEPARTURE_OFFSETS
+                    ),
+                },
             )
 
         options_schema = vol.Schema(
@@ -198,14 +461,25 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
                 vol.Optional(CONF_STOP_ID): vol.All(
                     cv.string, vol.Length(min=3, max=4)
                 ),
-                vol.Optional(CONF_ROUTE, default=""): vol.All(
-                    cv.string, vol.Length(max=3)
-                ),
-                vol.Optional(CONF_DEST, default=""): cv.string,
+                **FILTER_SCHEMA,
                 vol.Optional(CONF_NUM_DEPARTURES, default=1): cv.positive_int,
+                vol.Optional(STOP_LIST): STOP_LIST_SELECTOR,
+                vol.Optional(
+                    CONF_STARTUP_WINDOW,
+                    default=config.get(CONF_STARTUP_WINDOW, DEFAULT_STARTUP_WINDOW),
+                ): cv.positive_int,
+                vol.Optional(
+                    CONF_DEPARTURE_OFFSETS,
+                    default=config.get(
+                        CONF_DEPARTURE_OFFSETS, DEFAULT_DEPARTURE_OFFSETS
+                    ),
+                ): vol.All(cv.string, offset_list),
             }
         )
         _LOGGER.debug("Showing Reconfiguration form")
         return self.async_show_form(
-            step_id="init", data_schema=options_schema, errors=errors
+            step_id="init",
+            data_schema=options_schema,
+            errors=errors,
+            description_placeholders=placeholders,
         )
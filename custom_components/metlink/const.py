@@ -16,11 +16,40 @@ DOMAIN = "metlink"
 ATTRIBUTION = "Data provided by Greater Wellington Regional Council"
 LANG = "en" # API only provides English translations
 
+# Events fired on the bus
+EVENT_ALERT = "metlink_alert"
+EVENT_DEPARTURE_SOON = "metlink_departure_soon"
+
 CONF_STOPS = "stops"
 CONF_STOP_ID = "stop_id"
 CONF_DEST = "destination"
 CONF_ROUTE = "route"
 CONF_NUM_DEPARTURES = "num_departures"
+CONF_DIRECTION = "direction"
+CONF_OPERATOR = "operator"
+CONF_ACCESSIBLE = "accessible_only"
+CONF_MIN_LEAD = "min_lead_time"
+CONF_STARTUP_WINDOW = "startup_window"
+CONF_DEPARTURE_OFFSETS = "departure_event_offsets"
+CONF_GROUP = "group_stops"
+CONF_COMMUTE_WINDOWS = "commute_windows"
+CONF_COMMUTE_MAX_AGE = "commute_max_age"
+
+# Seconds over which the initial refresh of all stops is spread.
+DEFAULT_STARTUP_WINDOW = 60
+# Minutes before each departure that departure soon events are fired.
+DEFAULT_DEPARTURE_OFFSETS = "10, 5"
+# Seconds that departures are kept fresh within during commute windows, and
+# the least that can be asked for, the interval the engine refreshes at.
+DEFAULT_COMMUTE_MAX_AGE = 60
+MIN_COMMUTE_MAX_AGE = 30
+
+DIRECTIONS = ["outbound", "inbound"]
+# The status of departures that will not run.
+STATUS_CANCELLED = "cancelled"
+# By default, status is returned as null.  Follow the behaviour of signs and
+# call this "sched", meaning scheduled with no realtime status
+DEFAULT_STATUS = "sched"
 
 ATTR_ACCESSIBLE = "wheelchair_accessible"
 ATTR_AIMED = "aimed"
@@ -48,11 +77,14 @@ ATTR_ENTITY = "entity"
 ATTR_EXPECTED = "expected"
 ATTR_FAREZONE = "farezone"
 ATTR_HEADER_TEXT = "header_text"
+ATTR_ID = "id"
 ATTR_INFORMED_ENTITY = "informed_entity"
 ATTR_LANGUAGE = "language"
 ATTR_MONITORED = "monitored"
 ATTR_NAME = "name"
 ATTR_OPERATOR = "operator"
+ATTR_ROUTE_ID = "route_id"
+ATTR_ROUTE_SHORT_NAME = "route_short_name"
 ATTR_ORIGIN = "origin"
 ATTR_SERVICE = "service_id"
 ATTR_SEVERITY_LEVEL = "severity_level"
@@ -0,0 +1,261 @@
+"""Long-term statistics of departure delays, per stop and route."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timedelta
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from homeassistant import core
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP, PERCENTAGE, UnitOfTime
+from homeassistant.helpers.event import async_track_time_change
+from homeassistant.helpers.singleton import singleton
+import homeassistant.util.dt as dt_util
+from homeassistant.util import slugify
+
+from .const import (
+    ATTR_AIMED,
+    ATTR_DEPARTURE,
+    ATTR_DEPARTURES,
+    ATTR_EXPECTED,
+    ATTR_SERVICE,
+    ATTR_STATUS,
+    DOMAIN,
+    STATUS_CANCELLED,
+)
+from .polling import trip_key
+
+_LOGGER = logging.getLogger(__name__)
+
+DATA_DELAY_STATISTICS = f"{DOMAIN}_delay_statistics"
+# Departures up to this early or late, in seconds, count as on time.
+ON_TIME_EARLY = 60
+ON_TIME_LATE = 300
+# Hours are imported this long after they end, to catch trips that were
+# still being followed at the end of the hour.
+IMPORT_DELAY = timedelta(minutes=15)
+
+
+class HourAccumulator:
+    """Delays of the departures of a route from a stop in an hour.
+
+    Cancelled departures have no delay, so are only counted, separately.
+    """
+
+    __slots__ = ("count", "total", "minimum", "maximum", "on_time", "cancelled")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = 0.0
+        self.maximum = 0.0
+        self.on_time = 0
+        self.cancelled = 0
+
+    def add(self, delay: float) -> None:
+        if self.count == 0:
+            self.minimum = self.maximum = delay
+        else:
+            self.minimum = min(self.minimum, delay)
+            self.maximum = max(self.maximum, delay)
+        self.count += 1
+        self.total += delay
+        if -ON_TIME_EARLY <= delay <= ON_TIME_LATE:
+            self.on_time += 1
+
+
+class DelayStatistics:
+    """Hourly delay statistics, imported into Home Assistant's long-term
+    statistics.
+
+    Each realtime trip is followed until it has departed, and only its last
+    prediction counted, so stops are not weighted by how often they were
+    polled.  Trips last listed as cancelled are counted as such, rather
+    than as departing on time.  Completed hours are imported in one batch per statistic, so
+    nothing is written to the recorder per poll.
+    """
+
+    def __init__(self, hass: core.HomeAssistant):
+        self.hass = hass
+        # stop_id -> trip key -> (route, aimed, expected, cancelled), for the
+        # trips in each stop's latest predictions
+        self._pending: Dict[
+            str, Dict[Tuple, Tuple[str, datetime, datetime, bool]]
+        ] = {}
+        self._hours: Dict[Tuple[str, str, datetime], HourAccumulator] = {}
+        # Hours before this have been imported, so are complete.
+        self._imported_until = hour_start(dt_util.utcnow())
+
+    @core.callback
+    def async_observe(self, stop_id: str, data: Dict[str, Any], now: datetime) -> None:
+        """Record the predictions for a stop, and any trips that departed."""
+        current = {}
+        for departure in data.get(ATTR_DEPARTURES, []):
+            times = departure[ATTR_DEPARTURE]
+            aimed = dt_util.parse_datetime(times.get(ATTR_AIMED) or "")
+            expected = dt_util.parse_datetime(times.get(ATTR_EXPECTED) or "")
+            # Cancelled trips may have no expected time, and are done with
+            # at their aimed time.
+            cancelled = departure.get(ATTR_STATUS) == STATUS_CANCELLED
+            if aimed is None or (expected is None and not cancelled):
+                continue
+            key = trip_key(stop_id, departure)
+            route = departure[ATTR_SERVICE]
+            current[key] = (route, aimed, expected or aimed, cancelled)
+
+        # Trips no longer listed have departed if their time has passed,
+        # otherwise they were cancelled or dropped off the list.
+        for key, trip in self._pending.get(stop_id, {}).items():
+            if key not in current and trip[2] <= now:
+                self._add(stop_id, *trip)
+        self._pending[stop_id] = current
+
+    def _add(
+        self,
+        stop_id: str,
+        route: str,
+        aimed: datetime,
+        expected: datetime,
+        cancelled: bool,
+    ):
+        hour = hour_start(aimed)
+        if hour < self._imported_until:
+            return
+        accumulator = self._hours.get((stop_id, route, hour))
+        if accumulator is None:
+            accumulator = self._hours[(stop_id, route, hour)] = HourAccumulator()
+        if cancelled:
+            accumulator.cancelled += 1
+        else:
+            accumulator.add((expected - aimed).total_seconds())
+
+    @core.callback
+    def async_start(self) -> None:
+        """Import completed hours every hour, and when Home Assistant stops."""
+        unsub = async_track_time_change(
+            self.hass,
+            self.async_import,
+            minute=int(IMPORT_DELAY.total_seconds() // 60),
+            second=0,
+        )
+
+        @core.callback
+        def async_stop(event: core.Event) -> None:
+            unsub()
+            self.async_import(dt_util.utcnow())
+
+        self.hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_stop)
+
+    def pop_completed(
+        self, now: datetime
+    ) -> Dict[Tuple[str, str], List[Tuple[datetime, HourAccumulator]]]:
+        """Remove and return the completed hours, by stop and route."""
+        until = hour_start(now - IMPORT_DELAY)
+        batches: Dict[Tuple[str, str], List[Tuple[datetime, HourAccumulator]]] = {}
+        for (stop_id, route, hour), accumulator in list(self._hours.items()):
+            if hour < until:
+                batches.setdefault((stop_id, route), []).append((hour, accumulator))
+                del self._hours[(stop_id, route, hour)]
+        self._imported_until = max(self._imported_until, until)
+        for hours in batches.values():
+            hours.sort(key=lambda h: h[0])
+        return batches
+
+    @core.callback
+    def async_import(self, now: datetime) -> None:
+        """Import the hours that have completed into long-term statistics."""
+        batches = self.pop_completed(now)
+        if not batches:
+            return
+        if "recorder" not in self.hass.config.components:
+            _LOGGER.debug("Recorder not running, discarding delay statistics")
+            return
+        # The recorder is only imported once there is something to record.
+        from homeassistant.components.recorder.statistics import (
+            async_add_external_statistics,
+        )
+
+        for (stop_id, route), hours in batches.items():
+            for metadata, statistics in route_statistics(stop_id, route, hours):
+                if statistics:
+                    async_add_external_statistics(self.hass, metadata, statistics)
+        _LOGGER.debug(f"Imported delay statistics for {len(batches)} routes")
+
+
+def hour_start(when: datetime) -> datetime:
+    """Return the start of the UTC hour containing a time."""
+    return dt_util.as_utc(when).replace(minute=0, second=0, microsecond=0)
+
+
+def route_statistics(
+    stop_id: str, route: str, hours: List[Tuple[datetime, HourAccumulator]]
+) -> List[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+    """Return the statistics to import for a route at a stop."""
+    name = f"Metlink {stop_id} {route}"
+    object_id = slugify(f"{stop_id} {route}")
+
+    def metadata(kind: str, label: str, unit: Optional[str]) -> Dict[str, Any]:
+        return {
+            "has_mean": True,
+            "has_sum": False,
+            "name": f"{name} {label}",
+            "source": DOMAIN,
+            "statistic_id": f"{DOMAIN}:{kind}_{object_id}",
+            "unit_of_measurement": unit,
+        }
+
+    delays = []
+    on_time = []
+    departures = []
+    cancelled = []
+    for hour, acc in hours:
+        cancelled.append(
+            {
+                "start": hour,
+                "mean": acc.cancelled,
+                "min": acc.cancelled,
+                "max": acc.cancelled,
+            }
+        )
+        # An hour where every departure was cancelled has no delays.
+        if acc.count == 0:
+            continue
+        delays.append(
+            {
+                "start": hour,
+                "mean": acc.total / acc.count,
+                "min": acc.minimum,
+                "max": acc.maximum,
+            }
+        )
+        share = 100.0 * acc.on_time / acc.count
+        on_time.append({"start": hour, "mean": share, "min": share, "max": share})
+        departures.append(
+            {"start": hour, "mean": acc.count, "min": acc.count, "max": acc.count}
+        )
+    return [
+        (metadata("delay", "delay", UnitOfTime.SECONDS), delays),
+        (metadata("on_time", "on time", PERCENTAGE), on_time),
+        (metadata("departures", "departures", None), departures),
+        (metadata("cancelled", "cancelled", None), cancelled),
+    ]
+
+
+@singleton(DATA_DELAY_STATISTICS)
+@core.callback
+def async_get_delay_statistics(hass: core.HomeAssistant) -> DelayStatistics:
+    """Return the delay statistics shared by all Metlink setups."""
+    statistics = DelayStatistics(hass)
+    statistics.async_start()
+    return statistics
@@ -0,0 +1,237 @@
+"""Events fired a set time before the tracked departures."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timedelta
+import logging
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from homeassistant import core
+from homeassistant.helpers.event import async_track_point_in_time
+import homeassistant.util.dt as dt_util
+
+from .const import (
+    ATTR_DEPARTURE,
+    ATTR_DEPARTURES,
+    ATTR_DESTINATION,
+    ATTR_DESTINATION_ID,
+    ATTR_NAME,
+    ATTR_SERVICE,
+    ATTR_STOP,
+    ATTR_TRIP_ID,
+    EVENT_DEPARTURE_SOON,
+)
+from .filters import DepartureFilter, departure_time, merge_departures
+from .helpers import split_list
+from .polling import trip_key
+
+_LOGGER = logging.getLogger(__name__)
+
+# Events already scheduled are left alone unless the departure moves by
+# more than this.
+RESCHEDULE_TOLERANCE = timedelta(seconds=30)
+
+
+def parse_offsets(text: Optional[str]) -> List[int]:
+    """Parse comma separated minutes before departure."""
+    return sorted({int(offset) for offset in split_list(text)}, reverse=True)
+
+
+def shown_departures(
+    departure_filter: DepartureFilter,
+    num_departures: int,
+    departure_lists: Iterable[Iterable[Dict[str, Any]]],
+    now: datetime,
+) -> Iterator[Dict[str, Any]]:
+    """Yield the departures a sensor shows from its stops, in order.
+
+    The departures from each stop are merged as a group sensor merges them.
+    Departures too soon to be shown because of a minimum lead time are
+    included too, so those the sensor showed are followed until they leave.
+    """
+    without_lead = departure_filter.without_lead()
+    selected = [without_lead.select(departures, now) for departures in departure_lists]
+    shown = 0
+    for departure in merge_departures(selected):
+        if shown >= num_departures:
+            return
+        yield departure
+        if departure_filter.matches(departure, now):
+            shown += 1
+
+
+class ScheduledEvent:
+    """An event due at a time before a departure."""
+
+    def __init__(self, when: datetime, departure: Dict[str, Any]):
+        self.when = when
+        self.departure = departure
+        self.unsub: Optional[Callable[[], None]] = None
+
+    def cancel(self) -> None:
+        if self.unsub is not None:
+            self.unsub()
+            self.unsub = None
+
+
+class DepartureEvents:
+    """Fire metlink_departure_soon events at offsets before departures.
+
+    Each engine has one, so setups sharing the engine fire the event for a
+    departure and offset once, however many of them show it.  The
+    departures tracked are those shown by the sensors, and their events
+    are scheduled for the exact time whenever the engine updates their
+    stop.  A group sensor's departures are those in its merged list, so an
+    update to any of its stops reschedules the events at all of them.  An
+    event is only rescheduled when its departure's expected time
+    moves by more than RESCHEDULE_TOLERANCE, including after it has fired
+    if the new time is still to come.
+    """
+
+    def __init__(self, hass: core.HomeAssistant, engine):
+        self.hass = hass
+        self.engine = engine
+        # stop_id -> sensor -> offsets before its departures
+        self._sensors: Dict[str, Dict[Any, List[timedelta]]] = {}
+        # stop_id -> (trip key, offset) -> event
+        self._events: Dict[str, Dict[Tuple, ScheduledEvent]] = {}
+        self._unlisten: Optional[Callable[[], None]] = None
+
+    @core.callback
+    def async_add_sensors(self, sensors: Iterable, offsets: Iterable[int]) -> None:
+        """Track the departures shown by more sensors, at minutes before each."""
+        offsets = [timedelta(minutes=offset) for offset in offsets]
+        if not offsets:
+            return
+        for sensor in sensors:
+            for stop_id in sensor.stop_ids:
+                self._sensors.setdefault(stop_id, {})[sensor] = offsets
+        if self._sensors and self._unlisten is None:
+            self._unlisten = self.engine.async_listen(self._async_stop_updated)
+
+    @core.callback
+    def async_remove_sensors(self, sensors: Iterable) -> None:
+        """Stop tracking the departures shown by some sensors."""
+        removed = set(sensors)
+        stops = {stop_id for sensor in removed for stop_id in sensor.stop_ids}
+        for stop_id in stops:
+            watching = self._sensors.get(stop_id, {})
+            for sensor in removed & watching.keys():
+                del watching[sensor]
+            if watching:
+                # Drop the events only the removed sensors wanted.
+                self._async_stop_updated(stop_id)
+                continue
+            self._sensors.pop(stop_id, None)
+            for event in self._events.pop(stop_id, {}).values():
+                event.cancel()
+        if not self._sensors and self._unlisten is not None:
+            self._unlisten()
+            self._unlisten = None
+
+    def _tracked(self, stop_id: str, now: datetime) -> Dict[Tuple, Dict[str, Any]]:
+        """Return the departures from a stop its sensors show, by trip and offset."""
+        tracked = {}
+        for sensor, offsets in self._sensors[stop_id].items():
+            departure_lists = []
+            # Departures are matched to the stop by identity, as a trip that
+            # calls at more than one of a group's stops is shown at its first.
+            at_stop = set()
+            for sensor_stop in sensor.stop_ids:
+                cached = self.engine.predictions.get(sensor_stop)
+                if cached is None:
+                    continue
+                departures = cached.data.get(ATTR_DEPARTURES, [])
+                departure_lists.append(departures)
+                if sensor_stop == stop_id:
+                    at_stop = {id(departure) for departure in departures}
+            shown = shown_departures(
+                sensor.filter, sensor.num_departures, departure_lists, now
+            )
+            for departure in shown:
+                if id(departure) not in at_stop:
+                    continue
+                trip = trip_key(stop_id, departure)
+                for offset in offsets:
+                    tracked[trip, offset] = departure
+        return tracked
+
+    @core.callback
+    def _async_stop_updated(self, stop_id: str) -> None:
+        if stop_id not in self._sensors:
+            return
+        now = dt_util.utcnow()
+        stops = dict.fromkeys(
+            sensor_stop
+            for sensor in self._sensors[stop_id]
+            for sensor_stop in sensor.stop_ids
+        )
+        for sensor_stop in stops:
+            self._async_schedule(sensor_stop, now)
+
+    @core.callback
+    def _async_schedule(self, stop_id: str, now: datetime) -> None:
+        """Schedule the events for the departures tracked at a stop."""
+        tracked = self._tracked(stop_id, now)
+        events = self._events.setdefault(stop_id, {})
+        for key in [key for key in events if key not in tracked]:
+            events.pop(key).cancel()
+
+        for (trip, offset), departure in tracked.items():
+            leaves = dt_util.parse_datetime(departure_time(departure) or "")
+            if leaves is None:
+                continue
+            when = leaves - offset
+            event = events.get((trip, offset))
+            if event is not None:
+                if abs(when - event.when) <= RESCHEDULE_TOLERANCE:
+                    event.departure = departure
+                    continue
+                event.cancel()
+                del events[(trip, offset)]
+            if when <= now:
+                continue
+            event = ScheduledEvent(when, departure)
+            event.unsub = async_track_point_in_time(
+                self.hass, self._async_fire(stop_id, trip, offset), when
+            )
+            events[(trip, offset)] = event
+
+    def _async_fire(
+        self, stop_id: str, trip: Tuple, offset: timedelta
+    ) -> Callable[[datetime], None]:
+        @core.callback
+        def async_fire(now: datetime) -> None:
+            event = self._events.get(stop_id, {}).get((trip, offset))
+            if event is None:
+                return
+            # Kept, so the departure is not rescheduled unless it moves.
+            event.unsub = None
+            departure = event.departure
+            destination = departure[ATTR_DESTINATION]
+            _LOGGER.debug(f"{departure[ATTR_SERVICE]} from {stop_id} leaves soon")
+            self.hass.bus.async_fire(
+                EVENT_DEPARTURE_SOON,
+                {
+                    ATTR_STOP: stop_id,
+                    ATTR_TRIP_ID: departure.get(ATTR_TRIP_ID),
+                    ATTR_SERVICE: departure[ATTR_SERVICE],
+                    ATTR_DESTINATION: destination.get(ATTR_NAME),
+                    ATTR_DESTINATION_ID: destination.get(ATTR_STOP),
+                    ATTR_DEPARTURE: departure_time(departure),
+                    "minutes": int(offset / timedelta(minutes=1)),
+                },
+            )
+
+        return async_fire
@@ -0,0 +1,41 @@
+"""Diagnostics support for Metlink."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Any, Dict
+
+from homeassistant import config_entries, core
+from homeassistant.components.diagnostics import async_redact_data
+from homeassistant.const import CONF_API_KEY
+
+from .const import DOMAIN
+
+TO_REDACT = {CONF_API_KEY}
+
+
+async def async_get_config_entry_diagnostics(
+    hass: core.HomeAssistant, entry: config_entries.ConfigEntry
+) -> Dict[str, Any]:
+    """Return diagnostics for a config entry."""
+    diagnostics: Dict[str, Any] = {
+        "data": async_redact_data(entry.data, TO_REDACT),
+        "options": async_redact_data(entry.options, TO_REDACT),
+    }
+    engine = hass.data.get(DOMAIN, {}).get(entry.entry_id, {}).get("engine")
+    if engine is not None:
+        diagnostics["prediction_errors"] = engine.accuracy.summary()
+        diagnostics["loop_lag"] = engine.loop_lag.summary()
+        diagnostics["api_keys"] = engine.metlink.usage()
+        diagnostics["commute_reserved"] = engine.reserved
+    return diagnostics
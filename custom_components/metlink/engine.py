@@ -0,0 +1,800 @@
+"""Bulk refresh of Metlink stops."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from datetime import timedelta
+from itertools import islice
+import logging
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from homeassistant import core
+from homeassistant.const import EVENT_HOMEASSISTANT_CLOSE
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.event import async_track_time_interval
+import homeassistant.util.dt as dt_util
+from homeassistant.util.ssl import get_default_context
+
+from .MetlinkAPI import Metlink, create_session
+from .const import (
+    ATTR_AIMED,
+    ATTR_CLOSED,
+    ATTR_DEPARTURE,
+    ATTR_DEPARTURES,
+    ATTR_ENTITY,
+    ATTR_ROUTE_ID,
+    ATTR_ROUTE_SHORT_NAME,
+    ATTR_SERVICE,
+    ATTR_TRIP_ID,
+    DOMAIN,
+)
+from .accuracy import AccuracyTracker
+from .alerts import AlertTracker
+from .commute import CommuteSchedule
+from .delay_statistics import DelayStatistics, async_get_delay_statistics
+from .departure_events import DepartureEvents
+from .helpers import trip_alerts_index
+from .key_pool import KeyPool, engine_key, mask_key, parse_api_keys
+from .loop_lag import LoopLagMonitor
+from .polling import Backoff, SharedFetches
+from .service_hours import ServiceHours, async_get_service_hours
+from .timetable import Timetable, async_get_timetable
+from .trips import StopPredictions, TripIndex, derive_predictions
+from .volatility import VolatilityModel
+
+_LOGGER = logging.getLogger(__name__)
+
+# Key in hass.data[DOMAIN] of the running engines, one per set of API keys,
+# which setups share and services find the shared cache through.
+DATA_ENGINES = "engines"
+
+# How often to look for stops that are due for a refresh.
+REFRESH_INTERVAL = timedelta(seconds=30)
+# Maximum number of stops being fetched at once.
+MAX_CONCURRENT_FETCHES = 8
+# Seconds allowed for a refresh cycle.  Stops that are not fetched in time
+# stay due and are tried again in the next cycle.
+CYCLE_DEADLINE = 25
+# The alerts feed is shared by all stops, and reused for this long.
+ALERTS_MAX_AGE = timedelta(minutes=1)
+# The alerts feed is still checked this often when no stops are due, so
+# alerts on routes with nothing departing are noticed.
+ALERTS_POLL_INTERVAL = timedelta(minutes=5)
+# A failed fetch of the alerts feed is retried after this long, doubling
+# with each failure up to ALERTS_POLL_INTERVAL.
+ALERTS_RETRY_INTERVAL = timedelta(minutes=1)
+# Route names only change with the timetable, so the routes catalogue that
+# maps the alerts' route ids to them is downloaded this often.
+ROUTES_MAX_AGE = timedelta(days=1)
+# Sensors due this soon are refreshed in the current cycle, rather than
+# waiting almost a whole interval for the next one.
+DUE_SLACK = timedelta(seconds=5)
+# Polling intervals up to this long are adapted to how volatile the
+# predictions are.  Longer ones are waits for a distant departure.
+ADAPTIVE_MAX_INTERVAL = timedelta(minutes=10)
+# Requests per hour that adaptive polling aims to stay within.
+DEFAULT_REQUEST_BUDGET = 1200
+# Stops with commute windows are fetched this long before a window opens,
+# so the data is fresh from the start, and the requests they need in the
+# window are reserved from the budget from this long before.
+PREWARM_LEAD = timedelta(minutes=2)
+RESERVE_LEAD = timedelta(minutes=15)
+# Share of the budget kept for other stops, however much is reserved.
+MIN_UNRESERVED_SHARE = 0.2
+# How much polling is stretched for stops with commute windows when none
+# is in force.
+RELAXED_FACTOR = 4
+# Stops kept up to date by predictions at earlier stops on the same trips
+# are still fetched at least this often, to pick up other trips.
+MAX_DERIVED_AGE = timedelta(minutes=5)
+# Predictions this recent are served from the cache on request.
+CACHE_MAX_AGE = timedelta(minutes=1)
+# Payloads larger than these are processed in steps that yield to the
+# event loop, or in an executor.
+LARGE_DEPARTURES = 100
+LARGE_ALERTS = 200
+
+
+def departure_times(data: Dict[str, Any]) -> List:
+    """Return the timetabled departure times in a predictions response."""
+    times = []
+    for departure in data.get(ATTR_DEPARTURES, []):
+        aimed = dt_util.parse_datetime(departure[ATTR_DEPARTURE].get(ATTR_AIMED) or "")
+        if aimed is not None:
+            times.append(aimed)
+    return times
+
+
+@core.callback
+def async_get_engines(hass: core.HomeAssistant) -> Dict[Optional[str], "MetlinkEngine"]:
+    """Return the running engines, keyed by their sorted API keys."""
+    return hass.data.setdefault(DOMAIN, {}).setdefault(DATA_ENGINES, {})
+
+
+class MetlinkEngine:
+    """Refresh the sensors that are due, sharing fetches between them.
+
+    Each stop that has a due sensor is fetched once per cycle, however many
+    sensors watch it, and the alerts feed is fetched once for all of them.
+    Fetches run in parallel, up to MAX_CONCURRENT_FETCHES at a time, and
+    results are applied to the sensors as they arrive.
+
+    The latest predictions for each stop are kept in a cache, which can
+    also be queried directly.  Requests for a stop that is already being
+    fetched share the fetch in flight.
+
+    One engine is shared by all the setups using the same API key, which
+    subscribe their sensors to it.
+    """
+
+    def __init__(
+        self,
+        hass: core.HomeAssistant,
+        metlink: Metlink,
+        service_hours: Optional[ServiceHours] = None,
+        concurrency: int = MAX_CONCURRENT_FETCHES,
+        deadline: float = CYCLE_DEADLINE,
+        request_budget: int = DEFAULT_REQUEST_BUDGET,
+        statistics: Optional[DelayStatistics] = None,
+        api_key: Optional[str] = None,
+        timetable: Optional[Timetable] = None,
+    ):
+        self.hass = hass
+        self.metlink = metlink
+        self.service_hours = service_hours
+        self.deadline = deadline
+        self.request_budget = request_budget
+        self.statistics = statistics
+        self.api_key = api_key
+        self.timetable = timetable
+        self.volatility = VolatilityModel()
+        self.accuracy = AccuracyTracker()
+        self.alert_events = AlertTracker(hass)
+        self.departure_events = DepartureEvents(hass, self)
+        self.loop_lag = LoopLagMonitor()
+        self.trips = TripIndex()
+        self.predictions: Dict[str, StopPredictions] = {}
+        self.sensors: List = []
+        # Planned seconds between polls of each stop.
+        self._intervals: Dict[str, float] = {}
+        # Requests per hour reserved for stops in or near a commute window.
+        self.reserved: Dict[str, float] = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._refreshing = False
+        self._alerts: Dict[str, Any] = {ATTR_ENTITY: []}
+        self._alert_index: Dict[str, List[Dict[str, Any]]] = {}
+        self._alerts_time = None
+        self._alerts_task: Optional[asyncio.Task] = None
+        self._alerts_backoff = Backoff(ALERTS_RETRY_INTERVAL, ALERTS_POLL_INTERVAL)
+        # GTFS route id -> route short name, as used by departures.
+        self._route_names: Dict[str, str] = {}
+        self._routes_time = None
+        self._fetches = SharedFetches()
+        self._listeners: List[Callable[[str], None]] = []
+        self._subscriptions = 0
+        self._async_stop: Optional[Callable[[], None]] = None
+        self._remove_close: Optional[Callable[[], None]] = None
+
+    @core.callback
+    def async_add_sensors(self, sensors: Iterable) -> None:
+        """Take over the refreshing of some sensors."""
+        for sensor in sensors:
+            sensor.engine = self
+            self.sensors.append(sensor)
+
+    @core.callback
+    def async_remove_sensors(self, sensors: Iterable) -> None:
+        """Stop refreshing some sensors."""
+        removed = set(sensors)
+        self.sensors = [s for s in self.sensors if s not in removed]
+        # Stops no longer watched no longer count against the budget.
+        watched = {sensor.stop_id for sensor in self.sensors}
+        for stop_id in [s for s in self._intervals if s not in watched]:
+            del self._intervals[stop_id]
+
+    @core.callback
+    def async_subscribe(self, sensors: Iterable) -> Callable[[], None]:
+        """Refresh some sensors until the returned function is called.
+
+        The engine starts with its first subscription.  When the last one
+        is removed, or Home Assistant closes, it stops and closes its client.
+        """
+        sensors = list(sensors)
+        self.async_add_sensors(sensors)
+        if self._subscriptions == 0:
+            self._async_stop = self.async_start()
+            self._remove_close = self.hass.bus.async_listen_once(
+                EVENT_HOMEASSISTANT_CLOSE, self._async_close
+            )
+        self._subscriptions += 1
+
+        @core.callback
+        def async_unsubscribe() -> None:
+            self.async_remove_sensors(sensors)
+            self._subscriptions -= 1
+            if self._subscriptions == 0:
+                _LOGGER.debug("Last subscription removed, stopping the engine")
+                self._async_stop()
+                self._async_stop = None
+                if self._remove_close is not None:
+                    self._remove_close()
+                    self._remove_close = None
+                self.hass.async_create_task(self.metlink.close())
+
+        return async_unsubscribe
+
+    async def _async_close(self, event: core.Event) -> None:
+        self._remove_close = None
+        await self.metlink.close()
+
+    @core.callback
+    def async_listen(self, listener: Callable[[str], None]) -> Callable[[], None]:
+        """Call listener with the stop id whenever a stop's predictions change.
+
+        Returns a function that removes the listener.
+        """
+        self._listeners.append(listener)
+
+        @core.callback
+        def async_remove() -> None:
+            self._listeners.remove(listener)
+
+        return async_remove
+
+    @core.callback
+    def _async_notify(self, stop_id: str) -> None:
+        for listener in list(self._listeners):
+            listener(stop_id)
+
+    @core.callback
+    def async_start(self) -> Callable[[], None]:
+        """Start refreshing due sensors periodically.
+
+        Returns a function that stops the refreshes.
+        """
+        engines = async_get_engines(self.hass)
+        engines[self.api_key] = self
+        unsub = async_track_time_interval(
+            self.hass,
+            self._async_tick,
+            REFRESH_INTERVAL,
+            name="metlink refresh",
+            cancel_on_shutdown=True,
+        )
+
+        @core.callback
+        def async_stop() -> None:
+            unsub()
+            if engines.get(self.api_key) is self:
+                del engines[self.api_key]
+
+        return async_stop
+
+    async def _async_tick(self, now=None) -> None:
+        if self._refreshing:
+            _LOGGER.debug("Previous refresh still running, skipping this cycle")
+            return
+        self._refreshing = True
+        try:
+            await self.async_refresh()
+            if self.sensors:
+                self._async_refresh_alerts(ALERTS_POLL_INTERVAL)
+        finally:
+            self._refreshing = False
+
+    async def async_refresh(self, sensors: Optional[Iterable] = None) -> None:
+        """Refresh the sensors that are due, by default all of them."""
+        now = dt_util.as_local(dt_util.utcnow())
+        self.reserved = self._commute_reservations(now)
+        due: Dict[str, List] = {}
+        for sensor in self.sensors if sensors is None else sensors:
+            if sensor.update_time <= now + DUE_SLACK:
+                due.setdefault(sensor.stop_id, []).append(sensor)
+        if sensors is None:
+            skipped = set()
+            # Stops others rely on being fetched, so cannot be skipped.
+            needed = set()
+            for stop_id in due:
+                if stop_id in needed:
+                    continue
+                sources = self._derive_sources(stop_id, due, skipped, now)
+                if sources:
+                    _LOGGER.debug(f"Skipping {stop_id}, kept fresh from {sources}")
+                    skipped.add(stop_id)
+                    needed.update(sources)
+            for stop_id in skipped:
+                del due[stop_id]
+        if not due:
+            return
+
+        # The sensors are updated with the last alerts, and again if the
+        # feed brings new ones, so a slow feed never holds them up.
+        self._async_refresh_alerts(ALERTS_MAX_AGE)
+        loop = asyncio.get_running_loop()
+        end = loop.time() + self.deadline
+        tasks = [
+            asyncio.ensure_future(self._async_refresh_stop(stop_id, stop_sensors, end))
+            for stop_id, stop_sensors in due.items()
+        ]
+        async with self.loop_lag.async_measure():
+            _, pending = await asyncio.wait(tasks, timeout=self.deadline)
+        for task in pending:
+            task.cancel()
+        if pending:
+            # The fetches are shared, so are not cancelled along with the
+            # refresh, but are not worth waiting for any longer either.
+            for stop_id in due:
+                self._fetches.cancel(stop_id)
+            _LOGGER.info(
+                f"{len(pending)} of {len(tasks)} stops missed the refresh deadline, "
+                "they will be retried in the next cycle"
+            )
+
+    async def async_get_departures(
+        self, stop_ids: Iterable[str], max_age: timedelta = CACHE_MAX_AGE
+    ) -> Dict[str, StopPredictions]:
+        """Return the predictions for some stops, from the cache if possible.
+
+        Only stops whose cached predictions are older than max_age are
+        fetched.  If a fetch fails, any older predictions are returned, and
+        stops with none at all are left out.
+        """
+        now = dt_util.utcnow()
+        stale = [
+            stop_id
+            for stop_id in dict.fromkeys(stop_ids)
+            if stop_id not in self.predictions
+            or now - self.predictions[stop_id].updated > max_age
+        ]
+        if stale:
+            results = await asyncio.gather(
+                *(self._async_fetch_limited(stop_id) for stop_id in stale),
+                return_exceptions=True,
+            )
+            for stop_id, result in zip(stale, results):
+                if isinstance(result, BaseException):
+                    _LOGGER.warning(f"Unable to fetch departures for {stop_id}: {result!r}")
+        return {
+            stop_id: self.predictions[stop_id]
+            for stop_id in stop_ids
+            if stop_id in self.predictions
+        }
+
+    async def async_force_refresh(self, stop_ids: Optional[Iterable[str]] = None):
+        """Refresh stops now, whether due or not, by default all sensors."""
+        now = dt_util.as_local(dt_util.utcnow())
+        sensors = [
+            s for s in self.sensors if stop_ids is None or s.stop_id in stop_ids
+        ]
+        for sensor in sensors:
+            sensor.update_time = now
+        await self.async_refresh(sensors)
+        # Stops without sensors of their own are only in the cache.
+        others = set(stop_ids or []) - {s.stop_id for s in sensors}
+        if others:
+            await self.async_get_departures(others, max_age=timedelta(0))
+
+    async def _async_fetch_limited(self, stop_id: str) -> StopPredictions:
+        async with self._semaphore:
+            return await self._async_fetch(stop_id, self.deadline)
+
+    async def _async_fetch(self, stop_id: str, deadline: float) -> StopPredictions:
+        """Fetch a stop's predictions, sharing a fetch already in flight."""
+        return await self._fetches.fetch(
+            stop_id, lambda: self._async_fetch_stop(stop_id, deadline)
+        )
+
+    async def _async_fetch_stop(self, stop_id: str, deadline: float) -> StopPredictions:
+        """Fetch a stop's predictions and update the cache with them."""
+        data = await self.metlink.get_predictions(stop_id, deadline=deadline)
+        now = dt_util.as_local(dt_util.utcnow())
+        large = len(data.get(ATTR_DEPARTURES, [])) > LARGE_DEPARTURES
+        observers = [self.volatility.observe, self.accuracy.observe]
+        if self.statistics is not None:
+            observers.append(self.statistics.async_observe)
+        if self.timetable is not None:
+            observers.append(self.timetable.async_observe)
+        if self.service_hours is not None:
+            self.service_hours.async_observe(stop_id, departure_times(data))
+        for observe in observers:
+            if large:
+                await asyncio.sleep(0)
+            observe(stop_id, data, now)
+        cached = StopPredictions(data, now)
+        self.predictions[stop_id] = cached
+        self.trips.index(stop_id, data)
+        self._async_notify(stop_id)
+        self._async_derive(stop_id, data, now)
+        return cached
+
+    async def _async_refresh_stop(self, stop_id: str, sensors: List, end: float):
+        """Fetch one stop and apply the predictions to its sensors."""
+        loop = asyncio.get_running_loop()
+        async with self._semaphore:
+            remaining = end - loop.time()
+            if remaining <= 0:
+                return
+            try:
+                cached = await self._async_fetch(stop_id, remaining)
+            except asyncio.TimeoutError:
+                # Leave the sensors as they are, they are still due.
+                _LOGGER.debug(f"Refresh of {stop_id} missed the deadline")
+                return
+            except Exception:
+                for sensor in sensors:
+                    sensor.update_failed()
+                    self._async_write(sensor)
+                _LOGGER.exception(f"Error retrieving data for {stop_id}")
+                return
+
+        now = cached.fetched
+        data = cached.data
+        large = len(data.get(ATTR_DEPARTURES, [])) > LARGE_DEPARTURES
+        for sensor in sensors:
+            if large:
+                await asyncio.sleep(0)
+            self._async_update_sensor(sensor, self._alerts, data, now)
+            self._async_write(sensor)
+        self._intervals[stop_id] = max(
+            min((s.update_time - now).total_seconds() for s in sensors),
+            REFRESH_INTERVAL.total_seconds(),
+        )
+
+    def _derive_sources(
+        self, stop_id: str, due: Dict[str, List], skipped: Set[str], now
+    ) -> Set[str]:
+        """Return the stops being fetched that keep a due stop up to date.
+
+        A stop can skip fetching this cycle when every departure its due
+        sensors show is on a trip that departs earlier from a stop being
+        fetched, so is updated from there.  Otherwise, no stops are
+        returned.
+        """
+        cached = self.predictions.get(stop_id)
+        if cached is None or now - cached.fetched >= MAX_DERIVED_AGE:
+            return set()
+        departures = cached.data.get(ATTR_DEPARTURES, [])
+        sources: Set[str] = set()
+        for sensor in due[stop_id]:
+            selected = sensor.filter.select(departures, now)
+            for departure in islice(selected, sensor.num_departures):
+                trip_id = departure.get(ATTR_TRIP_ID)
+                fetched = [
+                    other
+                    for other in self.trips.upstream(stop_id, trip_id)
+                    if other in due and other not in skipped
+                ]
+                if trip_id is None or not fetched:
+                    return set()
+                sources.update(fetched)
+        return sources
+
+    @core.callback
+    def _async_update_sensor(self, sensor, alerts, data, now) -> bool:
+        """Update a sensor from its stop's predictions and plan its next poll.
+
+        Returns False if the predictions could not be processed.
+        """
+        try:
+            sensor.update_from_response(alerts, data, now, self._alert_index)
+            if sensor.state is None or data.get(ATTR_CLOSED):
+                self._async_suspend(sensor, now)
+            else:
+                self._async_adapt(sensor, now)
+            if sensor.commute is not None:
+                self._async_commute(sensor, sensor.commute, now)
+        except Exception:
+            sensor.update_failed()
+            _LOGGER.exception(f"Error processing data for {sensor.name}")
+            return False
+        return True
+
+    @core.callback
+    def _async_derive(self, stop_id: str, data: Dict[str, Any], now) -> None:
+        """Update the stops later on this stop's trips from its predictions."""
+        targets: Dict[str, List[str]] = {}
+        for departure in data.get(ATTR_DEPARTURES, []):
+            trip_id = departure.get(ATTR_TRIP_ID)
+            if trip_id is None:
+                continue
+            for other in self.trips.downstream(stop_id, trip_id):
+                targets.setdefault(other, []).append(trip_id)
+
+        for other, trips in targets.items():
+            cached = self.predictions.get(other)
+            if cached is None:
+                continue
+            derived = derive_predictions(data, cached, trips, stop_id, now)
+            if derived is None:
+                continue
+            self.predictions[other] = derived
+            if derived.data is cached.data:
+                continue
+            _LOGGER.debug(f"Updated {len(trips)} trips at {other} from {stop_id}")
+            self._async_notify(other)
+            for sensor in self.sensors:
+                if sensor.stop_id != other:
+                    continue
+                # Scheduled as if fetched, but never left later than the
+                # predictions being derived from can be trusted.
+                if self._async_update_sensor(sensor, self._alerts, derived.data, now):
+                    sensor.update_time = min(
+                        sensor.update_time, derived.fetched + MAX_DERIVED_AGE
+                    )
+                self._async_write(sensor)
+
+    @core.callback
+    def _async_adapt(self, sensor, now) -> None:
+        """Adjust a sensor's next poll to the volatility of its route.
+
+        Within the request budget, sensors whose next departure is on a
+        route with volatile predictions are polled more often than the
+        default schedule, and those with stable predictions less often.
+        """
+        interval = sensor.update_time - now
+        if interval > ADAPTIVE_MAX_INTERVAL:
+            return
+        factor = self.volatility.factor(sensor.stop_id, sensor.attrs.get(ATTR_SERVICE))
+        factor *= self._budget_factor()
+        if factor == 1:
+            return
+        # An interval of zero polls every cycle, so is stretched from there.
+        seconds = interval.total_seconds()
+        if factor > 1:
+            seconds = max(seconds, REFRESH_INTERVAL.total_seconds())
+        sensor.update_time = now + timedelta(seconds=seconds * factor)
+
+    def _budget_factor(self) -> float:
+        """Return how much polling must be stretched to keep to the budget.
+
+        Only the budget left after the commute reservations is shared by
+        the other stops.
+        """
+        rate = sum(
+            3600 / interval
+            for stop_id, interval in self._intervals.items()
+            if stop_id not in self.reserved
+        )
+        available = max(
+            self.request_budget - sum(self.reserved.values()),
+            self.request_budget * MIN_UNRESERVED_SHARE,
+        )
+        return max(1.0, rate / available)
+
+    def _commute_reservations(self, now) -> Dict[str, float]:
+        """Return the requests per hour needed by stops in commute windows."""
+        reserved: Dict[str, float] = {}
+        for sensor in self.sensors:
+            schedule: Optional[CommuteSchedule] = sensor.commute
+            if schedule is None:
+                continue
+            window = schedule.next_window(now)
+            if window is None or now < window[0] - RESERVE_LEAD:
+                continue
+            rate = 3600 / self._commute_interval(schedule).total_seconds()
+            reserved[sensor.stop_id] = max(reserved.get(sensor.stop_id, 0), rate)
+        return reserved
+
+    @staticmethod
+    def _commute_interval(schedule: CommuteSchedule) -> timedelta:
+        """Return the polling interval that keeps data within the max age.
+
+        Sensors are only refreshed when the engine ticks, so are made due a
+        tick early.
+        """
+        return max(
+            timedelta(seconds=schedule.max_age) - REFRESH_INTERVAL, REFRESH_INTERVAL
+        )
+
+    @core.callback
+    def _async_commute(self, sensor, schedule: CommuteSchedule, now) -> None:
+        """Keep a sensor fresh in its commute windows, and relax it outside.
+
+        Whatever the sensor's schedule, it is fetched just before its next
+        window opens, to warm the cache.
+        """
+        window = schedule.next_window(now)
+        if window is None:
+            return
+        warm_up = window[0] - PREWARM_LEAD
+        if now >= warm_up:
+            sensor.update_time = min(
+                sensor.update_time, now + self._commute_interval(schedule)
+            )
+            return
+        interval = sensor.update_time - now
+        if interval <= ADAPTIVE_MAX_INTERVAL:
+            interval = max(interval, REFRESH_INTERVAL) * RELAXED_FACTOR
+        sensor.update_time = min(now + interval, warm_up)
+
+    @core.callback
+    def _async_suspend(self, sensor, now) -> None:
+        """Stop polling a sensor with no departures until service resumes."""
+        if self.service_hours is None:
+            return
+        resume = self.service_hours.resume_time(sensor.stop_id, now)
+        if resume is not None and resume > sensor.update_time:
+            _LOGGER.debug(
+                f"{sensor.name}: outside service hours, suspending until {resume}"
+            )
+            sensor.update_time = resume
+
+    @core.callback
+    def _async_refresh_alerts(self, max_age: timedelta) -> None:
+        """Fetch the alerts feed in the background, if older than max_age.
+
+        Only one fetch runs at a time, and after a failure the feed is left
+        alone until it is due to be retried.
+        """
+        now = dt_util.utcnow()
+        if self._alerts_task is not None and not self._alerts_task.done():
+            return
+        if self._alerts_time is not None and now - self._alerts_time <= max_age:
+            return
+        if not self._alerts_backoff.ready(now):
+            return
+        self._alerts_task = self.hass.async_create_background_task(
+            self._async_fetch_alerts(self.deadline), "metlink alerts"
+        )
+
+    async def _async_fetch_alerts(self, deadline: float) -> Dict[str, Any]:
+        try:
+            alerts = await self.metlink.get_service_alerts(deadline=deadline)
+            if len(alerts.get(ATTR_ENTITY, [])) > LARGE_ALERTS:
+                index = await self.hass.async_add_executor_job(
+                    trip_alerts_index, alerts
+                )
+            else:
+                index = trip_alerts_index(alerts)
+        except Exception:
+            # Departures are still worth showing with out of date alerts.
+            backoff = self._alerts_backoff.failed(dt_util.utcnow())
+            _LOGGER.warning(
+                f"Unable to update service alerts, retrying in {backoff}",
+                exc_info=True,
+            )
+            return self._alerts
+        self._alerts_backoff.succeeded()
+        changed = index != self._alert_index
+        self._alerts, self._alert_index = alerts, index
+        self._alerts_time = dt_util.utcnow()
+        if changed:
+            self._async_apply_alerts()
+        route_names = await self._async_get_route_names(deadline)
+        self.alert_events.async_update(alerts, *self._watched(), route_names)
+        return self._alerts
+
+    @core.callback
+    def _async_apply_alerts(self) -> None:
+        """Show new alerts on the sensors, leaving their polling as it was."""
+        for sensor in self.sensors:
+            cached = self.predictions.get(sensor.stop_id)
+            if cached is None or not sensor.available:
+                continue
+            update_time = sensor.update_time
+            try:
+                sensor.update_from_response(
+                    self._alerts, cached.data, cached.fetched, self._alert_index
+                )
+            except Exception:
+                sensor.update_failed()
+                _LOGGER.exception(f"Error processing alerts for {sensor.name}")
+            sensor.update_time = update_time
+            self._async_write(sensor)
+
+    async def _async_get_route_names(self, deadline: float) -> Dict[str, str]:
+        """Return the routes' short names by route id, fetched once a day.
+
+        If the routes catalogue cannot be fetched, the last names are used.
+        """
+        now = dt_util.utcnow()
+        if self._routes_time is None or now - self._routes_time > ROUTES_MAX_AGE:
+            try:
+                routes = await self.metlink.get_routes(deadline=deadline)
+            except Exception:
+                _LOGGER.debug("Unable to update the route names", exc_info=True)
+            else:
+                self._route_names = {
+                    route[ATTR_ROUTE_ID]: route[ATTR_ROUTE_SHORT_NAME]
+                    for route in routes
+                    if ATTR_ROUTE_ID in route and ATTR_ROUTE_SHORT_NAME in route
+                }
+                self._routes_time = now
+        return self._route_names
+
+    def _watched(self) -> Tuple[Set[str], Set[str]]:
+        """Return the stops and routes that alerts are of interest for.
+
+        The routes are those the sensors filter on, and those departing
+        from the sensors' stops.
+        """
+        stops = {sensor.stop_id for sensor in self.sensors}
+        routes: Set[str] = set()
+        for sensor in self.sensors:
+            routes.update(sensor.filter.routes)
+        for stop_id in stops:
+            cached = self.predictions.get(stop_id)
+            if cached is not None:
+                routes.update(
+                    d[ATTR_SERVICE] for d in cached.data.get(ATTR_DEPARTURES, [])
+                )
+        return stops, routes
+
+    @core.callback
+    def _async_write(self, sensor) -> None:
+        if sensor.hass is not None and sensor.entity_id is not None:
+            sensor.async_write_ha_state()
+
+
+async def async_get_shared_engine(
+    hass: core.HomeAssistant, api_key: str
+) -> MetlinkEngine:
+    """Return the engine for the API keys, creating it if there is none.
+
+    Config entries and YAML platforms with the same API keys share the
+    engine, so stops they have in common are fetched once, and the alerts
+    feed is downloaded once for all of them.  The engine closes its client
+    once the last of them unsubscribes.
+    """
+    service_hours = await async_get_service_hours(hass)
+    timetable = await async_get_timetable(hass)
+    engines = async_get_engines(hass)
+    api_keys = parse_api_keys(api_key)
+    key = engine_key(api_keys)
+    engine = engines.get(key)
+    if engine is not None:
+        return engine
+    # The engine limits the fetches in flight, however many stops share it,
+    # so the connection pool follows that limit rather than the stop count.
+    metlink = async_create_client(hass, api_keys, MAX_CONCURRENT_FETCHES)
+    engine = MetlinkEngine(
+        hass,
+        metlink,
+        service_hours,
+        # Each key brings its own rate limit.
+        request_budget=round(DEFAULT_REQUEST_BUDGET * metlink.total_weight),
+        statistics=async_get_delay_statistics(hass),
+        api_key=key,
+        timetable=timetable,
+    )
+    engines[key] = engine
+    return engine
+
+
+@core.callback
+def async_create_client(
+    hass: core.HomeAssistant, api_keys: Dict[str, float], pool_size: int
+) -> KeyPool:
+    """Create Metlink clients for the API keys, with their own connection pool.
+
+    pool_size is the most requests the caller makes at once, which for the
+    engine is its concurrency cap, MAX_CONCURRENT_FETCHES.  Falls back to
+    Home Assistant's shared session if a dedicated one cannot be created.
+    """
+    try:
+        session = create_session(pool_size, ssl=get_default_context())
+        owns_session = True
+    except Exception:
+        _LOGGER.warning(
+            "Unable to create a dedicated session, using the shared session",
+            exc_info=True,
+        )
+        session = async_get_clientsession(hass)
+        owns_session = False
+    return KeyPool(
+        [
+            (mask_key(key), Metlink(session, key, owns_session, hedge=True), weight)
+            for key, weight in api_keys.items()
+        ]
+    )
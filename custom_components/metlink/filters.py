@@ -0,0 +1,162 @@
+"""Filters selecting which departures from a stop a sensor shows."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timedelta, timezone
+import heapq
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from .const import (
+    ATTR_ACCESSIBLE,
+    ATTR_AIMED,
+    ATTR_DEPARTURE,
+    ATTR_DESTINATION,
+    ATTR_DIRECTION,
+    ATTR_EXPECTED,
+    ATTR_NAME,
+    ATTR_OPERATOR,
+    ATTR_SERVICE,
+    ATTR_STOP,
+    ATTR_TRIP_ID,
+    CONF_ACCESSIBLE,
+    CONF_DEST,
+    CONF_DIRECTION,
+    CONF_MIN_LEAD,
+    CONF_OPERATOR,
+    CONF_ROUTE,
+)
+from .helpers import split_list
+from .polling import parse_time
+
+
+def departure_time(departure: Dict[str, Any]) -> str:
+    """Return the expected departure time, or the timetabled one if unknown."""
+    time = departure[ATTR_DEPARTURE].get(ATTR_EXPECTED)
+    if time is None:
+        time = departure[ATTR_DEPARTURE].get(ATTR_AIMED)
+    return time
+
+
+def departure_sort_key(departure: Dict[str, Any]) -> datetime:
+    """Return the time a departure is ordered by, unknown times last."""
+    time: Optional[datetime] = parse_time(departure_time(departure))
+    return time or datetime.max.replace(tzinfo=timezone.utc)
+
+
+def merge_departures(
+    departure_lists: Iterable[Iterable[Dict[str, Any]]]
+) -> Iterator[Dict[str, Any]]:
+    """Merge lists of departures, each in time order, into one.
+
+    The lists are merged lazily on a heap, so taking the first few
+    departures only looks at the start of each list.  A trip that calls at
+    more than one of the stops is only kept at its first.
+    """
+    seen = set()
+    for departure in heapq.merge(*departure_lists, key=departure_sort_key):
+        trip_id = departure.get(ATTR_TRIP_ID)
+        if trip_id is not None:
+            if trip_id in seen:
+                continue
+            seen.add(trip_id)
+        yield departure
+
+
+class DepartureFilter:
+    """A compiled set of conditions on departures.
+
+    Only the conditions that are configured are tested, so an empty filter
+    costs nothing, and all of them are checked in the same pass over the
+    departures.
+    """
+
+    def __init__(
+        self,
+        routes: Iterable[str] = (),
+        destinations: Iterable[str] = (),
+        direction: str = "",
+        operators: Iterable[str] = (),
+        accessible: bool = False,
+        min_lead: int = 0,
+    ):
+        self.routes = frozenset(routes)
+        self.destinations = frozenset(destinations)
+        self.direction = direction
+        self.operators = frozenset(operators)
+        self.accessible = accessible
+        self.min_lead = timedelta(minutes=min_lead)
+        self._tests: List[Callable[[Dict[str, Any], datetime], bool]] = []
+        if self.routes:
+            self._tests.append(lambda d, now: d[ATTR_SERVICE] in self.routes)
+        if self.destinations:
+            self._tests.append(self._destination_matches)
+        if self.direction:
+            self._tests.append(lambda d, now: d.get(ATTR_DIRECTION) == self.direction)
+        if self.operators:
+            self._tests.append(lambda d, now: d.get(ATTR_OPERATOR) in self.operators)
+        if self.accessible:
+            self._tests.append(lambda d, now: d.get(ATTR_ACCESSIBLE) is True)
+        if self.min_lead:
+            self._tests.append(self._lead_time_matches)
+
+    @classmethod
+    def from_config(cls, stop: Dict[str, Any]) -> "DepartureFilter":
+        """Compile the filter for a configured stop."""
+        return cls(
+            routes=split_list(stop.get(CONF_ROUTE)),
+            destinations=split_list(stop.get(CONF_DEST)),
+            direction=stop.get(CONF_DIRECTION) or "",
+            operators=split_list(stop.get(CONF_OPERATOR)),
+            accessible=stop.get(CONF_ACCESSIBLE, False),
+            min_lead=stop.get(CONF_MIN_LEAD, 0),
+        )
+
+    def without_lead(self) -> "DepartureFilter":
+        """Return the same filter without its minimum lead time."""
+        if not self.min_lead:
+            return self
+        return DepartureFilter(
+            self.routes,
+            self.destinations,
+            self.direction,
+            self.operators,
+            self.accessible,
+        )
+
+    def _destination_matches(self, departure: Dict[str, Any], now: datetime) -> bool:
+        # The destination can be given as either the stop id or the name
+        destination = departure[ATTR_DESTINATION]
+        return (
+            destination.get(ATTR_STOP) in self.destinations
+            or destination.get(ATTR_NAME) in self.destinations
+        )
+
+    def _lead_time_matches(self, departure: Dict[str, Any], now: datetime) -> bool:
+        time = parse_time(departure_time(departure))
+        return time is not None and time - now >= self.min_lead
+
+    def matches(self, departure: Dict[str, Any], now: datetime) -> bool:
+        """Return whether a departure passes the filter."""
+        return all(test(departure, now) for test in self._tests)
+
+    def select(
+        self, departures: Iterable[Dict[str, Any]], now: datetime
+    ) -> Iterator[Dict[str, Any]]:
+        """Yield the departures that pass the filter, in order."""
+        if not self._tests:
+            yield from departures
+            return
+        for departure in departures:
+            if self.matches(departure, now):
+                yield departure
@@ -0,0 +1,110 @@
+"""Helper functions shared by the Metlink platforms and config flow."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This module is imported by the config flow, so keep its imports light.
+# Anything heavier than the standard library is imported on first use.
+from datetime import timedelta
+import re
+from typing import Any, Dict, List, Optional
+
+from .const import (
+    ATTR_ALERT,
+    ATTR_ENTITY,
+    ATTR_INFORMED_ENTITY,
+    ATTR_LANGUAGE,
+    ATTR_TEXT,
+    ATTR_TRANSLATION,
+    ATTR_TRIP,
+    ATTR_TRIP_ID,
+    CONF_ACCESSIBLE,
+    CONF_DEST,
+    CONF_DIRECTION,
+    CONF_GROUP,
+    CONF_MIN_LEAD,
+    CONF_OPERATOR,
+    CONF_ROUTE,
+    CONF_STOP_ID,
+    LANG,
+)
+
+
+def slug(text: str):
+    return "_".join(re.split(r'["#$%&+,/:;=?@\[\\\]^`{|}~\'\s]+', text))
+
+
+def split_list(text: Optional[str]) -> List[str]:
+    """Split a comma separated list from the config, dropping blanks."""
+    if not text:
+        return []
+    return [item.strip() for item in text.split(",") if item.strip()]
+
+
+def metlink_unique_id(d: Dict):
+    """Return the unique id for the sensor of a configured stop."""
+    uid = "metlink_" + d[CONF_STOP_ID]
+    if d.get(CONF_ROUTE) not in (None, ""):
+        uid = uid + "_r" + slug(d[CONF_ROUTE])
+    if d.get(CONF_DEST) not in (None, ""):
+        uid = uid + "_d" + slug(d[CONF_DEST])
+    # Filters added later only appear when set, so existing ids are unchanged
+    if d.get(CONF_DIRECTION):
+        uid = uid + "_" + d[CONF_DIRECTION]
+    if d.get(CONF_OPERATOR):
+        uid = uid + "_o" + slug(d[CONF_OPERATOR])
+    if d.get(CONF_ACCESSIBLE):
+        uid = uid + "_wa"
+    if d.get(CONF_MIN_LEAD):
+        uid = uid + f"_l{d[CONF_MIN_LEAD]}"
+    if d.get(CONF_GROUP):
+        uid = uid + "_g" + slug(d[CONF_GROUP])
+    return uid
+
+
+def get_translation(translations: Dict) -> str:
+    for translation in translations.get(ATTR_TRANSLATION, {}):
+        if translation.get(ATTR_LANGUAGE) == LANG:
+            return translation.get(ATTR_TEXT, "")
+
+    return ""
+
+
+def trip_alerts_index(alerts: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+    """Return the service alerts affecting each trip, by trip id."""
+    index: Dict[str, List[Dict[str, Any]]] = {}
+    for entity in alerts.get(ATTR_ENTITY, []):
+        alert = entity[ATTR_ALERT]
+        trips = {
+            informed.get(ATTR_TRIP, {}).get(ATTR_TRIP_ID)
+            for informed in alert[ATTR_INFORMED_ENTITY]
+        }
+        trips.discard(None)
+        for trip_id in trips:
+            index.setdefault(trip_id, []).append(alert)
+    return index
+
+
+def delay_minutes(delay: str) -> int:
+    """Convert an ISO 8601 delay from the API to whole minutes."""
+    # isodate is only needed once departures arrive, not to show the UI.
+    from isodate import parse_duration
+
+    return int(parse_duration(delay) / timedelta(minutes=1))
+
+
+def delay_duration(delay: timedelta) -> str:
+    """Format a delay as an ISO 8601 duration, as the API does."""
+    seconds = int(delay.total_seconds())
+    sign = "-" if seconds < 0 else ""
+    return f"{sign}PT{abs(seconds)}S"
@@ -0,0 +1,220 @@
+"""Spreading requests across several Metlink API keys."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import deque
+import logging
+import time
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from aiohttp import ClientResponseError
+
+from .MetlinkAPI import Metlink
+
+_LOGGER = logging.getLogger(__name__)
+
+# Several API keys are configured separated by commas, each optionally
+# followed by a colon and its weight.
+KEY_SEPARATOR = ","
+WEIGHT_SEPARATOR = ":"
+# Responses meaning a key is being throttled, or has been refused.
+THROTTLED = 429
+REJECTED = (401, 403)
+# Seconds a throttled key is rested, doubling while the throttling goes on.
+MIN_COOLDOWN = 30
+MAX_COOLDOWN = 15 * 60
+# Seconds over which each key's requests are counted.
+USAGE_WINDOW = 3600
+
+
+def parse_api_keys(text: str) -> Dict[str, float]:
+    """Parse the configured API keys into a dict of key to weight.
+
+    Raises a ValueError if there are no keys or a weight is not positive.
+    """
+    keys: Dict[str, float] = {}
+    for item in text.split(KEY_SEPARATOR):
+        key, _, weight = item.strip().partition(WEIGHT_SEPARATOR)
+        key = key.strip()
+        if not key:
+            continue
+        keys[key] = float(weight) if weight.strip() else 1.0
+        if keys[key] <= 0:
+            raise ValueError(f"API key weights must be positive: {item}")
+    if not keys:
+        raise ValueError("No API key given")
+    return keys
+
+
+def engine_key(api_keys: Dict[str, float]) -> str:
+    """Return the key of the engine shared by setups with the same API keys.
+
+    The keys are sorted and their weights left out, so setups listing the
+    same keys in a different order share one engine.
+    """
+    return KEY_SEPARATOR.join(sorted(api_keys))
+
+
+def mask_key(key: str) -> str:
+    """Return enough of an API key to tell it from others in reports."""
+    return "..." + key[-4:]
+
+
+class KeyState:
+    """A client for one API key, with its recent usage and errors."""
+
+    def __init__(self, name: str, metlink: Metlink, weight: float):
+        self.name = name
+        self.metlink = metlink
+        self.weight = weight
+        self.errors = 0
+        self.last_error: Optional[int] = None
+        self.rested_until = 0.0
+        self._cooldown = 0.0
+        self._requests: Deque[float] = deque()
+        # Hedged duplicates are requests against the key's limit too.
+        metlink.on_hedge = lambda: self.record_request(time.monotonic())
+
+    def used(self, now: float) -> int:
+        """Return the number of requests made in the last USAGE_WINDOW."""
+        while self._requests and self._requests[0] <= now - USAGE_WINDOW:
+            self._requests.popleft()
+        return len(self._requests)
+
+    def share_used(self, now: float) -> float:
+        return self.used(now) / self.weight
+
+    def record_request(self, now: float) -> None:
+        self._requests.append(now)
+
+    def record_success(self) -> None:
+        self._cooldown = 0.0
+
+    def rest(self, now: float, cooldown: Optional[float] = None) -> None:
+        """Stop using the key for a while."""
+        if cooldown is None:
+            cooldown = min(max(self._cooldown * 2, MIN_COOLDOWN), MAX_COOLDOWN)
+            self._cooldown = cooldown
+        self.rested_until = now + cooldown
+
+
+class KeyPool:
+    """Metlink clients for several API keys, used in proportion to weight.
+
+    Each request goes to the key that has used the least of its share over
+    the last hour, among those not being rested.  A key that is throttled
+    is rested for a cooldown that doubles while the throttling continues,
+    and one that is refused for the longest cooldown, and the request is
+    retried with another key.
+    """
+
+    def __init__(self, clients: List[Tuple[str, Metlink, float]]):
+        self.keys = [KeyState(name, metlink, weight) for name, metlink, weight in clients]
+
+    @property
+    def total_weight(self) -> float:
+        return sum(state.weight for state in self.keys)
+
+    async def close(self) -> None:
+        for state in self.keys:
+            await state.metlink.close()
+
+    def _choose(self, now: float, tried: List[KeyState]) -> Optional[KeyState]:
+        candidates = [state for state in self.keys if state not in tried]
+        if not candidates:
+            return None
+        available = [state for state in candidates if state.rested_until <= now]
+        if not available:
+            # Every key is resting, so use the one that recovers soonest.
+            return min(candidates, key=lambda state: state.rested_until)
+        return min(available, key=lambda state: state.share_used(now))
+
+    async def _request(
+        self,
+        request: Callable[[Metlink, Optional[float]], Awaitable],
+        deadline: Optional[float],
+    ):
+        start = time.monotonic()
+        tried: List[KeyState] = []
+        while True:
+            now = time.monotonic()
+            state = self._choose(now, tried)
+            tried.append(state)
+            remaining = None if deadline is None else deadline - (now - start)
+            state.record_request(now)
+            try:
+                result = await request(state.metlink, remaining)
+            except ClientResponseError as err:
+                state.errors += 1
+                state.last_error = err.status
+                if err.status == THROTTLED:
+                    state.rest(now)
+                elif err.status in REJECTED:
+                    state.rest(now, MAX_COOLDOWN)
+                else:
+                    raise
+                if len(tried) == len(self.keys):
+                    raise
+                _LOGGER.debug(f"API key {state.name} returned {err.status}, retrying")
+                continue
+            except Exception:
+                state.errors += 1
+                raise
+            state.record_success()
+            return result
+
+    async def get_predictions(self, stop_id, deadline: Optional[float] = None):
+        """Get arrival/departure predictions for the specified stop."""
+        return await self._request(
+            lambda metlink, remaining: metlink.get_predictions(
+                stop_id, deadline=remaining
+            ),
+            deadline,
+        )
+
+    async def get_service_alerts(self, deadline: Optional[float] = None):
+        """Information about unforeseen events affecting routes, stops, or the network."""
+        return await self._request(
+            lambda metlink, remaining: metlink.get_service_alerts(deadline=remaining),
+            deadline,
+        )
+
+    async def get_stops(self, deadline: Optional[float] = None):
+        """The catalogue of all stops, with their ids and names."""
+        return await self._request(
+            lambda metlink, remaining: metlink.get_stops(deadline=remaining),
+            deadline,
+        )
+
+    async def get_routes(self, deadline: Optional[float] = None):
+        """The catalogue of all routes, with their ids and short names."""
+        return await self._request(
+            lambda metlink, remaining: metlink.get_routes(deadline=remaining),
+            deadline,
+        )
+
+    def usage(self) -> List[Dict[str, Any]]:
+        """Return each key's recent usage and error state, for diagnostics."""
+        now = time.monotonic()
+        return [
+            {
+                "key": state.name,
+                "weight": state.weight,
+                "requests_last_hour": state.used(now),
+                "errors": state.errors,
+                "last_error": state.last_error,
+                "rested_for": max(0, round(state.rested_until - now)),
+            }
+            for state in self.keys
+        ]
@@ -0,0 +1,82 @@
+"""Measurement of event loop lag while Metlink updates are running."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager, suppress
+import logging
+from typing import Any, AsyncIterator, Deque, Dict
+
+_LOGGER = logging.getLogger(__name__)
+
+# How often the probe checks the loop, in seconds.
+PROBE_INTERVAL = 0.05
+# Number of updates whose worst lag is kept.
+LAG_SAMPLES = 100
+# Lag, in seconds, worth logging.
+LAG_WARNING = 0.1
+
+
+class LoopLagMonitor:
+    """The worst event loop lag seen during each of the recent updates.
+
+    While an update runs, a probe repeatedly sleeps for PROBE_INTERVAL and
+    records how much later than that it was woken, which is how long other
+    callbacks on the loop were being held up.
+    """
+
+    def __init__(self, size: int = LAG_SAMPLES):
+        self._samples: Deque[float] = deque(maxlen=size)
+
+    @asynccontextmanager
+    async def async_measure(self) -> AsyncIterator[None]:
+        """Measure the loop lag while the body runs."""
+        probe = asyncio.ensure_future(self._async_probe())
+        try:
+            yield
+        finally:
+            probe.cancel()
+            with suppress(asyncio.CancelledError):
+                await probe
+
+    async def _async_probe(self) -> None:
+        loop = asyncio.get_running_loop()
+        worst = 0.0
+        try:
+            while True:
+                start = loop.time()
+                await asyncio.sleep(PROBE_INTERVAL)
+                worst = max(worst, loop.time() - start - PROBE_INTERVAL)
+        finally:
+            self._samples.append(worst)
+            if worst > LAG_WARNING:
+                _LOGGER.debug(f"Event loop lagged by {worst * 1000:.0f}ms during update")
+
+    def summary(self) -> Dict[str, Any]:
+        """Return the lag percentiles, in milliseconds."""
+        if not self._samples:
+            return {"samples": 0}
+        ordered = sorted(self._samples)
+
+        def percentile(pct: float) -> float:
+            index = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+            return round(ordered[index] * 1000, 1)
+
+        return {
+            "samples": len(ordered),
+            "p50_ms": percentile(50),
+            "p95_ms": percentile(95),
+            "max_ms": percentile(100),
+        }
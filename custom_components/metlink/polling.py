@@ -0,0 +1,138 @@
+"""Polling core shared by the engine and the standalone client.
+
+Nothing here depends on Home Assistant, so the client can use it outside.
+"""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple, TypeVar
+
+from .const import ATTR_AIMED, ATTR_DEPARTURE, ATTR_SERVICE, ATTR_TRIP_ID
+
+_T = TypeVar("_T")
+
+# How often a stop is polled, by how soon its next departure is, as
+# (departure within, poll interval) pairs.  A departure further away than
+# the last is not polled for until DEPARTURE_LEAD before it leaves.
+POLL_SCHEDULE = (
+    # Within 3 minutes, poll at every chance
+    (timedelta(minutes=3), timedelta(0)),
+    (timedelta(minutes=15), timedelta(minutes=2)),
+    (timedelta(hours=1), timedelta(minutes=10)),
+)
+DEPARTURE_LEAD = timedelta(hours=1)
+# How often to poll a stop with no departures listed, or that is closed.
+QUIET_POLL_INTERVAL = timedelta(minutes=10)
+CLOSED_POLL_INTERVAL = timedelta(hours=1)
+
+
+def parse_time(value: Optional[str]) -> Optional[datetime]:
+    """Parse a time from the API, returning None if it is missing or invalid."""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def trip_key(stop_id: str, departure: Dict[str, Any]) -> Tuple:
+    """Return a key identifying a departure across polls."""
+    trip_id = departure.get(ATTR_TRIP_ID)
+    if trip_id is not None:
+        return (stop_id, trip_id)
+    return (stop_id, departure[ATTR_SERVICE], departure[ATTR_DEPARTURE].get(ATTR_AIMED))
+
+
+def next_poll(
+    next_departure: Optional[datetime], now: datetime, closed: bool = False
+) -> datetime:
+    """Return when a stop is next worth polling, from its next departure.
+
+    Stops are polled more often as their next departure approaches, to get
+    accurate predictions close to the time, and rarely when nothing is due
+    or the stop is closed, so as not to overload the server.
+    """
+    if closed:
+        return now + CLOSED_POLL_INTERVAL
+    if next_departure is None:
+        return now + QUIET_POLL_INTERVAL
+    when = next_departure - now
+    for within, interval in POLL_SCHEDULE:
+        if when < within:
+            return now + interval
+    return next_departure - DEPARTURE_LEAD
+
+
+class SharedFetches:
+    """Fetches in flight, shared by all the callers asking for the same key.
+
+    A caller giving up does not cancel the fetch for the others.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+
+    async def fetch(self, key: Hashable, start: Callable[[], Awaitable[_T]]) -> _T:
+        """Return the result of the fetch for a key, starting it if needed."""
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(start())
+            self._tasks[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        return await asyncio.shield(task)
+
+    def cancel(self, key: Hashable) -> None:
+        """Cancel the fetch for a key, for all its callers."""
+        task = self._tasks.get(key)
+        if task is not None:
+            task.cancel()
+
+    def _done(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        # Retrieve the exception, in case every caller has given up.
+        if not task.cancelled():
+            task.exception()
+
+
+class Backoff:
+    """When to try something again after it has failed.
+
+    The wait starts at initial and doubles with each further failure, up to
+    maximum, until it succeeds again.
+    """
+
+    def __init__(self, initial: timedelta, maximum: timedelta):
+        self.initial = initial
+        self.maximum = maximum
+        self.failures = 0
+        self.retry_at: Optional[datetime] = None
+
+    def failed(self, now: datetime) -> timedelta:
+        """Record a failure, returning how long to wait before trying again."""
+        self.failures += 1
+        wait = min(self.initial * 2 ** (self.failures - 1), self.maximum)
+        self.retry_at = now + wait
+        return wait
+
+    def succeeded(self) -> None:
+        self.failures = 0
+        self.retry_at = None
+
+    def ready(self, now: datetime) -> bool:
+        """Return whether it is time to try again."""
+        return self.retry_at is None or now >= self.retry_at
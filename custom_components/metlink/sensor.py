@@ -13,20 +13,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from datetime import timedelta
+from datetime import datetime
 import logging
-import re
-from typing import Any, Callable, Dict, Optional
+from typing import Any, Callable, Dict, Iterable, List, Optional
 
 from homeassistant import config_entries, core
 from homeassistant.components.sensor import PLATFORM_SCHEMA, SensorDeviceClass
 from homeassistant.const import ATTR_ATTRIBUTION, CONF_API_KEY
-from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers import entity_registry as er
 import homeassistant.helpers.config_validation as cv
-from homeassistant.helpers.entity import Entity
+from homeassistant.helpers.restore_state import RestoreEntity
 from homeassistant.helpers.typing import ConfigType, DiscoveryInfoType
 import homeassistant.util.dt as dt_util
-from isodate import parse_duration
 import voluptuous as vol
 
 from .MetlinkAPI import Metlink
@@ -40,8 +38,8 @@ from .const import (
     ATTR_ALERT_HEADER,
     ATTR_ALERT_SEVERITY_LEVEL,
     ATTR_ALERT_URL,
-    ATTR_ALERT,
     ATTR_CAUSE,
+    ATTR_CLOSED,
     ATTR_DELAY,
     ATTR_DEPARTURE,
     ATTR_DEPARTURES,
@@ -50,11 +48,8 @@ from .const import (
     ATTR_DESTINATION_ID,
     ATTR_DESTINATION,
     ATTR_EFFECT,
-    ATTR_ENTITY,
     ATTR_EXPECTED,
     ATTR_HEADER_TEXT,
-    ATTR_INFORMED_ENTITY,
-    ATTR_LANGUAGE,
     ATTR_MONITORED,
     ATTR_NAME,
     ATTR_OPERATOR,
@@ -63,26 +58,48 @@ from .const import (
     ATTR_STATUS,
     ATTR_STOP_NAME,
     ATTR_STOP,
-    ATTR_TEXT,
-    ATTR_TRANSLATION,
     ATTR_TRIP_ID,
-    ATTR_TRIP,
     ATTR_URL,
     ATTR_VEHICLE,
     ATTRIBUTION,
+    CONF_ACCESSIBLE,
+    CONF_COMMUTE_MAX_AGE,
+    CONF_COMMUTE_WINDOWS,
+    CONF_DEPARTURE_OFFSETS,
     CONF_DEST,
+    CONF_DIRECTION,
+    CONF_GROUP,
+    CONF_MIN_LEAD,
     CONF_NUM_DEPARTURES,
+    CONF_OPERATOR,
     CONF_ROUTE,
+    CONF_STARTUP_WINDOW,
     CONF_STOP_ID,
     CONF_STOPS,
+    DEFAULT_DEPARTURE_OFFSETS,
+    DEFAULT_STARTUP_WINDOW,
+    DEFAULT_STATUS,
+    DIRECTIONS,
     DOMAIN,
-    LANG,
+    MIN_COMMUTE_MAX_AGE,
 )
+from .commute import CommuteSchedule, commute_windows
+from .departure_events import parse_offsets
+from .engine import MetlinkEngine, async_get_shared_engine
+from .filters import DepartureFilter, merge_departures
+from .helpers import (
+    delay_minutes,
+    get_translation,
+    metlink_unique_id,
+    split_list,
+    trip_alerts_index,
+)
+from .polling import next_poll
+from .startup import StaggeredStartup
 
 _LOGGER = logging.getLogger(__name__)
 VERBOSE = 1
-# Set the scan interval to 30 seconds, to get up to date times as the time approaches.  But polls are dynamically limited by update_time below.
-SCAN_INTERVAL = timedelta(seconds=30)
+
 
 STOP_SCHEMA = vol.Schema(
     {
@@ -90,6 +107,15 @@ STOP_SCHEMA = vol.Schema(
         vol.Optional(CONF_ROUTE): cv.string,
         vol.Optional(CONF_DEST): cv.string,
         vol.Optional(CONF_NUM_DEPARTURES): cv.positive_int,
+        vol.Optional(CONF_DIRECTION): vol.In(DIRECTIONS),
+        vol.Optional(CONF_OPERATOR): cv.string,
+        vol.Optional(CONF_ACCESSIBLE): cv.boolean,
+        vol.Optional(CONF_MIN_LEAD): cv.positive_int,
+        vol.Optional(CONF_GROUP): cv.string,
+        vol.Optional(CONF_COMMUTE_WINDOWS): vol.All(cv.string, commute_windows),
+        vol.Optional(CONF_COMMUTE_MAX_AGE): vol.All(
+            vol.Coerce(int), vol.Range(min=MIN_COMMUTE_MAX_AGE)
+        ),
     }
 )
 
@@ -97,14 +123,17 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
     {
         vol.Required(CONF_API_KEY): cv.string,
         vol.Required(CONF_STOPS): vol.All(cv.ensure_list, [STOP_SCHEMA]),
+        vol.Optional(
+            CONF_STARTUP_WINDOW, default=DEFAULT_STARTUP_WINDOW
+        ): cv.positive_int,
+        vol.Optional(
+            CONF_DEPARTURE_OFFSETS, default=DEFAULT_DEPARTURE_OFFSETS
+        ): cv.string,
     }
 )
 
 DEFAULT_ICON = "mdi:bus"
 OPERATOR_ICONS = {"RAIL": "mdi:train", "EBYW": "mdi:ferry", "WCCL": "mdi:gondola"}
-# By default, status is returned as null.  Follow the behaviour of signs and
-# call this "sched", meaning scheduled with no realtime status
-DEFAULT_STATUS = "sched"
 
 
 async def async_setup_entry(
@@ -119,10 +148,125 @@ async def async_setup_entry(
     if config_entry.options:
         _LOGGER.info(f"Updating config from {config_entry.options}")
         config.update(config_entry.options)
-    session = async_get_clientsession(hass)
-    metlink = Metlink(session, config[CONF_API_KEY])
-    sensors = [MetlinkSensor(metlink, stop) for stop in config[CONF_STOPS]]
-    async_add_entities(sensors, update_before_add=True)
+    engine = await async_get_shared_engine(hass, config[CONF_API_KEY])
+    config["engine"] = engine
+    sensors = [create_sensor(engine.metlink, stop) for stop in config[CONF_STOPS]]
+    pollers = sensor_pollers(sensors)
+    # Kept so that options changes can add and remove sensors in place.
+    config["sensors"] = {sensor.uid: sensor for sensor in sensors}
+    config["add_entities"] = async_add_entities
+    unsubscribe = engine.async_subscribe(pollers)
+
+    @core.callback
+    def async_unsubscribe() -> None:
+        # Sensors added by later options changes are refreshed too.
+        pollers = sensor_pollers(config["sensors"].values())
+        engine.async_remove_sensors(pollers)
+        engine.departure_events.async_remove_sensors(config["sensors"].values())
+        unsubscribe()
+
+    config_entry.async_on_unload(async_unsubscribe)
+    # Initial data is fetched in the background so startup does not wait
+    # for the API.
+    StaggeredStartup(
+        hass,
+        engine,
+        pollers,
+        config.get(CONF_STARTUP_WINDOW, DEFAULT_STARTUP_WINDOW),
+        config_entry,
+    )
+    async_add_entities(sensors)
+    engine.departure_events.async_add_sensors(
+        sensors,
+        parse_offsets(config.get(CONF_DEPARTURE_OFFSETS, DEFAULT_DEPARTURE_OFFSETS)),
+    )
+
+
+async def async_update_stops(
+    hass: core.HomeAssistant, config_entry: config_entries.ConfigEntry
+) -> bool:
+    """Apply a change of stops in the options to the running sensors.
+
+    Only the sensors for stops that were added, removed or changed are
+    touched, so the others keep their schedules and the engine its cache,
+    and new stops are fetched over the startup window rather than all at
+    once.  A stop whose config changed keeps its unique id, so its sensor
+    is replaced under the same entity id.  Returns False if the change
+    needs the entry to be reloaded instead.
+    """
+    config = hass.data[DOMAIN].get(config_entry.entry_id, {})
+    if "sensors" not in config:
+        return False
+    new_config = {**config_entry.data, **config_entry.options}
+    # Other settings are rarely changed, so are applied by reloading.
+    offsets_changed = new_config.get(
+        CONF_DEPARTURE_OFFSETS, DEFAULT_DEPARTURE_OFFSETS
+    ) != config.get(CONF_DEPARTURE_OFFSETS, DEFAULT_DEPARTURE_OFFSETS)
+    if offsets_changed or new_config[CONF_API_KEY] != config[CONF_API_KEY]:
+        return False
+
+    engine: MetlinkEngine = config["engine"]
+    current: Dict[str, MetlinkSensor] = config["sensors"]
+    wanted = {metlink_unique_id(stop): stop for stop in new_config[CONF_STOPS]}
+    previous = {metlink_unique_id(stop): stop for stop in config[CONF_STOPS]}
+    changed = {
+        uid
+        for uid, stop in wanted.items()
+        if uid in current and previous.get(uid) != stop
+    }
+    removed = [
+        sensor for uid, sensor in current.items() if uid not in wanted or uid in changed
+    ]
+    added = [
+        create_sensor(engine.metlink, stop)
+        for uid, stop in wanted.items()
+        if uid not in current or uid in changed
+    ]
+    config.update(new_config)
+    _LOGGER.info(
+        f"Adding {len(added)} and removing {len(removed)} stops, "
+        f"{len(changed)} of them changed"
+    )
+
+    if removed:
+        engine.async_remove_sensors(sensor_pollers(removed))
+        engine.departure_events.async_remove_sensors(removed)
+        entity_registry = er.async_get(hass)
+        for sensor in removed:
+            del current[sensor.uid]
+            if sensor.uid in changed:
+                # Replaced below, so is kept in the registry.
+                if sensor.hass is not None:
+                    await sensor.async_remove()
+            elif sensor.entity_id and entity_registry.async_get(sensor.entity_id):
+                entity_registry.async_remove(sensor.entity_id)
+            elif sensor.hass is not None:
+                await sensor.async_remove()
+    if added:
+        for sensor in added:
+            current[sensor.uid] = sensor
+        pollers = sensor_pollers(added)
+        engine.async_add_sensors(pollers)
+        engine.departure_events.async_add_sensors(
+            added,
+            parse_offsets(
+                config.get(CONF_DEPARTURE_OFFSETS, DEFAULT_DEPARTURE_OFFSETS)
+            ),
+        )
+        StaggeredStartup(
+            hass,
+            engine,
+            pollers,
+            config.get(CONF_STARTUP_WINDOW, DEFAULT_STARTUP_WINDOW),
+            config_entry,
+        )
+        config["add_entities"](added)
+    if "calendars" in config:
+        # Only loaded by then if the calendar platform is set up.
+        from .calendar import async_update_calendars
+
+        await async_update_calendars(hass, config, wanted, changed)
+    return True
 
 
 async def async_setup_platform(
@@ -133,40 +277,39 @@ async def async_setup_platform(
 ) -> None:
     """Set up the sensor platform."""
     _LOGGER.info("Setting up Metlink platform.")
-    session = async_get_clientsession(hass)
-    metlink = Metlink(session, config[CONF_API_KEY])
-    sensors = [MetlinkSensor(metlink, stop) for stop in config[CONF_STOPS]]
-    async_add_entities(sensors, update_before_add=True)
+    engine = await async_get_shared_engine(hass, config[CONF_API_KEY])
+    sensors = [create_sensor(engine.metlink, stop) for stop in config[CONF_STOPS]]
+    pollers = sensor_pollers(sensors)
+    # YAML platforms are never unloaded, so the subscription is kept.
+    engine.async_subscribe(pollers)
+    StaggeredStartup(hass, engine, pollers, config[CONF_STARTUP_WINDOW])
+    async_add_entities(sensors)
+    offsets = parse_offsets(config[CONF_DEPARTURE_OFFSETS])
+    engine.departure_events.async_add_sensors(sensors, offsets)
 
 
-def slug(text: str):
-    return "_".join(re.split(r'["#$%&+,/:;=?@\[\\\]^`{|}~\'\s]+', text))
+def create_sensor(metlink: Metlink, stop: Dict[str, Any]) -> "MetlinkSensor":
+    """Create the sensor for a configured stop, or group of stops."""
+    if stop.get(CONF_GROUP):
+        return MetlinkGroupSensor(metlink, stop)
+    return MetlinkSensor(metlink, stop)
 
 
-def metlink_unique_id(d: Dict):
-    uid = "metlink_" + d["stop_id"]
-    if "route_filter" in d and d["route_filter"] not in (None, ""):
-        uid = uid + "_r" + slug(d["route_filter"])
-    if "dest_filter" in d and d["dest_filter"] not in (None, ""):
-        uid = uid + "_d" + slug(d["dest_filter"])
-    return uid
+def sensor_pollers(sensors: Iterable["MetlinkSensor"]) -> List["MetlinkSensor"]:
+    """Return the sensors the engine refreshes, to keep some sensors updated."""
+    return [poller for sensor in sensors for poller in sensor.pollers]
 
-def get_translation(translations: Dict) -> str:
-    for translation in translations.get(ATTR_TRANSLATION, {}):
-        if translation.get(ATTR_LANGUAGE) == LANG:
-            return translation.get(ATTR_TEXT, "")
 
-    return ""
-
-class MetlinkSensor(Entity):
+class MetlinkSensor(RestoreEntity):
     """Representation of a Metlink Stop sensor."""
 
     def __init__(self, metlink: Metlink, stop: Dict[str, str]):
         super().__init__()
         self.metlink = metlink
         self.stop_id = stop[CONF_STOP_ID]
-        self.route_filter = stop.get(CONF_ROUTE, None)
-        self.dest_filter = stop.get(CONF_DEST, None)
+        self.stop_ids = [self.stop_id]
+        self.filter = DepartureFilter.from_config(stop)
+        self.commute = CommuteSchedule.from_config(stop)
         self.num_departures = stop.get(CONF_NUM_DEPARTURES, 1)
         if self.num_departures < 1:
             self.num_departures = 1
@@ -175,13 +318,40 @@ class MetlinkSensor(Entity):
             ATTR_ATTRIBUTION: ATTRIBUTION,
         }
         self._name = "Metlink " + self.stop_id
-        self.uid = metlink_unique_id(self.__dict__)
+        self.uid = metlink_unique_id(stop)
         self._state = None
         self._available = True
         self._icon = DEFAULT_ICON
         self.update_time = dt_util.as_local(dt_util.utcnow())
+        self.warm_up: Optional[StaggeredStartup] = None
+        self.engine: Optional[MetlinkEngine] = None
+        # The alerts shown for each departure, by attribute suffix.
+        self._shown_alerts: Dict[str, List[Dict[str, Any]]] = {}
         _LOGGER.debug(f"Created Metlink sensor {self.uid}.")
 
+    async def async_added_to_hass(self) -> None:
+        """Restore the last departure and queue the initial refresh."""
+        await super().async_added_to_hass()
+        last_state = await self.async_get_last_state()
+        if last_state is not None:
+            departure = dt_util.parse_datetime(last_state.state)
+            # A departure that has already gone is of no use, even as a
+            # placeholder until the first refresh.
+            if departure is not None and departure > dt_util.utcnow():
+                self._state = departure
+        if self.warm_up is not None:
+            self.warm_up.async_queue(self)
+
+    @property
+    def should_poll(self) -> bool:
+        """The engine refreshes the sensor instead."""
+        return False
+
+    @property
+    def pollers(self) -> List["MetlinkSensor"]:
+        """Return the sensors that fetch this sensor's stops."""
+        return [self]
+
     @property
     def name(self) -> str:
         """Return the name of the entity."""
@@ -214,121 +384,132 @@ class MetlinkSensor(Entity):
     def extra_state_attributes(self) -> Dict[str, Any]:
         return self.attrs
 
-    async def async_update(self):
-        # Only poll the API if it is time to do so
-        now = dt_util.as_local(dt_util.utcnow())
-        if self.update_time > now:
-            return
-
+    def update_failed(self) -> None:
+        """Mark the sensor unavailable, keeping its previous data."""
+        self._available = False
+
+    def update_from_response(
+        self,
+        alerts: Dict[str, Any],
+        data: Dict[str, Any],
+        now: datetime,
+        alert_index: Optional[Dict[str, List[Dict[str, Any]]]] = None,
+    ) -> None:
+        """Update the sensor from the API's predictions for its stop.
+
+        alert_index is the alerts indexed by trip_alerts_index, if the
+        caller has already done so.
+        """
+        self.show_departures(
+            alerts,
+            self.filter.select(data[ATTR_DEPARTURES], now),
+            bool(data.get(ATTR_CLOSED)),
+            now,
+            alert_index,
+        )
+
+    def show_departures(
+        self,
+        alerts: Dict[str, Any],
+        departures: Iterable[Dict[str, Any]],
+        closed: bool,
+        now: datetime,
+        alert_index: Optional[Dict[str, List[Dict[str, Any]]]] = None,
+    ) -> None:
+        """Show the first departures, already filtered and in time order."""
+        if alert_index is None:
+            alert_index = trip_alerts_index(alerts)
         num = 0
-        try:
-            alerts = await self.metlink.get_service_alerts()
-            data = await self.metlink.get_predictions(self.stop_id)
-
-            for departure in data[ATTR_DEPARTURES]:
-                dest = departure[ATTR_DESTINATION].get(ATTR_NAME)
-                if self.route_filter not in (None, ""):
-                    if departure[ATTR_SERVICE] != self.route_filter:
-                        continue
-                if self.dest_filter not in (None, ""):
-                    if (
-                        departure[ATTR_DESTINATION][ATTR_STOP] != self.dest_filter
-                        and dest != self.dest_filter
-                    ):
-                        continue
-                num = num + 1
-                if num > self.num_departures:
-                    break
-                time = departure[ATTR_DEPARTURE].get(ATTR_EXPECTED)
-                if time is None:
-                    time = departure[ATTR_DEPARTURE].get(ATTR_AIMED)
-
-                # enumerate the service alerts to find any that are relevant to the trip.
-                trip_alerts = []
-                if ATTR_TRIP_ID in departure:
-                    trip_id = departure[ATTR_TRIP_ID]
-                    for entity in alerts[ATTR_ENTITY]:
-                        alert = entity[ATTR_ALERT]
-                        informed_entities = alert[ATTR_INFORMED_ENTITY]
-                        if any(informed_entity.get(ATTR_TRIP, {}).get(ATTR_TRIP_ID) == trip_id for informed_entity in informed_entities):
-                            trip_alerts.append(alert)
-
-                name = f"{departure[ATTR_SERVICE]} {dest}"
-                if num == 1:
-                    # First record is the next departure, so use that
-                    # to set the state (departure time)
-                    next_departure = dt_util.parse_datetime(time)
-                    self._state = next_departure
-                    self._icon = OPERATOR_ICONS.get(
-                        departure[ATTR_OPERATOR], DEFAULT_ICON
-                    )
-                    self.attrs[ATTR_STOP_NAME] = departure[ATTR_NAME]
-                    _LOGGER.info(f"{self._name}: {name} departs at {time}")
-                    suffix = ""
-                    # Dynamic polling of the API to get accurate predictions
-                    # close to the time, without overloading the server when
-                    # there is nothing pending:
-                    when = (next_departure - now).total_seconds()
-                    # Within 3 minutes, poll next call as well
-                    if when < 180:
-                        self.update_time = now
-                    # Within 15 minutes, poll every two minutes
-                    elif when < 900:
-                        self.update_time = now + timedelta(minutes=2)
-                    # Within an hour, poll every 10 minutes
-                    elif when < 3600:
-                        self.update_time = now + timedelta(minutes=10)
-                    # More than an hour away, don't poll until 1 hour before
-                    else:
-                        self.update_time = next_departure - timedelta(hours=1)
-
-                    _LOGGER.debug(
-                        f"Next departure at {next_departure}, blocking updates until {self.update_time}"
-                    )
-                else:
-                    suffix = f"_{num}"
-                _LOGGER.log(
-                    VERBOSE,
-                    f"{self._name}: Parsing {suffix} attributes from {departure}",
-                )
-                _LOGGER.log(
-                    VERBOSE,
-                    f"Resolved time as {time} from {departure[ATTR_DEPARTURE][ATTR_AIMED]} and {departure[ATTR_DEPARTURE][ATTR_EXPECTED]}",
+        for departure in departures:
+            dest = departure[ATTR_DESTINATION].get(ATTR_NAME)
+            num = num + 1
+            if num > self.num_departures:
+                break
+            time = departure[ATTR_DEPARTURE].get(ATTR_EXPECTED)
+            if time is None:
+                time = departure[ATTR_DEPARTURE].get(ATTR_AIMED)
+
+            # the service alerts that are relevant to the trip.
+            trip_alerts = alert_index.get(departure.get(ATTR_TRIP_ID), [])
+
+            name = f"{departure[ATTR_SERVICE]} {dest}"
+            if num == 1:
+                # First record is the next departure, so use that
+                # to set the state (departure time)
+                next_departure = dt_util.parse_datetime(time)
+                self._state = next_departure
+                self._icon = OPERATOR_ICONS.get(
+                    departure[ATTR_OPERATOR], DEFAULT_ICON
                 )
-                self.attrs[ATTR_DESCRIPTION + suffix] = name
-                self.attrs[ATTR_DEPARTURE + suffix] = time
-                self.attrs[ATTR_SERVICE + suffix] = departure[ATTR_SERVICE]
-                status = departure.get(ATTR_STATUS)
-                if status is None:
-                    status = DEFAULT_STATUS
-                self.attrs[ATTR_STATUS + suffix] = status
-                self.attrs[ATTR_DESTINATION + suffix] = dest
-                self.attrs[ATTR_DESTINATION_ID + suffix] = departure[ATTR_DESTINATION][
-                    ATTR_STOP
-                ]
-                self.attrs[ATTR_ACCESSIBLE + suffix] = departure[ATTR_ACCESSIBLE]
-                self.attrs[ATTR_DELAY + suffix] = int(
-                    parse_duration(departure[ATTR_DELAY]) / timedelta(minutes=1)
-                )
-                self.attrs[ATTR_MONITORED + suffix] = departure[ATTR_MONITORED]
-                self.attrs[ATTR_VEHICLE + suffix] = departure[ATTR_VEHICLE]
-
-                # Trip alerts
-                self.attrs[ATTR_ALERT_COUNT + suffix] = len(trip_alerts)
-                num_alert = 0
-                for alert in trip_alerts:
-                    alert_suffix = f"_{num_alert}"
-
-                    self.attrs[ATTR_ALERT_HEADER + suffix + alert_suffix] = get_translation(alert.get(ATTR_HEADER_TEXT, {}))
-                    self.attrs[ATTR_ALERT_DESCRIPTION + suffix + alert_suffix] = get_translation(alert.get(ATTR_DESCRIPTION_TEXT, {}))
-                    self.attrs[ATTR_ALERT_URL + suffix + alert_suffix] = get_translation(alert.get(ATTR_URL, {}))
-                    self.attrs[ATTR_ALERT_CAUSE + suffix + alert_suffix] = alert.get(ATTR_CAUSE, "")
-                    self.attrs[ATTR_ALERT_EFFECT + suffix + alert_suffix] = alert.get(ATTR_EFFECT, "")
-                    self.attrs[ATTR_ALERT_SEVERITY_LEVEL + suffix + alert_suffix] = alert.get(ATTR_SEVERITY_LEVEL, "")
+                self.attrs[ATTR_STOP_NAME] = departure[ATTR_NAME]
+                _LOGGER.info(f"{self._name}: {name} departs at {time}")
+                suffix = ""
+                self.update_time = next_poll(next_departure, now)
 
-                    num_alert += 1
+                _LOGGER.debug(
+                    f"Next departure at {next_departure}, blocking updates until {self.update_time}"
+                )
+            else:
+                suffix = f"_{num}"
+            _LOGGER.log(
+                VERBOSE,
+                f"{self._name}: Parsing {suffix} attributes from {departure}",
+            )
+            _LOGGER.log(
+                VERBOSE,
+                f"Resolved time as {time} from {departure[ATTR_DEPARTURE][ATTR_AIMED]} and {departure[ATTR_DEPARTURE][ATTR_EXPECTED]}",
+            )
+            self.attrs[ATTR_DESCRIPTION + suffix] = name
+            self.attrs[ATTR_DEPARTURE + suffix] = time
+            self.attrs[ATTR_SERVICE + suffix] = departure[ATTR_SERVICE]
+            status = departure.get(ATTR_STATUS)
+            if status is None:
+                status = DEFAULT_STATUS
+            self.attrs[ATTR_STATUS + suffix] = status
+            self.attrs[ATTR_DESTINATION + suffix] = dest
+            self.attrs[ATTR_DESTINATION_ID + suffix] = departure[ATTR_DESTINATION][
+                ATTR_STOP
+            ]
+            self.attrs[ATTR_ACCESSIBLE + suffix] = departure[ATTR_ACCESSIBLE]
+            self.attrs[ATTR_DELAY + suffix] = delay_minutes(departure[ATTR_DELAY])
+            self.attrs[ATTR_MONITORED + suffix] = departure[ATTR_MONITORED]
+            self.attrs[ATTR_VEHICLE + suffix] = departure[ATTR_VEHICLE]
+
+            # Trip alerts. Their text is only rewritten when they change,
+            # as the same alerts usually apply to a trip poll after poll.
+            self.attrs[ATTR_ALERT_COUNT + suffix] = len(trip_alerts)
+            if trip_alerts != self._shown_alerts.get(suffix):
+                self._shown_alerts[suffix] = trip_alerts
+                self.show_alerts(suffix, trip_alerts)
 
-                # Clear out old alerts
+        self._available = True
+        # With no departure to schedule around, back off rather than poll
+        # every scan interval until one appears.
+        if closed:
+            _LOGGER.info(f"{self._name}: Stop is closed")
+        if closed or num == 0:
+            self.update_time = next_poll(None, now, closed)
+        # Clear out the unused slots
+        for i in range(num, self.num_departures):
+            if i == 0:
+                _LOGGER.warning(f"{self._name}: Clearing due to no departure info")
+                suffix = ""
+                self._state = None
+            else:
+                _LOGGER.info(
+                    f"{self._name}: Clearing departure info for {i} due to insufficient departure info"
+                )
+                suffix = f"_{i+1}"
+                self.attrs.pop(ATTR_DESCRIPTION + suffix, None)
+                self.attrs.pop(ATTR_DEPARTURE + suffix, None)
+                self.attrs.pop(ATTR_DEPARTURE + suffix, None)
+                self.attrs.pop(ATTR_SERVICE + suffix, None)
+                self.attrs.pop(ATTR_STATUS + suffix, None)
+                self.attrs.pop(ATTR_DESTINATION + suffix, None)
+                self.attrs.pop(ATTR_DESTINATION_ID + suffix, None)
+                self.attrs.pop(ATTR_ACCESSIBLE + suffix, None)
+                self.attrs.pop(ATTR_DELAY + suffix, None)
+                self.attrs.pop(ATTR_ALERT_COUNT + suffix, None)
                 to_remove = []
                 for alert_prefix in [
                     ATTR_ALERT_HEADER,
@@ -338,62 +519,150 @@ class MetlinkSensor(Entity):
                     ATTR_ALERT_EFFECT,
                     ATTR_ALERT_SEVERITY_LEVEL,
                 ]:
-                    prefix = f"{alert_prefix}{suffix}_"
+                    prefix = f"{alert_prefix}{suffix}"
                     for attr in self.attrs:
                         if attr.startswith(prefix):
-                            try:
-                                if int(attr.removeprefix(prefix)) >= len(trip_alerts):
-                                    # we have an attribute outside of the range of the current alerts
-                                    to_remove.append(attr)
-                            except ValueError as ex:
-                                pass
+                            to_remove.append(attr)
 
                 for attr in to_remove:
                     self.attrs.pop(attr)
+                self._shown_alerts.pop(suffix, None)
+
+    def show_alerts(self, suffix: str, trip_alerts: List[Dict[str, Any]]) -> None:
+        """Show the alerts for the departure with an attribute suffix."""
+        for num_alert, alert in enumerate(trip_alerts):
+            alert_suffix = f"_{num_alert}"
+
+            self.attrs[ATTR_ALERT_HEADER + suffix + alert_suffix] = get_translation(alert.get(ATTR_HEADER_TEXT, {}))
+            self.attrs[ATTR_ALERT_DESCRIPTION + suffix + alert_suffix] = get_translation(alert.get(ATTR_DESCRIPTION_TEXT, {}))
+            self.attrs[ATTR_ALERT_URL + suffix + alert_suffix] = get_translation(alert.get(ATTR_URL, {}))
+            self.attrs[ATTR_ALERT_CAUSE + suffix + alert_suffix] = alert.get(ATTR_CAUSE, "")
+            self.attrs[ATTR_ALERT_EFFECT + suffix + alert_suffix] = alert.get(ATTR_EFFECT, "")
+            self.attrs[ATTR_ALERT_SEVERITY_LEVEL + suffix + alert_suffix] = alert.get(ATTR_SEVERITY_LEVEL, "")
+
+        # Clear out old alerts
+        to_remove = []
+        for alert_prefix in [
+            ATTR_ALERT_HEADER,
+            ATTR_ALERT_DESCRIPTION,
+            ATTR_ALERT_URL,
+            ATTR_ALERT_CAUSE,
+            ATTR_ALERT_EFFECT,
+            ATTR_ALERT_SEVERITY_LEVEL,
+        ]:
+            prefix = f"{alert_prefix}{suffix}_"
+            for attr in self.attrs:
+                if attr.startswith(prefix):
+                    try:
+                        if int(attr.removeprefix(prefix)) >= len(trip_alerts):
+                            # we have an attribute outside of the range of the current alerts
+                            to_remove.append(attr)
+                    except ValueError:
+                        pass
+
+        for attr in to_remove:
+            self.attrs.pop(attr)
+
+
+class GroupMember(MetlinkSensor):
+    """One stop of a group sensor, refreshed like a sensor of its own.
+
+    Members are never added to Home Assistant, they only keep their stop's
+    polling schedule and pass each update on to their group.
+    """
+
+    def __init__(self, metlink: Metlink, stop: Dict[str, Any], group):
+        super().__init__(metlink, stop)
+        self.group = group
+
+    def update_from_response(
+        self,
+        alerts: Dict[str, Any],
+        data: Dict[str, Any],
+        now: datetime,
+        alert_index: Optional[Dict[str, List[Dict[str, Any]]]] = None,
+    ) -> None:
+        super().update_from_response(alerts, data, now, alert_index)
+        self.group.async_member_updated(alerts, now, alert_index)
+
+    def update_failed(self) -> None:
+        super().update_failed()
+        self.group.async_member_failed()
+
+
+class MetlinkGroupSensor(MetlinkSensor):
+    """The next departures from several nearby stops, as one sensor.
+
+    Each stop is refreshed by a member, sharing the engine's fetch with any
+    other sensors on the stop, so the group costs no extra requests.  When
+    a member is updated, the filtered departures from each stop's cached
+    predictions are merged in time order, keeping only the first stop of a
+    trip that calls at more than one.
+    """
+
+    def __init__(self, metlink: Metlink, stop: Dict[str, Any]):
+        super().__init__(metlink, stop)
+        self.stop_ids = list(
+            dict.fromkeys([self.stop_id] + split_list(stop[CONF_GROUP]))
+        )
+        self.members = [
+            GroupMember(metlink, {**stop, CONF_STOP_ID: stop_id}, self)
+            for stop_id in self.stop_ids
+        ]
+        self.attrs[CONF_STOPS] = self.stop_ids
+        self._name = "Metlink " + ", ".join(self.stop_ids)
+
+    async def async_added_to_hass(self) -> None:
+        """Queue the members' initial refresh, soonest groups first."""
+        await super().async_added_to_hass()
+        for member in self.members:
+            member._state = self._state
+            if member.warm_up is not None:
+                member.warm_up.async_queue(member)
 
-            self._available = True
-            # Clear out the unused slots
-            for i in range(num, self.num_departures):
-                if i == 0:
-                    _LOGGER.warning(f"{self._name}: Clearing due to no departure info")
-                    suffix = ""
-                    self._state = None
-                else:
-                    _LOGGER.info(
-                        f"{self._name}: Clearing departure info for {i} due to insufficient departure info"
-                    )
-                    suffix = f"_{i+1}"
-                    self.attrs.pop(ATTR_DESCRIPTION + suffix, None)
-                    self.attrs.pop(ATTR_DEPARTURE + suffix, None)
-                    self.attrs.pop(ATTR_DEPARTURE + suffix, None)
-                    self.attrs.pop(ATTR_SERVICE + suffix, None)
-                    self.attrs.pop(ATTR_STATUS + suffix, None)
-                    self.attrs.pop(ATTR_DESTINATION + suffix, None)
-                    self.attrs.pop(ATTR_DESTINATION_ID + suffix, None)
-                    self.attrs.pop(ATTR_ACCESSIBLE + suffix, None)
-                    self.attrs.pop(ATTR_DELAY + suffix, None)
-                    self.attrs.pop(ATTR_ALERT_COUNT + suffix, None)
-                    to_remove = []
-                    for alert_prefix in [
-                        ATTR_ALERT_HEADER,
-                        ATTR_ALERT_DESCRIPTION,
-                        ATTR_ALERT_URL,
-                        ATTR_ALERT_CAUSE,
-                        ATTR_ALERT_EFFECT,
-                        ATTR_ALERT_SEVERITY_LEVEL,
-                    ]:
-                        prefix = f"{alert_prefix}{suffix}"
-                        for attr in self.attrs:
-                            if attr.startswith(prefix):
-                                to_remove.append(attr)
-
-                    for attr in to_remove:
-                        self.attrs.pop(attr)
-
-        # set the sensor to unavailable on errors, but leave previous data in
-        # attributes, so temporary network issues do not cause glitches.
-        except BaseException:
-            self._available = False
-            _LOGGER.exception(
-                "Error retrieving data from Metlink API for sensor %s.", self.name
-            )
+    @property
+    def pollers(self) -> List[MetlinkSensor]:
+        return self.members
+
+    @core.callback
+    def async_member_updated(
+        self,
+        alerts: Dict[str, Any],
+        now: datetime,
+        alert_index: Optional[Dict[str, List[Dict[str, Any]]]] = None,
+    ) -> None:
+        """Merge the departures from the members' stops."""
+        departure_lists = []
+        closed = True
+        for member in self.members:
+            if member.engine is None:
+                continue
+            cached = member.engine.predictions.get(member.stop_id)
+            if cached is None:
+                continue
+            departures = cached.data.get(ATTR_DEPARTURES, [])
+            departure_lists.append(member.filter.select(departures, now))
+            closed = closed and bool(cached.data.get(ATTR_CLOSED))
+        # Already filtered, so shown as they are.
+        self.show_departures(
+            alerts,
+            merge_departures(departure_lists),
+            closed and bool(departure_lists),
+            now,
+            alert_index,
+        )
+        self._available = any(member.available for member in self.members)
+        self._async_write()
+
+    @core.callback
+    def async_member_failed(self) -> None:
+        """Only show the group as unavailable when all its stops are."""
+        available = any(member.available for member in self.members)
+        if available != self._available:
+            self._available = available
+            self._async_write()
+
+    @core.callback
+    def _async_write(self) -> None:
+        if self.hass is not None and self.entity_id is not None:
+            self.async_write_ha_state()
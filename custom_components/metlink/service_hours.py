@@ -0,0 +1,132 @@
+"""Service hours of Metlink stops, learned from observed departures."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timedelta
+import logging
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from homeassistant import core
+from homeassistant.helpers.singleton import singleton
+from homeassistant.helpers.storage import Store
+import homeassistant.util.dt as dt_util
+
+from .const import DOMAIN
+
+_LOGGER = logging.getLogger(__name__)
+
+STORAGE_KEY = f"{DOMAIN}.service_hours"
+STORAGE_VERSION = 1
+SAVE_DELAY = 300
+DATA_SERVICE_HOURS = f"{DOMAIN}_service_hours"
+
+# Departures before this hour belong to the previous day's service, so
+# late night services extend the evening rather than start the morning.
+SERVICE_DAY_START = 3
+# A weekday's hours are only trusted once departures have been seen on
+# this many different dates, as the first polls only see part of the day.
+MIN_OBSERVED_DAYS = 3
+# Resume polling this long before the first expected departure.
+SERVICE_LEAD = timedelta(minutes=30)
+# Never suspend polling for longer than this, in case service has changed.
+MAX_SUSPEND = timedelta(hours=6)
+
+
+def service_day(when: datetime) -> Tuple[datetime, int]:
+    """Return the start of the service day containing a time, and the
+    number of minutes into the service day's calendar date it is."""
+    local = dt_util.as_local(when)
+    day = local.replace(hour=0, minute=0, second=0, microsecond=0)
+    minute = local.hour * 60 + local.minute
+    if local.hour < SERVICE_DAY_START:
+        day = day - timedelta(days=1)
+        minute += 24 * 60
+    return day, minute
+
+
+class ServiceHours:
+    """First and last departures seen at each stop, by weekday."""
+
+    def __init__(self, hass: core.HomeAssistant):
+        self._store = Store(hass, STORAGE_VERSION, STORAGE_KEY)
+        self._data: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+    async def async_load(self) -> None:
+        self._data = await self._store.async_load() or {}
+
+    @core.callback
+    def async_observe(self, stop_id: str, departures: Iterable[datetime]) -> None:
+        """Record departure times seen at a stop."""
+        stop = self._data.setdefault(stop_id, {})
+        changed = False
+        for departure in departures:
+            day, minute = service_day(departure)
+            date = day.date().isoformat()
+            hours = stop.setdefault(
+                str(day.weekday()), {"first": minute, "last": minute, "days": 0}
+            )
+            if hours.get("date") != date:
+                hours["date"] = date
+                hours["days"] += 1
+                changed = True
+            if minute < hours["first"]:
+                hours["first"] = minute
+                changed = True
+            if minute > hours["last"]:
+                hours["last"] = minute
+                changed = True
+        if changed:
+            self._store.async_delay_save(lambda: self._data, SAVE_DELAY)
+
+    def _hours(self, stop_id: str, weekday: int) -> Optional[Dict[str, Any]]:
+        hours = self._data.get(stop_id, {}).get(str(weekday))
+        if hours is None or hours["days"] < MIN_OBSERVED_DAYS:
+            return None
+        return hours
+
+    def resume_time(self, stop_id: str, now: datetime) -> Optional[datetime]:
+        """Return when to resume polling a stop that has no departures.
+
+        Returns None if the stop is expected to be in service now, or its
+        hours are not known well enough to suspend polling.
+        """
+        if stop_id not in self._data:
+            return None
+        day, minute = service_day(now)
+        weekday = day.weekday()
+        for offset in range(8):
+            hours = self._hours(stop_id, (weekday + offset) % 7)
+            if hours is None:
+                if offset == 0 or self._data[stop_id].get(str((weekday + offset) % 7)):
+                    # Not enough known about this day to skip over it.
+                    return None
+                continue
+            if offset == 0:
+                if minute > hours["last"]:
+                    continue
+                if minute >= hours["first"] - SERVICE_LEAD.total_seconds() / 60:
+                    return None
+            resume = (
+                day + timedelta(days=offset, minutes=hours["first"]) - SERVICE_LEAD
+            )
+            return min(resume, now + MAX_SUSPEND)
+        return None
+
+
+@singleton(DATA_SERVICE_HOURS)
+async def async_get_service_hours(hass: core.HomeAssistant) -> ServiceHours:
+    """Return the service hours shared by all Metlink setups."""
+    service_hours = ServiceHours(hass)
+    await service_hours.async_load()
+    return service_hours
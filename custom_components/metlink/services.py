@@ -0,0 +1,173 @@
+"""Services for querying and refreshing Metlink departures."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from itertools import islice
+import logging
+from typing import Any, Dict, Iterable
+
+from homeassistant import core
+from homeassistant.core import ServiceCall, ServiceResponse, SupportsResponse
+from homeassistant.exceptions import HomeAssistantError
+import homeassistant.helpers.config_validation as cv
+import homeassistant.util.dt as dt_util
+import voluptuous as vol
+
+from .const import (
+    ATTR_ACCESSIBLE,
+    ATTR_AIMED,
+    ATTR_DELAY,
+    ATTR_DEPARTURE,
+    ATTR_DEPARTURES,
+    ATTR_DESTINATION,
+    ATTR_DESTINATION_ID,
+    ATTR_DIRECTION,
+    ATTR_EXPECTED,
+    ATTR_MONITORED,
+    ATTR_NAME,
+    ATTR_OPERATOR,
+    ATTR_SERVICE,
+    ATTR_STATUS,
+    ATTR_STOP,
+    ATTR_STOP_NAME,
+    ATTR_TRIP_ID,
+    ATTR_VEHICLE,
+    CONF_ACCESSIBLE,
+    CONF_DEST,
+    CONF_DIRECTION,
+    CONF_MIN_LEAD,
+    CONF_NUM_DEPARTURES,
+    CONF_OPERATOR,
+    CONF_ROUTE,
+    CONF_STOP_ID,
+    DIRECTIONS,
+    DOMAIN,
+)
+from .engine import MetlinkEngine, async_get_engines
+from .filters import DepartureFilter, departure_time
+from .helpers import delay_minutes
+from .trips import StopPredictions
+
+_LOGGER = logging.getLogger(__name__)
+
+SERVICE_GET_DEPARTURES = "get_departures"
+SERVICE_REFRESH = "refresh"
+
+GET_DEPARTURES_SCHEMA = vol.Schema(
+    {
+        vol.Required(CONF_STOP_ID): vol.All(cv.ensure_list, [cv.string]),
+        vol.Optional(CONF_ROUTE, default=[]): vol.All(cv.ensure_list_csv, [cv.string]),
+        vol.Optional(CONF_DEST, default=[]): vol.All(cv.ensure_list_csv, [cv.string]),
+        vol.Optional(CONF_DIRECTION, default=""): vol.In([""] + DIRECTIONS),
+        vol.Optional(CONF_OPERATOR, default=[]): vol.All(
+            cv.ensure_list_csv, [cv.string]
+        ),
+        vol.Optional(CONF_ACCESSIBLE, default=False): cv.boolean,
+        vol.Optional(CONF_MIN_LEAD, default=0): cv.positive_int,
+        vol.Optional(CONF_NUM_DEPARTURES): cv.positive_int,
+    }
+)
+REFRESH_SCHEMA = vol.Schema(
+    {vol.Optional(CONF_STOP_ID): vol.All(cv.ensure_list, [cv.string])}
+)
+
+
+def departure_data(departure: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the useful fields of a departure from the API."""
+    times = departure[ATTR_DEPARTURE]
+    return {
+        ATTR_SERVICE: departure[ATTR_SERVICE],
+        ATTR_DEPARTURE: departure_time(departure),
+        ATTR_AIMED: times.get(ATTR_AIMED),
+        ATTR_EXPECTED: times.get(ATTR_EXPECTED),
+        ATTR_DESTINATION: departure[ATTR_DESTINATION].get(ATTR_NAME),
+        ATTR_DESTINATION_ID: departure[ATTR_DESTINATION].get(ATTR_STOP),
+        ATTR_DIRECTION: departure.get(ATTR_DIRECTION),
+        ATTR_OPERATOR: departure.get(ATTR_OPERATOR),
+        ATTR_STATUS: departure.get(ATTR_STATUS),
+        ATTR_DELAY: delay_minutes(departure.get(ATTR_DELAY) or "PT0S"),
+        ATTR_MONITORED: departure.get(ATTR_MONITORED),
+        ATTR_ACCESSIBLE: departure.get(ATTR_ACCESSIBLE),
+        ATTR_VEHICLE: departure.get(ATTR_VEHICLE),
+        ATTR_TRIP_ID: departure.get(ATTR_TRIP_ID),
+    }
+
+
+def stop_data(
+    cached: StopPredictions, departures: Iterable[Dict[str, Any]]
+) -> Dict[str, Any]:
+    """Return a stop's name, when it was updated and some of its departures."""
+    all_departures = cached.data.get(ATTR_DEPARTURES) or [{}]
+    return {
+        ATTR_STOP_NAME: all_departures[0].get(ATTR_NAME),
+        "updated": cached.updated.isoformat(),
+        ATTR_DEPARTURES: [departure_data(d) for d in departures],
+    }
+
+
+def async_get_engine(hass: core.HomeAssistant) -> MetlinkEngine:
+    """Return an engine to serve requests that are not tied to a sensor."""
+    engines = async_get_engines(hass)
+    if not engines:
+        raise HomeAssistantError("Metlink has not been set up with an API key")
+    return next(iter(engines.values()))
+
+
+@core.callback
+def async_setup_services(hass: core.HomeAssistant) -> None:
+    """Register the Metlink services."""
+
+    async def async_get_departures(call: ServiceCall) -> ServiceResponse:
+        """Return the departures from some stops, as a service response."""
+        engine = async_get_engine(hass)
+        departure_filter = DepartureFilter(
+            routes=call.data[CONF_ROUTE],
+            destinations=call.data[CONF_DEST],
+            direction=call.data[CONF_DIRECTION],
+            operators=call.data[CONF_OPERATOR],
+            accessible=call.data[CONF_ACCESSIBLE],
+            min_lead=call.data[CONF_MIN_LEAD],
+        )
+        limit = call.data.get(CONF_NUM_DEPARTURES)
+        predictions = await engine.async_get_departures(call.data[CONF_STOP_ID])
+        now = dt_util.utcnow()
+        stops = {}
+        for stop_id, cached in predictions.items():
+            departures = departure_filter.select(
+                cached.data.get(ATTR_DEPARTURES, []), now
+            )
+            stops[stop_id] = stop_data(cached, islice(departures, limit))
+        return {"stops": stops}
+
+    async def async_refresh(call: ServiceCall) -> None:
+        """Refresh stops immediately, sharing fetches already in flight."""
+        stop_ids = call.data.get(CONF_STOP_ID)
+        await asyncio.gather(
+            *(
+                engine.async_force_refresh(stop_ids)
+                for engine in async_get_engines(hass).values()
+            )
+        )
+
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_GET_DEPARTURES,
+        async_get_departures,
+        schema=GET_DEPARTURES_SCHEMA,
+        supports_response=SupportsResponse.ONLY,
+    )
+    hass.services.async_register(
+        DOMAIN, SERVICE_REFRESH, async_refresh, schema=REFRESH_SCHEMA
+    )
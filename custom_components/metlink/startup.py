@@ -0,0 +1,120 @@
+"""Staggered initial refresh of Metlink sensors."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from datetime import datetime
+import heapq
+import itertools
+import logging
+from typing import List, Optional
+
+from homeassistant import config_entries, core
+import homeassistant.util.dt as dt_util
+
+_LOGGER = logging.getLogger(__name__)
+
+# Maximum number of sensors fetching their initial data at the same time.
+MAX_CONCURRENT_REFRESH = 4
+# Sensors waiting for their warm-up slot do not poll on their own.
+HOLD = datetime.max.replace(tzinfo=dt_util.UTC)
+
+
+class StaggeredStartup:
+    """Spread the initial refresh of a batch of sensors over a time window.
+
+    Sensors are registered with Home Assistant immediately, without waiting
+    for their first API response, and queue themselves here once added.
+    Queued sensors are refreshed in order of their last known departure, so
+    imminent stops get fresh data first, with at most
+    MAX_CONCURRENT_REFRESH requests in flight.
+    """
+
+    def __init__(
+        self,
+        hass: core.HomeAssistant,
+        engine,
+        sensors: List,
+        window: float,
+        config_entry: Optional[config_entries.ConfigEntry] = None,
+        concurrency: int = MAX_CONCURRENT_REFRESH,
+    ):
+        self.hass = hass
+        self.engine = engine
+        self.config_entry = config_entry
+        self._spacing = window / max(len(sensors), 1)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._queue: List = []
+        self._counter = itertools.count()
+        self._task: Optional[asyncio.Task] = None
+        for sensor in sensors:
+            sensor.warm_up = self
+            sensor.update_time = HOLD
+
+    @core.callback
+    def async_queue(self, sensor) -> None:
+        """Queue a sensor that has been added to Home Assistant."""
+        # Stops without a known departure go last, in configuration order.
+        departure = sensor.state
+        key = (departure is None, departure or HOLD, next(self._counter))
+        heapq.heappush(self._queue, (key, sensor))
+        if self._task is None:
+            name = "metlink staggered startup"
+            if self.config_entry is not None:
+                self._task = self.config_entry.async_create_background_task(
+                    self.hass, self._async_run(), name
+                )
+            else:
+                self._task = self.hass.async_create_background_task(
+                    self._async_run(), name
+                )
+
+    async def _async_run(self) -> None:
+        """Work through the queue, one sensor per time slot.
+
+        Sensors queued while the last refreshes are in flight are picked
+        up before the run ends, as no other run will start for them.
+        """
+        pending = set()
+        while self._queue or pending:
+            if not self._queue:
+                done, _ = await asyncio.wait(pending)
+                pending -= done
+                continue
+            # Sleeping first lets the rest of the batch be queued before the
+            # most imminent stop is picked.
+            await asyncio.sleep(self._spacing)
+            _, sensor = heapq.heappop(self._queue)
+            # Other sensors on the same stop can share its fetch.
+            batch = [sensor] + [s for _, s in self._queue if s.stop_id == sensor.stop_id]
+            self._queue = [e for e in self._queue if e[1] not in batch]
+            heapq.heapify(self._queue)
+            await self._semaphore.acquire()
+            task = self.hass.async_create_task(self._async_refresh(batch))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        self._task = None
+        _LOGGER.debug("Staggered startup complete")
+
+    async def _async_refresh(self, sensors: List) -> None:
+        """Release the hold on sensors and fetch their first data."""
+        try:
+            now = dt_util.as_local(dt_util.utcnow())
+            for sensor in sensors:
+                sensor.update_time = now
+                sensor.warm_up = None
+            _LOGGER.debug(f"Initial refresh of {sensors[0].stop_id}")
+            await self.engine.async_refresh(sensors)
+        finally:
+            self._semaphore.release()
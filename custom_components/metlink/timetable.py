@@ -0,0 +1,138 @@
+"""Timetable of each stop, learnt from the departures seen there."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timedelta
+import logging
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+from homeassistant import core
+from homeassistant.helpers.singleton import singleton
+from homeassistant.helpers.storage import Store
+import homeassistant.util.dt as dt_util
+
+from .const import (
+    ATTR_AIMED,
+    ATTR_DEPARTURE,
+    ATTR_DEPARTURES,
+    ATTR_DESTINATION,
+    ATTR_NAME,
+    ATTR_SERVICE,
+    DOMAIN,
+)
+from .service_hours import service_day
+
+_LOGGER = logging.getLogger(__name__)
+
+STORAGE_KEY = f"{DOMAIN}.timetable"
+STORAGE_VERSION = 1
+SAVE_DELAY = 300
+DATA_TIMETABLE = f"{DOMAIN}_timetable"
+
+# Departures not seen on their weekday for this long are dropped, as the
+# timetable has changed.
+STALE_AFTER = timedelta(weeks=3)
+
+
+class ScheduledDeparture(NamedTuple):
+    """A departure from the timetable, on a particular day."""
+
+    time: datetime
+    service_id: str
+    destination: str
+
+
+class Timetable:
+    """Timetabled departures seen at each stop, by weekday.
+
+    Each departure is recorded under its service day's weekday, by minute
+    and route, with the date it was last seen.  Once a day, the first time
+    a weekday is observed, departures not seen for STALE_AFTER are dropped.
+    """
+
+    def __init__(self, hass: core.HomeAssistant):
+        self._store = Store(hass, STORAGE_VERSION, STORAGE_KEY)
+        # stop_id -> weekday -> "minute route" -> [minute, route, destination, date]
+        self._data: Dict[str, Dict[str, Dict[str, List[Any]]]] = {}
+        # Changes whenever a stop's departures are added or dropped.
+        self._versions: Dict[str, int] = {}
+        # The date each stop's weekday was last pruned.
+        self._pruned: Dict[Tuple[str, str], str] = {}
+
+    async def async_load(self) -> None:
+        self._data = await self._store.async_load() or {}
+
+    def version(self, stop_id: str) -> int:
+        return self._versions.get(stop_id, 0)
+
+    @core.callback
+    def async_observe(self, stop_id: str, data: Dict[str, Any], now: datetime) -> None:
+        """Record the timetabled departures in a predictions response."""
+        stop = self._data.setdefault(stop_id, {})
+        changed = False
+        for departure in data.get(ATTR_DEPARTURES, []):
+            aimed = dt_util.parse_datetime(
+                departure[ATTR_DEPARTURE].get(ATTR_AIMED) or ""
+            )
+            if aimed is None:
+                continue
+            day, minute = service_day(aimed)
+            date = day.date().isoformat()
+            weekday = stop.setdefault(str(day.weekday()), {})
+            if self._pruned.get((stop_id, str(day.weekday()))) != date:
+                self._pruned[stop_id, str(day.weekday())] = date
+                if self._prune(weekday, day):
+                    self._versions[stop_id] = self.version(stop_id) + 1
+                    changed = True
+            service = departure[ATTR_SERVICE]
+            key = f"{minute} {service}"
+            entry = weekday.get(key)
+            if entry is None:
+                destination = departure[ATTR_DESTINATION].get(ATTR_NAME) or ""
+                weekday[key] = [minute, service, destination, date]
+                self._versions[stop_id] = self.version(stop_id) + 1
+                changed = True
+            elif entry[3] < date:
+                entry[3] = date
+                changed = True
+        if changed:
+            self._store.async_delay_save(lambda: self._data, SAVE_DELAY)
+
+    def _prune(self, weekday: Dict[str, List[Any]], day: datetime) -> bool:
+        oldest = (day - STALE_AFTER).date().isoformat()
+        stale = [key for key, entry in weekday.items() if entry[3] < oldest]
+        for key in stale:
+            del weekday[key]
+        return bool(stale)
+
+    def departures(self, stop_id: str, day: datetime) -> List[ScheduledDeparture]:
+        """Return the departures expected on a service day, in time order.
+
+        day is the local midnight starting the service day.
+        """
+        entries = self._data.get(stop_id, {}).get(str(day.weekday()), {})
+        return sorted(
+            ScheduledDeparture(
+                day + timedelta(minutes=minute), service, destination
+            )
+            for minute, service, destination, _ in entries.values()
+        )
+
+
+@singleton(DATA_TIMETABLE)
+async def async_get_timetable(hass: core.HomeAssistant) -> Timetable:
+    """Return the timetable shared by all Metlink setups."""
+    timetable = Timetable(hass)
+    await timetable.async_load()
+    return timetable
@@ -0,0 +1,161 @@
+"""Trips shared between the configured Metlink stops."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime
+import logging
+from typing import Any, Collection, Dict, List, Optional
+
+import homeassistant.util.dt as dt_util
+
+from .const import (
+    ATTR_AIMED,
+    ATTR_DELAY,
+    ATTR_DEPARTURE,
+    ATTR_DEPARTURES,
+    ATTR_EXPECTED,
+    ATTR_TRIP_ID,
+)
+from .filters import departure_sort_key
+from .helpers import delay_duration
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class StopPredictions:
+    """The latest predictions for a stop.
+
+    fetched is when the predictions were last fetched from the API, and
+    updated when they last changed, which may be later if expected times
+    have since been derived from other stops on the same trips.
+    """
+
+    def __init__(self, data: Dict[str, Any], fetched: datetime):
+        self.data = data
+        self.fetched = fetched
+        self.updated = fetched
+        self.derived_from: Optional[str] = None
+
+
+class TripIndex:
+    """Where each trip departs from among the configured stops.
+
+    A trip's timetabled (aimed) departures from the stops give the offsets
+    between them, so a fresh prediction at one stop can be carried forward
+    to the stops later on the trip.
+    """
+
+    def __init__(self):
+        # trip_id -> stop_id -> aimed departure
+        self._trips: Dict[str, Dict[str, datetime]] = {}
+        # stop_id -> trip_ids in its latest predictions
+        self._stops: Dict[str, List[str]] = {}
+
+    def index(self, stop_id: str, data: Dict[str, Any]) -> None:
+        """Replace the trips of a stop with those in its latest predictions."""
+        for trip_id in self._stops.pop(stop_id, []):
+            stops = self._trips.get(trip_id, {})
+            stops.pop(stop_id, None)
+            if not stops:
+                self._trips.pop(trip_id, None)
+        trips = []
+        for departure in data.get(ATTR_DEPARTURES, []):
+            trip_id = departure.get(ATTR_TRIP_ID)
+            aimed = dt_util.parse_datetime(
+                departure[ATTR_DEPARTURE].get(ATTR_AIMED) or ""
+            )
+            if trip_id is None or aimed is None:
+                continue
+            self._trips.setdefault(trip_id, {})[stop_id] = aimed
+            trips.append(trip_id)
+        self._stops[stop_id] = trips
+
+    def upstream(self, stop_id: str, trip_id: str) -> List[str]:
+        """Return the other stops that a trip departs from before this one."""
+        stops = self._trips.get(trip_id, {})
+        aimed = stops.get(stop_id)
+        if aimed is None:
+            return []
+        return [other for other, when in stops.items() if when < aimed]
+
+    def downstream(self, stop_id: str, trip_id: str) -> List[str]:
+        """Return the other stops that a trip departs from after this one."""
+        stops = self._trips.get(trip_id, {})
+        aimed = stops.get(stop_id)
+        if aimed is None:
+            return []
+        return [other for other, when in stops.items() if when > aimed]
+
+
+def derive_predictions(
+    source: Dict[str, Any],
+    target: StopPredictions,
+    trips: Collection[str],
+    source_id: str,
+    now: datetime,
+) -> Optional[StopPredictions]:
+    """Carry expected times from a stop's fresh predictions to a later stop.
+
+    The given trips are given the delay they have at the source stop.
+    Returns the target's new predictions, or None if none of the trips are
+    in them.  The target itself is left as it is, as sensors and views may
+    still be reading it, and if no expected time changed the new
+    predictions share its data.  Otherwise the departures are put back in
+    time order, as the delays can change it.
+    """
+    delays = {}
+    for departure in source.get(ATTR_DEPARTURES, []):
+        trip_id = departure.get(ATTR_TRIP_ID)
+        if trip_id not in trips:
+            continue
+        times = departure[ATTR_DEPARTURE]
+        aimed = dt_util.parse_datetime(times.get(ATTR_AIMED) or "")
+        expected = dt_util.parse_datetime(times.get(ATTR_EXPECTED) or "")
+        if trip_id is not None and aimed is not None and expected is not None:
+            delays[trip_id] = expected - aimed
+
+    matched = changed = False
+    departures = []
+    for departure in target.data.get(ATTR_DEPARTURES, []):
+        departures.append(departure)
+        delay = delays.get(departure.get(ATTR_TRIP_ID))
+        if delay is None:
+            continue
+        times = departure[ATTR_DEPARTURE]
+        aimed = dt_util.parse_datetime(times.get(ATTR_AIMED) or "")
+        if aimed is None:
+            continue
+        matched = True
+        expected = (aimed + delay).isoformat()
+        if times.get(ATTR_EXPECTED) != expected:
+            departures[-1] = {
+                **departure,
+                ATTR_DEPARTURE: {**times, ATTR_EXPECTED: expected},
+                ATTR_DELAY: delay_duration(delay),
+            }
+            changed = True
+    if not matched:
+        return None
+
+    # Even if nothing changed, the target's predictions have been confirmed
+    # by fresher data.
+    if changed:
+        departures.sort(key=departure_sort_key)
+        data = {**target.data, ATTR_DEPARTURES: departures}
+    else:
+        data = target.data
+    derived = StopPredictions(data, target.fetched)
+    derived.updated = now
+    derived.derived_from = source_id
+    return derived
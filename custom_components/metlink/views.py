@@ -0,0 +1,168 @@
+"""HTTP endpoint serving departure boards from the Metlink cache."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from datetime import datetime
+import hashlib
+from http import HTTPStatus
+from typing import Callable, Dict, List, Tuple
+
+from aiohttp import hdrs, web
+from homeassistant import core
+from homeassistant.components.http import KEY_HASS, HomeAssistantView
+from homeassistant.const import CONTENT_TYPE_JSON
+from homeassistant.exceptions import HomeAssistantError
+from homeassistant.helpers.json import json_bytes
+
+from .const import ATTR_DEPARTURES, ATTR_STOP_NAME
+from .engine import MetlinkEngine
+from .helpers import split_list
+from .services import async_get_engine, stop_data
+from .trips import StopPredictions
+
+BOARD_URL = "/api/metlink/board"
+# Longest a request may wait for the departures to change, in seconds.
+MAX_WAIT = 60
+
+
+class MetlinkBoardView(HomeAssistantView):
+    """Departures from a list of stops, as compact JSON for display boards.
+
+    Takes the stops as a comma separated stops= parameter.  Each stop is
+    serialized once per update, and the result shared by every request for
+    it.  The ETag is a digest of the stops' departures, so only changes
+    when they do, not on every fetch, and a request with a matching
+    If-None-Match and a wait= parameter is held for up to that many seconds
+    until they change, rather than the display polling.  It is a weak ETag,
+    as the time each stop was updated is left out of the digest.
+    """
+
+    url = BOARD_URL
+    name = "api:metlink:board"
+
+    def __init__(self):
+        # stop_id -> (when it was updated, digest of its departures,
+        # serialized stop)
+        self._fragments: Dict[str, Tuple[datetime, str, bytes]] = {}
+
+    async def get(self, request: web.Request) -> web.Response:
+        """Return the departures from the requested stops."""
+        hass = request.app[KEY_HASS]
+        stop_ids = split_list(request.query.get("stops"))
+        if not stop_ids:
+            return self.json_message("No stops requested", HTTPStatus.BAD_REQUEST)
+        try:
+            wait = min(float(request.query.get("wait", 0)), MAX_WAIT)
+        except ValueError:
+            return self.json_message("Invalid wait", HTTPStatus.BAD_REQUEST)
+        try:
+            engine = async_get_engine(hass)
+        except HomeAssistantError as err:
+            return self.json_message(str(err), HTTPStatus.SERVICE_UNAVAILABLE)
+
+        fragments = self._stop_fragments(await engine.async_get_departures(stop_ids))
+        etag = board_etag(fragments)
+        if_none_match = request.headers.get(hdrs.IF_NONE_MATCH)
+        if wait > 0 and if_none_match == etag:
+            await async_wait_for_change(
+                engine,
+                stop_ids,
+                wait,
+                lambda: board_etag(self._cached_fragments(engine, stop_ids)) != etag,
+            )
+            fragments = self._cached_fragments(engine, stop_ids)
+            etag = board_etag(fragments)
+
+        headers = {hdrs.ETAG: etag, hdrs.CACHE_CONTROL: "no-cache"}
+        if if_none_match == etag:
+            return web.Response(status=HTTPStatus.NOT_MODIFIED, headers=headers)
+        return web.Response(
+            body=board_body(fragments),
+            content_type=CONTENT_TYPE_JSON,
+            headers=headers,
+        )
+
+    def _cached_fragments(
+        self, engine: MetlinkEngine, stop_ids: List[str]
+    ) -> Dict[str, Tuple[datetime, str, bytes]]:
+        return self._stop_fragments(
+            {
+                stop_id: engine.predictions[stop_id]
+                for stop_id in stop_ids
+                if stop_id in engine.predictions
+            }
+        )
+
+    def _stop_fragments(
+        self, predictions: Dict[str, StopPredictions]
+    ) -> Dict[str, Tuple[datetime, str, bytes]]:
+        """Return each stop serialized, building it again only once updated."""
+        fragments = {}
+        for stop_id, cached in predictions.items():
+            fragment = self._fragments.get(stop_id)
+            if fragment is None or fragment[0] != cached.updated:
+                data = stop_data(cached, cached.data.get(ATTR_DEPARTURES, []))
+                content = json_bytes([data[ATTR_STOP_NAME], data[ATTR_DEPARTURES]])
+                digest = hashlib.blake2b(content, digest_size=8).hexdigest()
+                fragment = (cached.updated, digest, json_bytes(data))
+                self._fragments[stop_id] = fragment
+            fragments[stop_id] = fragment
+        return fragments
+
+
+def board_body(fragments: Dict[str, Tuple[datetime, str, bytes]]) -> bytes:
+    """Return the board for some stops, joining their serialized fragments."""
+    parts = [b'{"stops":{']
+    for num, (stop_id, fragment) in enumerate(fragments.items()):
+        if num:
+            parts.append(b",")
+        parts.extend((json_bytes(stop_id), b":", fragment[2]))
+    parts.append(b"}}")
+    return b"".join(parts)
+
+
+def board_etag(fragments: Dict[str, Tuple[datetime, str, bytes]]) -> str:
+    """Return an ETag that changes whenever any of the stops' departures do."""
+    key = ";".join(
+        f"{stop_id}@{fragment[1]}" for stop_id, fragment in fragments.items()
+    )
+    return 'W/"' + hashlib.blake2b(key.encode(), digest_size=8).hexdigest() + '"'
+
+
+async def async_wait_for_change(
+    engine: MetlinkEngine,
+    stop_ids: List[str],
+    wait: float,
+    is_changed: Callable[[], bool],
+) -> None:
+    """Wait up to wait seconds for any of the stops to change.
+
+    is_changed is asked each time one of the stops is updated, so that
+    fetches returning the same departures do not end the wait.
+    """
+    changed = asyncio.Event()
+
+    @core.callback
+    def async_changed(stop_id: str) -> None:
+        if stop_id in stop_ids and is_changed():
+            changed.set()
+
+    remove = engine.async_listen(async_changed)
+    try:
+        await asyncio.wait_for(changed.wait(), wait)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        remove()
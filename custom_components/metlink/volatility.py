@@ -0,0 +1,99 @@
+"""Volatility of departure predictions, per route and stop."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Any, Deque, Dict, Optional, Tuple
+
+import homeassistant.util.dt as dt_util
+
+from .const import ATTR_DEPARTURE, ATTR_DEPARTURES, ATTR_EXPECTED, ATTR_SERVICE
+from .polling import trip_key
+
+# Bounds on the memory used by the model.
+MAX_TRIPS = 1000
+MAX_ROUTES = 500
+SAMPLES_PER_ROUTE = 20
+# Movement of the expected time, in seconds per minute between polls, at
+# which the normal polling schedule is used unchanged.
+REFERENCE_DRIFT = 10
+# Limits on how far the polling interval is stretched or shrunk.
+MIN_FACTOR = 0.5
+MAX_FACTOR = 2.0
+
+
+class VolatilityModel:
+    """How much expected departure times move between polls.
+
+    The last expected time of recently seen trips is kept, and each change
+    is recorded against the trip's route and stop as a rate, in seconds per
+    minute, so that it does not depend on how often the stop was polled.
+    Both tables are bounded, dropping the least recently seen entries.
+    """
+
+    def __init__(self):
+        self._trips: "OrderedDict[Tuple, Tuple[datetime, datetime]]" = OrderedDict()
+        self._routes: "OrderedDict[Tuple[str, str], Deque[float]]" = OrderedDict()
+
+    def observe(self, stop_id: str, data: Dict[str, Any], now: datetime) -> None:
+        """Record the expected times in a predictions response."""
+        for departure in data.get(ATTR_DEPARTURES, []):
+            expected = dt_util.parse_datetime(
+                departure[ATTR_DEPARTURE].get(ATTR_EXPECTED) or ""
+            )
+            if expected is None:
+                continue
+            key = trip_key(stop_id, departure)
+            previous = self._trips.pop(key, None)
+            self._trips[key] = (now, expected)
+            if len(self._trips) > MAX_TRIPS:
+                self._trips.popitem(last=False)
+            if previous is None:
+                continue
+            seen, last_expected = previous
+            minutes = (now - seen).total_seconds() / 60
+            if minutes <= 0:
+                continue
+            drift = abs((expected - last_expected).total_seconds()) / minutes
+            self._record((stop_id, departure[ATTR_SERVICE]), drift)
+
+    def _record(self, route: Tuple[str, str], drift: float) -> None:
+        samples = self._routes.pop(route, None)
+        if samples is None:
+            samples = deque(maxlen=SAMPLES_PER_ROUTE)
+        samples.append(drift)
+        self._routes[route] = samples
+        if len(self._routes) > MAX_ROUTES:
+            self._routes.popitem(last=False)
+
+    def drift(self, stop_id: str, route: Optional[str]) -> Optional[float]:
+        """Return the mean drift of a route at a stop, if it has been seen."""
+        samples = self._routes.get((stop_id, route))
+        if not samples:
+            return None
+        return sum(samples) / len(samples)
+
+    def factor(self, stop_id: str, route: Optional[str]) -> float:
+        """Return how much to stretch the polling interval for a route.
+
+        Volatile routes get a factor below 1, so are polled more often, and
+        stable ones above 1.
+        """
+        drift = self.drift(stop_id, route)
+        if drift is None:
+            return 1.0
+        if drift == 0:
+            return MAX_FACTOR
+        return max(MIN_FACTOR, min(MAX_FACTOR, REFERENCE_DRIFT / drift))
@@ -0,0 +1,118 @@
+"""Websocket subscriptions to departure updates."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+from typing import Any, Dict, List
+
+from homeassistant import core
+from homeassistant.components import websocket_api
+from homeassistant.exceptions import HomeAssistantError
+import homeassistant.helpers.config_validation as cv
+import voluptuous as vol
+
+from .const import (
+    ATTR_AIMED,
+    ATTR_DEPARTURES,
+    ATTR_SERVICE,
+    ATTR_TRIP_ID,
+    CONF_STOP_ID,
+)
+from .services import async_get_engine, departure_data
+from .trips import StopPredictions
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def departure_key(departure: Dict[str, Any]) -> str:
+    """Return a key identifying a departure across updates."""
+    if departure.get(ATTR_TRIP_ID) is not None:
+        return departure[ATTR_TRIP_ID]
+    return f"{departure[ATTR_SERVICE]}@{departure[ATTR_AIMED]}"
+
+
+def stop_departures(cached: StopPredictions) -> Dict[str, Dict[str, Any]]:
+    """Return a stop's departures, by key."""
+    departures = (departure_data(d) for d in cached.data.get(ATTR_DEPARTURES, []))
+    return {departure_key(d): d for d in departures}
+
+
+def departures_diff(
+    old: Dict[str, Dict[str, Any]], new: Dict[str, Dict[str, Any]]
+) -> Dict[str, List]:
+    """Return the departures added, changed and removed between updates."""
+    return {
+        "added": [d for key, d in new.items() if key not in old],
+        "changed": [d for key, d in new.items() if key in old and old[key] != d],
+        "removed": [key for key in old if key not in new],
+    }
+
+
+@websocket_api.websocket_command(
+    {
+        vol.Required("type"): "metlink/subscribe_departures",
+        vol.Required(CONF_STOP_ID): vol.All(cv.ensure_list, [cv.string]),
+    }
+)
+@websocket_api.async_response
+async def ws_subscribe_departures(
+    hass: core.HomeAssistant,
+    connection: websocket_api.ActiveConnection,
+    msg: Dict[str, Any],
+) -> None:
+    """Subscribe to the departures from some stops.
+
+    A snapshot of all their departures is sent first, and after that only
+    the departures that were added, changed or removed when a stop updates.
+    """
+    try:
+        engine = async_get_engine(hass)
+    except HomeAssistantError as err:
+        connection.send_error(msg["id"], "not_ready", str(err))
+        return
+    stop_ids = msg[CONF_STOP_ID]
+    predictions = await engine.async_get_departures(stop_ids)
+    sent = {stop_id: stop_departures(cached) for stop_id, cached in predictions.items()}
+
+    @core.callback
+    def async_stop_updated(stop_id: str) -> None:
+        if stop_id not in stop_ids or stop_id not in engine.predictions:
+            return
+        new = stop_departures(engine.predictions[stop_id])
+        diff = departures_diff(sent.get(stop_id, {}), new)
+        sent[stop_id] = new
+        if any(diff.values()):
+            connection.send_message(
+                websocket_api.event_message(msg["id"], {"stop_id": stop_id, **diff})
+            )
+
+    connection.subscriptions[msg["id"]] = engine.async_listen(async_stop_updated)
+    connection.send_result(msg["id"])
+    connection.send_message(
+        websocket_api.event_message(
+            msg["id"],
+            {
+                "snapshot": {
+                    stop_id: list(departures.values())
+                    for stop_id, departures in sent.items()
+                }
+            },
+        )
+    )
+
+
+@core.callback
+def async_register_commands(hass: core.HomeAssistant) -> None:
+    """Register the Metlink websocket commands."""
+    websocket_api.async_register_command(hass, ws_subscribe_departures)
@@ -0,0 +1,61 @@
+"""Tests for the prediction accuracy tracker."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import timedelta
+
+import homeassistant.util.dt as dt_util
+
+from custom_components.metlink.accuracy import AccuracyTracker, ErrorRing
+
+
+def response(expected):
+    departures = []
+    if expected is not None:
+        departures.append(
+            {
+                "trip_id": "T1",
+                "service_id": "2",
+                "departure": {"aimed": None, "expected": expected.isoformat()},
+            }
+        )
+    return {"departures": departures}
+
+
+def test_ring_is_bounded():
+    """Test only the most recent errors are kept."""
+    ring = ErrorRing(4)
+    for value in range(10):
+        ring.append(value)
+    assert 4 == ring.count
+    assert 6 == ring.percentile(0)
+    assert 9 == ring.percentile(100)
+
+
+def test_optimistic_predictions():
+    """Test errors are recorded by lead time once the trip departs."""
+    tracker = AccuracyTracker()
+    now = dt_util.utcnow()
+    departs = now + timedelta(minutes=15)
+    # Predicted on time 15 minutes out, then 3 minutes late from 4 minutes
+    tracker.observe("5000", response(departs), now)
+    tracker.observe(
+        "5000", response(departs + timedelta(minutes=3)), now + timedelta(minutes=14)
+    )
+    tracker.observe("5000", response(None), now + timedelta(minutes=19))
+
+    errors = tracker.summary()["5000 2"]
+    assert {"10-20 min", "2-5 min"} == set(errors)
+    assert 180 == errors["10-20 min"]["p50"]
+    assert 0 == errors["2-5 min"]["p50"]
@@ -0,0 +1,87 @@
+"""Tests for service alert events."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest.mock import AsyncMock, MagicMock
+
+from pytest_homeassistant_custom_component.common import async_capture_events
+
+from custom_components.metlink.alerts import AlertTracker
+from custom_components.metlink.const import CONF_ROUTE, CONF_STOP_ID, EVENT_ALERT
+from custom_components.metlink.engine import MetlinkEngine
+from custom_components.metlink.sensor import MetlinkSensor
+
+
+def alert(alert_id, route_id, header):
+    return {
+        "id": alert_id,
+        "alert": {
+            "effect": "NO_SERVICE",
+            "header_text": {"translation": [{"language": "en", "text": header}]},
+            "informed_entity": [{"route_id": route_id}],
+        },
+    }
+
+
+def feed(*alerts):
+    return {"entity": list(alerts)}
+
+
+async def test_alert_changes_fire_events(hass):
+    """Test events fire once for each change to a relevant alert."""
+    events = async_capture_events(hass, EVENT_ALERT)
+    tracker = AlertTracker(hass)
+    stops, routes = {"WELL"}, {"2"}
+    old = alert("A1", "2", "Already running")
+    tracker.async_update(feed(old), stops, routes)
+    tracker.async_update(feed(old), stops, routes)
+    await hass.async_block_till_done()
+    assert [] == events
+
+    new = alert("A2", "2", "Route suspended")
+    other = alert("A3", "83", "Elsewhere")
+    tracker.async_update(feed(old, new, other), stops, routes)
+    changed = alert("A2", "2", "Route suspended until 5pm")
+    tracker.async_update(feed(old, changed, other), stops, routes)
+    tracker.async_update(feed(old, other), stops, routes)
+    await hass.async_block_till_done()
+
+    assert [("A2", "added"), ("A2", "changed"), ("A2", "cleared")] == [
+        (e.data["id"], e.data["change"]) for e in events
+    ]
+    assert "Route suspended until 5pm" == events[1].data["header"]
+    assert ["2"] == events[0].data["routes"]
+
+
+async def test_alert_route_ids_mapped_to_names(hass):
+    """Test alerts naming a route by its GTFS id match its short name."""
+    events = async_capture_events(hass, EVENT_ALERT)
+    metlink = MagicMock()
+    metlink.get_routes = AsyncMock(
+        return_value=[{"route_id": "20", "route_short_name": "2"}]
+    )
+    metlink.get_service_alerts = AsyncMock(
+        side_effect=[feed(), feed(alert("A1", "20", "Route suspended"))]
+    )
+    engine = MetlinkEngine(hass, metlink)
+    sensor = MetlinkSensor(metlink, {CONF_STOP_ID: "WELL", CONF_ROUTE: "2"})
+    engine.async_add_sensors([sensor])
+
+    await engine._async_fetch_alerts(10)
+    await engine._async_fetch_alerts(10)
+    await hass.async_block_till_done()
+
+    assert [["2"]] == [e.data["routes"] for e in events]
+    # The routes catalogue is only downloaded once a day.
+    metlink.get_routes.assert_awaited_once()
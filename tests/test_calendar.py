@@ -0,0 +1,99 @@
+"""Tests for the departures calendar."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import timedelta
+from unittest.mock import MagicMock
+
+import homeassistant.util.dt as dt_util
+
+from custom_components.metlink import calendar as calendar_module
+from custom_components.metlink.calendar import MetlinkCalendar
+from custom_components.metlink.const import CONF_GROUP, CONF_ROUTE, CONF_STOP_ID
+from custom_components.metlink.engine import MetlinkEngine
+from custom_components.metlink.timetable import Timetable
+from custom_components.metlink.trips import StopPredictions
+
+from .test_sensor import TEST_RESPONSE
+from .test_trips import predictions
+
+NOW = dt_util.parse_datetime("2021-04-29T21:30:00+12:00")
+
+
+async def test_calendar_events(hass, freezer, monkeypatch):
+    """Test events from the predictions, then the learnt timetable."""
+    hass.config.set_time_zone("Pacific/Auckland")
+    freezer.move_to(NOW)
+    # Long enough to reach the same time next week.
+    monkeypatch.setattr(calendar_module, "TIMETABLE_HORIZON", timedelta(days=8))
+    timetable = Timetable(hass)
+    timetable.async_observe("WELL", TEST_RESPONSE[0], NOW)
+    engine = MetlinkEngine(hass, MagicMock(), timetable=timetable)
+    engine.predictions["WELL"] = StopPredictions(TEST_RESPONSE[0], NOW)
+    calendar = MetlinkCalendar(engine, {CONF_STOP_ID: "WELL", CONF_ROUTE: "KPL"})
+
+    end = NOW + timedelta(days=7, hours=1)
+    events = await calendar.async_get_events(hass, NOW, end)
+    assert [
+        ("2021-04-29T21:44:00+12:00", "Realtime departure, sched"),
+        ("2021-04-29T21:55:00+12:00", "Realtime departure, sched"),
+        ("2021-04-29T22:45:34+12:00", "Realtime departure, late"),
+        ("2021-05-06T21:44:00+12:00", "Timetabled departure"),
+        ("2021-05-06T21:55:00+12:00", "Timetabled departure"),
+        ("2021-05-06T22:15:00+12:00", "Timetabled departure"),
+    ] == [(e.start.isoformat(), e.description) for e in events]
+    assert "KPL WAIK-All stops" == events[0].summary
+    assert events[0] == calendar.event
+
+    # The window is built once until the predictions change.
+    assert events is await calendar.async_get_events(hass, NOW, end)
+    updated = NOW + timedelta(minutes=1)
+    engine.predictions["WELL"] = StopPredictions(TEST_RESPONSE[0], updated)
+    assert events is not await calendar.async_get_events(hass, NOW, end)
+
+
+async def test_group_calendar_events_in_time_order(hass, freezer):
+    """Test timetabled events at one stop fall between another's predictions."""
+    hass.config.set_time_zone("Pacific/Auckland")
+    freezer.move_to(NOW)
+    timetable = Timetable(hass)
+    opposite = predictions("OPPO", NOW + timedelta(minutes=20), trip_id="T9")
+    timetable.async_observe("OPPO", opposite, NOW)
+    engine = MetlinkEngine(hass, MagicMock(), timetable=timetable)
+    engine.predictions["WELL"] = StopPredictions(TEST_RESPONSE[0], NOW)
+    calendar = MetlinkCalendar(engine, {CONF_STOP_ID: "WELL", CONF_GROUP: "OPPO"})
+
+    events = await calendar.async_get_events(hass, NOW, NOW + timedelta(hours=1))
+    starts = [e.start for e in events]
+    assert sorted(starts) == starts
+    assert "Timetabled departure" in [e.description for e in events[:-1]]
+
+
+async def test_calendar_written_when_next_event_changes(hass, freezer):
+    """Test the state is only written when the next event changes."""
+    freezer.move_to(NOW)
+    engine = MetlinkEngine(hass, MagicMock())
+    engine.predictions["WELL"] = StopPredictions(TEST_RESPONSE[0], NOW)
+    calendar = MetlinkCalendar(engine, {CONF_STOP_ID: "WELL"})
+    calendar.async_write_ha_state = MagicMock()
+
+    calendar._async_stop_updated("WELL")
+    calendar._async_stop_updated("WELL")
+    calendar._async_stop_updated("OPPO")
+    assert 1 == calendar.async_write_ha_state.call_count
+
+    engine.predictions["WELL"] = StopPredictions({"departures": []}, NOW)
+    calendar._async_stop_updated("WELL")
+    assert 2 == calendar.async_write_ha_state.call_count
+    assert calendar.event is None
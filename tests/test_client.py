@@ -0,0 +1,111 @@
+"""Tests for the standalone Metlink client."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock, MagicMock
+
+from aiohttp import ClientError
+import pytest
+
+from custom_components.metlink import client as client_module
+from custom_components.metlink.client import Departure, MetlinkClient
+from custom_components.metlink.filters import DepartureFilter
+
+from .test_sensor import TEST_RESPONSE
+
+
+def mock_metlink(side_effect):
+    metlink = MagicMock()
+    metlink.get_predictions = AsyncMock(side_effect=side_effect)
+    return metlink
+
+
+def response(aimed, delay):
+    """Return a response with a Kapiti train and a Hutt Valley train."""
+    return {
+        "departures": [
+            {
+                "stop_id": "WELL",
+                "trip_id": trip_id,
+                "service_id": service_id,
+                "destination": {"stop_id": destination, "name": destination},
+                "departure": {
+                    "aimed": aimed.isoformat(),
+                    "expected": (aimed + timedelta(minutes=delay)).isoformat(),
+                },
+            }
+            for trip_id, service_id, destination in (
+                ("T1", "KPL", "WAIK"),
+                ("T2", "HVL", "UPPE"),
+            )
+        ]
+    }
+
+
+def test_departure_model():
+    """Test departures are parsed into typed fields."""
+    departure = Departure.from_api("WELL", TEST_RESPONSE[0]["departures"][0])
+    assert "UPPE" == departure.destination_id
+    assert "delay" == departure.status
+    assert departure.time == departure.expected
+    assert departure.expected > departure.aimed
+
+
+async def test_fetches_coalesced_and_cached():
+    """Test concurrent requests share a fetch, and later ones the cache."""
+
+    async def slow(stop_id, deadline):
+        await asyncio.sleep(0.01)
+        return TEST_RESPONSE[0]
+
+    metlink = mock_metlink(slow)
+    client = MetlinkClient(metlink)
+    results = await asyncio.gather(*(client.get_departures("WELL") for _ in range(3)))
+    await client.get_departures("WELL")
+
+    metlink.get_predictions.assert_awaited_once()
+    assert results[0] is results[2]
+
+
+async def test_failed_stop_backs_off():
+    """Test a failed stop is not fetched again until its backoff passes."""
+    metlink = mock_metlink(ClientError("down"))
+    client = MetlinkClient(metlink)
+    for _ in range(2):
+        with pytest.raises(ClientError):
+            await client.get_departures("WELL", max_age=timedelta(0))
+
+    metlink.get_predictions.assert_awaited_once()
+
+
+async def test_watch_yields_changes(monkeypatch):
+    """Test watch only yields the filtered departures that changed."""
+    monkeypatch.setattr(client_module, "MIN_POLL_INTERVAL", timedelta(0))
+    aimed = datetime.now(timezone.utc) + timedelta(minutes=1)
+    metlink = mock_metlink(
+        [response(aimed, 0), response(aimed, 0), response(aimed, 2)]
+    )
+    client = MetlinkClient(metlink)
+    updates = client.watch(["WELL"], DepartureFilter(destinations=["WAIK"]))
+
+    first = await updates.__anext__()
+    assert ["T1"] == [d.trip_id for d in first.added]
+    second = await updates.__anext__()
+    assert not second.added and not second.removed
+    assert ["T1"] == [d.trip_id for d in second.changed]
+    assert timedelta(minutes=2) == second.changed[0].expected - second.changed[0].aimed
+    assert 3 == metlink.get_predictions.await_count
+    await updates.aclose()
@@ -0,0 +1,108 @@
+"""Tests for commute windows."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, time, timedelta
+from unittest.mock import MagicMock
+
+import pytest
+
+import homeassistant.util.dt as dt_util
+
+from custom_components.metlink.commute import (
+    CommuteSchedule,
+    parse_days,
+    parse_windows,
+)
+from custom_components.metlink.const import (
+    CONF_COMMUTE_MAX_AGE,
+    CONF_COMMUTE_WINDOWS,
+    CONF_STOP_ID,
+)
+from custom_components.metlink.engine import (
+    DEFAULT_REQUEST_BUDGET,
+    PREWARM_LEAD,
+    REFRESH_INTERVAL,
+    MetlinkEngine,
+)
+from custom_components.metlink.sensor import MetlinkSensor
+
+STOP = {
+    CONF_STOP_ID: "WELL",
+    CONF_COMMUTE_WINDOWS: "mon-fri 07:30-08:30, sat+sun 09:00-10:00",
+    CONF_COMMUTE_MAX_AGE: 60,
+}
+
+
+def local(day: int, hour: int, minute: int) -> datetime:
+    """Return a time in the week of Monday 2021-05-03."""
+    return datetime(2021, 5, 3 + day, hour, minute, tzinfo=dt_util.DEFAULT_TIME_ZONE)
+
+
+def test_parse_windows():
+    """Test commute windows are parsed, and mistakes rejected."""
+    weekdays, weekend = parse_windows(STOP[CONF_COMMUTE_WINDOWS])
+    assert frozenset(range(5)) == weekdays.days
+    assert (time(7, 30), time(8, 30)) == (weekdays.start, weekdays.end)
+    assert frozenset({5, 6}) == weekend.days
+    assert frozenset(range(7)) == parse_windows("17:00-18:00")[0].days
+    assert frozenset({0, 1, 2, 4}) == parse_days("mon-wed+fri")
+    for text in ("fri-mon 07:00-08:00", "07:00", "09:00-08:00", "tues 07:00-08:00"):
+        with pytest.raises(ValueError):
+            parse_windows(text)
+
+
+def test_next_window():
+    """Test finding the window in force or coming next."""
+    schedule = CommuteSchedule.from_config(STOP)
+    assert (local(0, 7, 30), local(0, 8, 30)) == schedule.next_window(local(0, 8, 0))
+    # Friday evening waits for Saturday's window.
+    assert local(5, 9, 0) == schedule.next_window(local(4, 18, 0))[0]
+    assert CommuteSchedule.from_config({CONF_STOP_ID: "WELL"}) is None
+
+
+async def test_commute_scheduling(hass):
+    """Test polling is kept fresh in windows, and relaxed outside them."""
+    engine = MetlinkEngine(hass, MagicMock())
+    sensor = MetlinkSensor(engine.metlink, STOP)
+    engine.async_add_sensors([sensor])
+
+    # Inside the window the max age wins over a distant departure.
+    now = local(0, 8, 0)
+    sensor.update_time = now + timedelta(minutes=10)
+    engine._async_commute(sensor, sensor.commute, now)
+    assert now + timedelta(seconds=60) - REFRESH_INTERVAL == sensor.update_time
+
+    # Outside, polling is stretched, but the cache is warmed before opening.
+    now = local(0, 18, 0)
+    sensor.update_time = now + timedelta(minutes=2)
+    engine._async_commute(sensor, sensor.commute, now)
+    assert now + timedelta(minutes=8) == sensor.update_time
+    sensor.update_time = now + timedelta(days=1)
+    engine._async_commute(sensor, sensor.commute, now)
+    assert local(1, 7, 30) - PREWARM_LEAD == sensor.update_time
+
+
+async def test_commute_budget_reserved(hass):
+    """Test other stops share what is left after the reservations."""
+    engine = MetlinkEngine(hass, MagicMock())
+    engine.async_add_sensors([MetlinkSensor(engine.metlink, STOP)])
+    engine._intervals = {"WELL": 30, "PETO": 3}
+    assert {} == engine._commute_reservations(local(0, 7, 0))
+    assert 1320 / DEFAULT_REQUEST_BUDGET == engine._budget_factor()
+
+    # The reserved stop no longer counts against what is left.
+    engine.reserved = engine._commute_reservations(local(0, 7, 20))
+    assert {"WELL": 120} == engine.reserved
+    assert 1200 / (DEFAULT_REQUEST_BUDGET - 120) == engine._budget_factor()
@@ -1,5 +1,5 @@
 """Tests for the config_flow."""
-from unittest.mock import ANY, AsyncMock, patch
+from unittest.mock import ANY, AsyncMock, MagicMock, patch
 
 from aiohttp import ClientResponseError
 from homeassistant.const import CONF_API_KEY
@@ -12,8 +12,12 @@ from custom_components.metlink.const import (
     CONF_DEST,
     CONF_NUM_DEPARTURES,
     CONF_ROUTE,
+    CONF_DEPARTURE_OFFSETS,
+    CONF_STARTUP_WINDOW,
     CONF_STOP_ID,
     CONF_STOPS,
+    DEFAULT_DEPARTURE_OFFSETS,
+    DEFAULT_STARTUP_WINDOW,
     DOMAIN,
 )
 
@@ -75,6 +79,117 @@ async def test_validate_auth_invalid(m_metlink, hass):
         await config_flow.validate_auth("apikey", hass)
 
 
+@patch("custom_components.metlink.config_flow.Metlink")
+async def test_validate_auth_several_keys(m_metlink, hass):
+    """Test that every key is validated, and one bad key fails them all."""
+
+    def client(session, key):
+        m_instance = AsyncMock()
+        if key == "bad":
+            m_instance.get_predictions.side_effect = ClientResponseError(
+                request_info="dummy", history=""
+            )
+        return m_instance
+
+    m_metlink.side_effect = client
+    await config_flow.validate_auth("good:2, other", hass)
+    with pytest.raises(ValueError):
+        await config_flow.validate_auth("good, bad", hass)
+    assert 4 == m_metlink.call_count
+
+
+def test_parse_stop_list():
+    """Test stops are parsed from CSV lines, with errors for bad lines."""
+    stops, errors = config_flow.parse_stop_list(
+        "WELL, KPL, , 2\n\n5000\n12345\n5006,1,2,3,4\n"
+    )
+    assert [
+        {
+            CONF_STOP_ID: "WELL",
+            CONF_ROUTE: "KPL",
+            CONF_DEST: None,
+            CONF_NUM_DEPARTURES: 2,
+        },
+        {
+            CONF_STOP_ID: "5000",
+            CONF_ROUTE: None,
+            CONF_DEST: None,
+            CONF_NUM_DEPARTURES: 1,
+        },
+    ] == stops
+    assert 2 == len(errors)
+    assert errors[0].startswith("line 4:")
+    assert "line 5: too many fields" == errors[1]
+
+
+@patch("custom_components.metlink.config_flow.Metlink")
+async def test_validate_stops(m_metlink, hass):
+    """Test stops are checked against the catalogue, or the API without it."""
+    m_instance = AsyncMock()
+    m_instance.get_stops.return_value = [{"stop_id": "WELL"}]
+    m_metlink.return_value = m_instance
+    stops = [{CONF_STOP_ID: "WELL"}, {CONF_STOP_ID: "9999"}]
+
+    errors = await config_flow.validate_stops(hass, "apikey", stops)
+    assert ["9999: unknown stop"] == errors
+    m_instance.get_predictions.assert_not_awaited()
+
+    m_instance.get_stops.side_effect = ClientResponseError(
+        request_info="dummy", history=""
+    )
+    m_instance.get_predictions.side_effect = [
+        {},
+        ClientResponseError(request_info="dummy", history="", status=400),
+    ]
+    errors = await config_flow.validate_stops(hass, "apikey", stops)
+    assert ["9999: rejected by the API (400)"] == errors
+
+
+@patch("custom_components.metlink.config_flow.Metlink")
+async def test_validate_stops_with_key_pool(m_metlink, hass):
+    """Test a refused key is retried with the other keys when validating."""
+    refused, spare = AsyncMock(), AsyncMock()
+    refused.get_stops.side_effect = ClientResponseError(
+        request_info="dummy", history="", status=403
+    )
+    spare.get_stops.return_value = [{"stop_id": "WELL"}]
+    m_metlink.side_effect = [refused, spare]
+
+    stops = [{CONF_STOP_ID: "WELL"}]
+    errors = await config_flow.validate_stops(hass, "key1, key2", stops)
+    assert [] == errors
+    refused.get_stops.assert_awaited_once()
+    spare.get_stops.assert_awaited_once()
+
+
+@patch("custom_components.metlink.config_flow.validate_stops")
+@patch("custom_components.metlink.config_flow.validate_auth")
+async def test_flow_bulk_import(m_validate_auth, m_validate_stops, hass):
+    """Test a pasted list of stops creates the entry once all are valid."""
+    m_validate_stops.return_value = ["5000: unknown stop"]
+    _result = await hass.config_entries.flow.async_init(
+        DOMAIN, context={"source": "user"}
+    )
+    result = await hass.config_entries.flow.async_configure(
+        _result["flow_id"], user_input={CONF_API_KEY: "key", "bulk_import": True}
+    )
+    assert "bulk" == result["step_id"]
+    result = await hass.config_entries.flow.async_configure(
+        _result["flow_id"], user_input={"stop_list": "WELL\n5000\nX"}
+    )
+    assert {"base": "stop_list"} == result["errors"]
+    problems = result["description_placeholders"]["errors"]
+    assert "line 3:" in problems and "5000: unknown stop" in problems
+
+    m_validate_stops.return_value = []
+    result = await hass.config_entries.flow.async_configure(
+        _result["flow_id"], user_input={"stop_list": "WELL\n5000"}
+    )
+    assert "create_entry" == result["type"]
+    assert ["WELL", "5000"] == [s[CONF_STOP_ID] for s in result["data"][CONF_STOPS]]
+    assert "bulk_import" not in result["data"]
+
+
 async def test_flow_user_init(hass):
     """Test the initialisation of the form in the first step of the config flow."""
     result = await hass.config_entries.flow.async_init(
@@ -196,7 +311,8 @@ async def test_flow_stops_creates_config_entry(m_metlink, hass):
     assert expected == result
 
 
-@patch("custom_components.metlink.sensor.Metlink")
+@patch("custom_components.metlink.engine.create_session", MagicMock())
+@patch("custom_components.metlink.engine.Metlink")
 async def test_options_flow_init(m_metlink, hass):
     """Test config flow options."""
     m_instance = AsyncMock()
@@ -223,7 +339,8 @@ async def test_options_flow_init(m_metlink, hass):
     ].options
 
 
-@patch("custom_components.metlink.sensor.Metlink")
+@patch("custom_components.metlink.engine.create_session", MagicMock())
+@patch("custom_components.metlink.engine.Metlink")
 async def test_options_flow_remove_stop(m_metlink, hass):
     """Test removing a stop from the options config flow."""
     m_instance = AsyncMock()
@@ -248,10 +365,15 @@ async def test_options_flow_remove_stop(m_metlink, hass):
     assert "create_entry" == result["type"]
     assert "" == result["title"]
     assert result["result"] is True
-    assert {CONF_STOPS: []} == result["data"]
+    assert {
+        CONF_STOPS: [],
+        CONF_STARTUP_WINDOW: DEFAULT_STARTUP_WINDOW,
+        CONF_DEPARTURE_OFFSETS: DEFAULT_DEPARTURE_OFFSETS,
+    } == result["data"]
 
 
-@patch("custom_components.metlink.sensor.Metlink")
+@patch("custom_components.metlink.engine.create_session", MagicMock())
+@patch("custom_components.metlink.engine.Metlink")
 @patch("custom_components.metlink.config_flow.Metlink")
 async def test_options_flow_add_stop(m_metlink, m_metlink_flow, hass):
     """Test adding a stop in config flow options."""
@@ -283,4 +405,103 @@ async def test_options_flow_add_stop(m_metlink, m_metlink_flow, hass):
         {CONF_STOP_ID: "1111"},
         {CONF_STOP_ID: "WELL", CONF_ROUTE: "", CONF_DEST: "", CONF_NUM_DEPARTURES: 1},
     ]
-    assert {CONF_STOPS: expected_stops} == result["data"]
+    assert {
+        CONF_STOPS: expected_stops,
+        CONF_STARTUP_WINDOW: DEFAULT_STARTUP_WINDOW,
+        CONF_DEPARTURE_OFFSETS: DEFAULT_DEPARTURE_OFFSETS,
+    } == result["data"]
+
+
+@patch("custom_components.metlink.engine.create_session", MagicMock())
+@patch("custom_components.metlink.engine.Metlink")
+@patch("custom_components.metlink.config_flow.Metlink")
+async def test_options_flow_updates_in_place(m_metlink, m_metlink_flow, hass):
+    """Test options changes add and remove sensors without a reload."""
+    m_instance = AsyncMock()
+    m_metlink.return_value = m_instance
+    m_metlink_flow.return_value = m_instance
+
+    config_entry = MockConfigEntry(
+        domain=DOMAIN,
+        unique_id="metlink_1111",
+        data={CONF_API_KEY: "dummy", CONF_STOPS: [{CONF_STOP_ID: "1111"}]},
+    )
+    config_entry.add_to_hass(hass)
+    assert await hass.config_entries.async_setup(config_entry.entry_id)
+    await hass.async_block_till_done()
+    sensors = hass.data[DOMAIN][config_entry.entry_id]["sensors"]
+    original = sensors["metlink_1111"]
+
+    _result = await hass.config_entries.options.async_init(config_entry.entry_id)
+    await hass.config_entries.options.async_configure(
+        _result["flow_id"],
+        user_input={CONF_STOPS: ["sensor.metlink_1111"], "stop_id": "WELL"},
+    )
+    await hass.async_block_till_done()
+    assert original is sensors["metlink_1111"]
+    assert hass.states.get("sensor.metlink_well")
+
+    _result = await hass.config_entries.options.async_init(config_entry.entry_id)
+    await hass.config_entries.options.async_configure(
+        _result["flow_id"], user_input={CONF_STOPS: ["sensor.metlink_well"]}
+    )
+    await hass.async_block_till_done()
+    assert ["metlink_WELL"] == list(sensors)
+    assert hass.states.get("sensor.metlink_1111") is None
+    assert ["metlink_WELL"] == [
+        s.uid for s in hass.data[DOMAIN][config_entry.entry_id]["engine"].sensors
+    ]
+
+
+@patch("custom_components.metlink.engine.create_session", MagicMock())
+@patch("custom_components.metlink.engine.Metlink")
+@patch("custom_components.metlink.config_flow.Metlink")
+async def test_options_flow_replaces_changed_stop(m_metlink, m_metlink_flow, hass):
+    """Test a stop added again with other options replaces its sensor."""
+    m_instance = AsyncMock()
+    m_metlink.return_value = m_instance
+    m_metlink_flow.return_value = m_instance
+
+    config_entry = MockConfigEntry(
+        domain=DOMAIN,
+        unique_id="metlink_1111",
+        data={CONF_API_KEY: "dummy", CONF_STOPS: [{CONF_STOP_ID: "1111"}]},
+    )
+    config_entry.add_to_hass(hass)
+    assert await hass.config_entries.async_setup(config_entry.entry_id)
+    await hass.async_block_till_done()
+    config = hass.data[DOMAIN][config_entry.entry_id]
+    original = config["sensors"]["metlink_1111"]
+
+    # Unchecked and added again, with more departures
+    _result = await hass.config_entries.options.async_init(config_entry.entry_id)
+    result = await hass.config_entries.options.async_configure(
+        _result["flow_id"],
+        user_input={CONF_STOPS: [], "stop_id": "1111", CONF_NUM_DEPARTURES: 3},
+    )
+    await hass.async_block_till_done()
+    assert [
+        {CONF_STOP_ID: "1111", CONF_ROUTE: "", CONF_DEST: "", CONF_NUM_DEPARTURES: 3}
+    ] == result["data"][CONF_STOPS]
+    replacement = config["sensors"]["metlink_1111"]
+    assert replacement is not original
+    assert 3 == replacement.num_departures
+    assert [replacement] == config["engine"].sensors
+    assert "sensor.metlink_1111" == replacement.entity_id
+    assert hass.states.get("sensor.metlink_1111")
+    assert hass.states.get("calendar.metlink_1111")
+
+    # Added again while still checked, it is not listed twice.
+    _result = await hass.config_entries.options.async_init(config_entry.entry_id)
+    result = await hass.config_entries.options.async_configure(
+        _result["flow_id"],
+        user_input={
+            CONF_STOPS: ["sensor.metlink_1111"],
+            "stop_id": "1111",
+            CONF_NUM_DEPARTURES: 2,
+        },
+    )
+    await hass.async_block_till_done()
+    assert 1 == len(result["data"][CONF_STOPS])
+    assert 2 == config["sensors"]["metlink_1111"].num_departures
+    assert 1 == len(config["engine"].sensors)
@@ -0,0 +1,103 @@
+"""Tests for the long-term delay statistics."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import timedelta
+
+import homeassistant.util.dt as dt_util
+
+from custom_components.metlink.delay_statistics import (
+    DelayStatistics,
+    hour_start,
+    route_statistics,
+)
+
+
+def predictions(*trips):
+    return {
+        "departures": [
+            {
+                "trip_id": trip_id,
+                "service_id": "2",
+                "status": None if delay is not None else "cancelled",
+                "departure": {
+                    "aimed": aimed.isoformat(),
+                    "expected": None if delay is None else (aimed + delay).isoformat(),
+                },
+            }
+            for trip_id, aimed, delay in trips
+        ]
+    }
+
+
+async def test_departed_trips_counted_hourly(hass):
+    """Test each departed trip is counted once, in its hour."""
+    hour = hour_start(dt_util.utcnow()) + timedelta(hours=1)
+    statistics = DelayStatistics(hass)
+    late = ("T1", hour, timedelta(minutes=10))
+    on_time = ("T2", hour + timedelta(minutes=30), timedelta(0))
+    # Both trips are polled several times before they depart
+    for _ in range(3):
+        statistics.async_observe("5000", predictions(late, on_time), hour)
+    statistics.async_observe("5000", predictions(on_time), hour + timedelta(minutes=11))
+    statistics.async_observe("5000", predictions(), hour + timedelta(minutes=31))
+
+    # Nothing is imported until the hour is complete
+    assert {} == statistics.pop_completed(hour + timedelta(minutes=59))
+    completed = statistics.pop_completed(hour + timedelta(hours=1, minutes=15))
+    assert [("5000", "2")] == list(completed)
+
+    imported = {
+        metadata["statistic_id"]: rows
+        for metadata, rows in route_statistics("5000", "2", completed[("5000", "2")])
+    }
+    delay = imported["metlink:delay_5000_2"][0]
+    assert hour == delay["start"]
+    assert 300 == delay["mean"]
+    assert 600 == delay["max"]
+    assert 50 == imported["metlink:on_time_5000_2"][0]["mean"]
+    assert 2 == imported["metlink:departures_5000_2"][0]["mean"]
+    assert 0 == imported["metlink:cancelled_5000_2"][0]["mean"]
+
+
+async def test_cancelled_trips_counted_separately(hass):
+    """Test cancelled trips are not counted as departing on time."""
+    hour = hour_start(dt_util.utcnow()) + timedelta(hours=1)
+    statistics = DelayStatistics(hass)
+    on_time = ("T1", hour, timedelta(0))
+    cancelled = ("T2", hour + timedelta(minutes=10), None)
+    statistics.async_observe("5000", predictions(on_time, cancelled), hour)
+    statistics.async_observe("5000", predictions(), hour + timedelta(minutes=11))
+
+    completed = statistics.pop_completed(hour + timedelta(hours=1, minutes=15))
+    imported = {
+        metadata["statistic_id"]: rows
+        for metadata, rows in route_statistics("5000", "2", completed[("5000", "2")])
+    }
+    assert 100 == imported["metlink:on_time_5000_2"][0]["mean"]
+    assert 1 == imported["metlink:departures_5000_2"][0]["mean"]
+    assert 1 == imported["metlink:cancelled_5000_2"][0]["mean"]
+
+    # An hour with only cancelled trips has no delays to report.
+    later = hour + timedelta(hours=2)
+    cancelled = ("T3", later, None)
+    statistics.async_observe("5000", predictions(cancelled), later)
+    statistics.async_observe("5000", predictions(), later + timedelta(minutes=1))
+    completed = statistics.pop_completed(later + timedelta(hours=1, minutes=15))
+    imported = {
+        metadata["statistic_id"]: rows
+        for metadata, rows in route_statistics("5000", "2", completed[("5000", "2")])
+    }
+    assert [] == imported["metlink:delay_5000_2"]
+    assert 1 == imported["metlink:cancelled_5000_2"][0]["mean"]
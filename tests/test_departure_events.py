@@ -0,0 +1,141 @@
+"""Tests for departure soon events."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import timedelta
+from unittest.mock import MagicMock
+
+import homeassistant.util.dt as dt_util
+from pytest_homeassistant_custom_component.common import (
+    async_capture_events,
+    async_fire_time_changed,
+)
+
+from custom_components.metlink.const import (
+    CONF_GROUP,
+    CONF_MIN_LEAD,
+    CONF_STOP_ID,
+    EVENT_DEPARTURE_SOON,
+)
+from custom_components.metlink.departure_events import parse_offsets
+from custom_components.metlink.engine import MetlinkEngine
+from custom_components.metlink.sensor import MetlinkGroupSensor, MetlinkSensor
+from custom_components.metlink.trips import StopPredictions
+
+from .test_trips import predictions
+
+
+async def test_events_fired_before_departure(hass):
+    """Test events fire at each offset, following moves beyond tolerance."""
+    events = async_capture_events(hass, EVENT_DEPARTURE_SOON)
+    engine = MetlinkEngine(hass, MagicMock())
+    sensor = MetlinkSensor(engine.metlink, {CONF_STOP_ID: "A"})
+    engine.departure_events.async_add_sensors([sensor], parse_offsets("5, 10"))
+    now = dt_util.utcnow()
+    aimed = now + timedelta(minutes=20)
+
+    def update(expected):
+        engine.predictions["A"] = StopPredictions(
+            predictions("A", aimed, aimed + expected), now
+        )
+        engine._async_notify("A")
+
+    update(timedelta(0))
+    # Small moves do not reschedule, larger ones do.
+    update(timedelta(seconds=10))
+    update(timedelta(minutes=2))
+    async_fire_time_changed(hass, now + timedelta(minutes=11))
+    await hass.async_block_till_done()
+    assert [] == events
+
+    async_fire_time_changed(hass, now + timedelta(minutes=12, seconds=1))
+    await hass.async_block_till_done()
+    assert [10] == [e.data["minutes"] for e in events]
+    assert "T1" == events[0].data["trip_id"]
+
+    async_fire_time_changed(hass, now + timedelta(minutes=17, seconds=1))
+    await hass.async_block_till_done()
+    assert [10, 5] == [e.data["minutes"] for e in events]
+    engine.departure_events.async_remove_sensors([sensor])
+    assert [] == engine._listeners
+
+
+async def test_events_fired_once_for_shared_engine(hass):
+    """Test setups sharing an engine fire each departure's event once."""
+    events = async_capture_events(hass, EVENT_DEPARTURE_SOON)
+    engine = MetlinkEngine(hass, MagicMock())
+    first = MetlinkSensor(engine.metlink, {CONF_STOP_ID: "A"})
+    second = MetlinkSensor(engine.metlink, {CONF_STOP_ID: "A"})
+    engine.departure_events.async_add_sensors([first], parse_offsets("5"))
+    engine.departure_events.async_add_sensors([second], parse_offsets("5, 10"))
+    now = dt_util.utcnow()
+    aimed = now + timedelta(minutes=20)
+    engine.predictions["A"] = StopPredictions(predictions("A", aimed), now)
+    engine._async_notify("A")
+
+    async_fire_time_changed(hass, now + timedelta(minutes=16))
+    await hass.async_block_till_done()
+    assert [10, 5] == [e.data["minutes"] for e in events]
+
+    # Only the events the remaining setup wants are kept.
+    engine.departure_events.async_remove_sensors([second])
+    assert [timedelta(minutes=5)] == [
+        offset for _, offset in engine.departure_events._events["A"]
+    ]
+
+
+async def test_events_kept_within_min_lead(hass, freezer):
+    """Test a shown departure keeps its events once too soon to be shown."""
+    events = async_capture_events(hass, EVENT_DEPARTURE_SOON)
+    engine = MetlinkEngine(hass, MagicMock())
+    sensor = MetlinkSensor(engine.metlink, {CONF_STOP_ID: "A", CONF_MIN_LEAD: 10})
+    engine.departure_events.async_add_sensors([sensor], parse_offsets("5"))
+    now = dt_util.utcnow()
+    aimed = now + timedelta(minutes=12)
+    engine.predictions["A"] = StopPredictions(predictions("A", aimed), now)
+    engine._async_notify("A")
+
+    # Refreshed once the departure is within the sensor's minimum lead time
+    freezer.tick(timedelta(minutes=3))
+    engine._async_notify("A")
+    async_fire_time_changed(hass, now + timedelta(minutes=7, seconds=1))
+    await hass.async_block_till_done()
+    assert [5] == [e.data["minutes"] for e in events]
+
+
+async def test_group_events_follow_merged_departures(hass):
+    """Test a group's events are for the departures in its merged list."""
+    events = async_capture_events(hass, EVENT_DEPARTURE_SOON)
+    engine = MetlinkEngine(hass, MagicMock())
+    group = MetlinkGroupSensor(
+        engine.metlink, {CONF_STOP_ID: "A", CONF_GROUP: "B", "num_departures": 1}
+    )
+    engine.departure_events.async_add_sensors([group], parse_offsets("5"))
+    now = dt_util.utcnow()
+    engine.predictions["A"] = StopPredictions(
+        predictions("A", now + timedelta(minutes=20)), now
+    )
+    engine._async_notify("A")
+    assert 1 == len(engine.departure_events._events["A"])
+
+    # An earlier departure from the other stop takes the only place.
+    engine.predictions["B"] = StopPredictions(
+        predictions("B", now + timedelta(minutes=15), trip_id="T2"), now
+    )
+    engine._async_notify("B")
+    assert {} == engine.departure_events._events["A"]
+
+    async_fire_time_changed(hass, now + timedelta(minutes=16))
+    await hass.async_block_till_done()
+    assert [("B", "T2")] == [(e.data["stop_id"], e.data["trip_id"]) for e in events]
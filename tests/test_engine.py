@@ -0,0 +1,251 @@
+"""Tests for the refresh engine."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from copy import deepcopy
+from datetime import timedelta
+from unittest.mock import AsyncMock, MagicMock
+
+from aiohttp import ClientResponseError
+from homeassistant.const import EVENT_HOMEASSISTANT_CLOSE
+import homeassistant.util.dt as dt_util
+
+from custom_components.metlink.const import CONF_GROUP, CONF_ROUTE, CONF_STOP_ID
+from custom_components.metlink import engine as engine_module
+from custom_components.metlink.engine import (
+    MetlinkEngine,
+    async_get_engines,
+    async_get_shared_engine,
+)
+from custom_components.metlink.sensor import (
+    MetlinkGroupSensor,
+    MetlinkSensor,
+    sensor_pollers,
+)
+
+from .test_sensor import TEST_RESPONSE
+
+
+def mock_metlink(predictions):
+    metlink = MagicMock()
+    metlink.get_predictions = AsyncMock(side_effect=predictions)
+    metlink.get_service_alerts = AsyncMock(return_value={"entity": []})
+    return metlink
+
+
+async def test_stop_fetched_once_for_all_sensors(hass):
+    """Test that sensors on the same stop share one fetch."""
+    metlink = mock_metlink(lambda stop_id, deadline: TEST_RESPONSE[0])
+    engine = MetlinkEngine(hass, metlink)
+    sensors = [
+        MetlinkSensor(metlink, {CONF_STOP_ID: "WELL"}),
+        MetlinkSensor(metlink, {CONF_STOP_ID: "WELL", CONF_ROUTE: "KPL"}),
+    ]
+    engine.async_add_sensors(sensors)
+
+    await engine.async_refresh()
+    await engine._alerts_task
+
+    metlink.get_predictions.assert_awaited_once()
+    metlink.get_service_alerts.assert_awaited_once()
+    assert "HVL" == sensors[0].attrs["service_id"]
+    assert "KPL" == sensors[1].attrs["service_id"]
+    assert all(not s.should_poll for s in sensors)
+
+
+async def test_group_sensor_merges_shared_fetches(hass):
+    """Test that a group sensor merges its stops from the engine's fetches."""
+    opposite = deepcopy(TEST_RESPONSE[0])
+    opposite["departures"] = opposite["departures"][1:2]
+    opposite["departures"][0]["service_id"] = "MEL"
+    opposite["departures"][0]["departure"]["aimed"] = "2021-04-29T21:40:00+12:00"
+    responses = {"WELL": TEST_RESPONSE[0], "OPPO": opposite}
+    metlink = mock_metlink(lambda stop_id, deadline: responses[stop_id])
+    engine = MetlinkEngine(hass, metlink)
+    group = MetlinkGroupSensor(
+        metlink, {CONF_STOP_ID: "WELL", CONF_GROUP: "OPPO", "num_departures": 2}
+    )
+    single = MetlinkSensor(metlink, {CONF_STOP_ID: "WELL"})
+    engine.async_add_sensors(sensor_pollers([group, single]))
+
+    await engine.async_refresh()
+
+    # WELL is fetched once for both sensors.
+    assert 2 == metlink.get_predictions.await_count
+    assert "HVL" == group.attrs["service_id"]
+    assert "MEL" == group.attrs["service_id_2"]
+    assert ["WELL", "OPPO"] == group.attrs["stops"]
+    assert group.available and not group.should_poll
+
+
+async def test_shared_engine_subscriptions(hass):
+    """Test that setups sharing an engine are reference counted."""
+    metlink = mock_metlink(lambda stop_id, deadline: TEST_RESPONSE[0])
+    metlink.close = AsyncMock()
+    engine = MetlinkEngine(hass, metlink, api_key="key")
+    first = MetlinkSensor(metlink, {CONF_STOP_ID: "WELL"})
+    second = MetlinkSensor(metlink, {CONF_STOP_ID: "WELL", CONF_ROUTE: "KPL"})
+    listeners = hass.bus.async_listeners().get(EVENT_HOMEASSISTANT_CLOSE, 0)
+    unsubscribe_first = engine.async_subscribe([first])
+    unsubscribe_second = engine.async_subscribe([second])
+    assert engine is async_get_engines(hass)["key"]
+
+    await engine.async_refresh()
+    metlink.get_predictions.assert_awaited_once()
+
+    unsubscribe_first()
+    assert [second] == engine.sensors
+    assert engine is async_get_engines(hass)["key"]
+    unsubscribe_second()
+    await hass.async_block_till_done()
+    assert "key" not in async_get_engines(hass)
+    metlink.close.assert_awaited_once()
+    # Nothing is left behind for the stops or the client.
+    assert {} == engine._intervals
+    assert listeners == hass.bus.async_listeners().get(EVENT_HOMEASSISTANT_CLOSE, 0)
+
+
+async def test_shared_engine_keyed_by_key_set(hass):
+    """Test that setups listing the same API keys in any order share one engine."""
+    first = await async_get_shared_engine(hass, "key1, key2:2")
+    assert first is await async_get_shared_engine(hass, "key2:2,key1")
+    assert first is not await async_get_shared_engine(hass, "key1")
+
+
+async def test_missed_deadline_is_rescheduled(hass):
+    """Test that a stop missing the deadline stays available and due."""
+
+    async def slow(stop_id, deadline):
+        await asyncio.sleep(deadline + 1)
+
+    metlink = mock_metlink(slow)
+    engine = MetlinkEngine(hass, metlink, deadline=0.1)
+    sensor = MetlinkSensor(metlink, {CONF_STOP_ID: "WELL"})
+    due = sensor.update_time
+    engine.async_add_sensors([sensor])
+
+    await engine.async_refresh()
+
+    assert sensor.available is True
+    assert due == sensor.update_time
+
+
+async def test_slow_alerts_do_not_hold_up_sensors(hass):
+    """Test sensors are updated without waiting for the alerts feed."""
+
+    departures = deepcopy(TEST_RESPONSE[0])
+    departures["departures"][0]["trip_id"] = "T1"
+    alert = {"informed_entity": [{"trip": {"trip_id": "T1"}}]}
+    released = asyncio.Event()
+
+    async def slow(deadline):
+        await released.wait()
+        return {"entity": [{"alert": alert}]}
+
+    metlink = mock_metlink(lambda stop_id, deadline: departures)
+    metlink.get_service_alerts = AsyncMock(side_effect=slow)
+    engine = MetlinkEngine(hass, metlink, deadline=1)
+    sensor = MetlinkSensor(metlink, {CONF_STOP_ID: "WELL"})
+    engine.async_add_sensors([sensor])
+
+    await asyncio.wait_for(engine.async_refresh(), 0.5)
+    assert sensor.state is not None
+    assert 0 == sensor.attrs["alert_count"]
+    update_time = sensor.update_time
+
+    # Alerts arriving later are shown without changing the schedule.
+    released.set()
+    await engine._alerts_task
+    assert 1 == sensor.attrs["alert_count"]
+    assert update_time == sensor.update_time
+
+
+async def test_failed_alerts_fetch_backs_off(hass, freezer):
+    """Test a failed alerts fetch is retried after a growing interval."""
+    metlink = mock_metlink(lambda stop_id, deadline: TEST_RESPONSE[0])
+    metlink.get_service_alerts = AsyncMock(side_effect=asyncio.TimeoutError)
+    engine = MetlinkEngine(hass, metlink)
+    sensor = MetlinkSensor(metlink, {CONF_STOP_ID: "WELL"})
+    engine.async_add_sensors([sensor])
+
+    async def refresh():
+        sensor.update_time = dt_util.now()
+        await engine.async_refresh()
+        await engine._alerts_task
+
+    await refresh()
+    await refresh()
+    assert sensor.state is not None
+    metlink.get_service_alerts.assert_awaited_once()
+
+    freezer.tick(engine_module.ALERTS_RETRY_INTERVAL + timedelta(seconds=1))
+    await refresh()
+    assert 2 == metlink.get_service_alerts.await_count
+    assert engine._alerts_backoff.retry_at == dt_util.utcnow() + 2 * (
+        engine_module.ALERTS_RETRY_INTERVAL
+    )
+
+
+async def test_fetch_error_marks_unavailable(hass):
+    """Test that a failed fetch makes the stop's sensors unavailable."""
+    metlink = mock_metlink(ClientResponseError(request_info="dummy", history=""))
+    engine = MetlinkEngine(hass, metlink)
+    sensor = MetlinkSensor(metlink, {CONF_STOP_ID: "WELL"})
+    engine.async_add_sensors([sensor])
+
+    await engine.async_refresh()
+
+    assert sensor.available is False
+
+
+async def test_polling_stretched_to_request_budget(hass):
+    """Test that polling is slowed down when over the request budget."""
+    metlink = mock_metlink(lambda stop_id, deadline: TEST_RESPONSE[0])
+    engine = MetlinkEngine(hass, metlink, request_budget=60)
+    # Two other stops polled every 30s make 240 requests an hour
+    engine._intervals = {"5000": 30, "5002": 30}
+    sensor = MetlinkSensor(metlink, {CONF_STOP_ID: "WELL"})
+    engine.async_add_sensors([sensor])
+
+    await engine.async_refresh()
+
+    assert sensor.update_time - dt_util.utcnow() > timedelta(seconds=90)
+
+
+async def test_large_alerts_feed_indexed_once(hass, monkeypatch):
+    """Test a large alerts feed is indexed by trip in the executor."""
+    monkeypatch.setattr(engine_module, "LARGE_ALERTS", 1)
+    departures = deepcopy(TEST_RESPONSE[0])
+    departures["departures"][0]["trip_id"] = "T1"
+    alert = {
+        "header_text": {"translation": [{"language": "en", "text": "Bus replaced"}]},
+        "informed_entity": [{"trip": {"trip_id": "T1"}}],
+    }
+    other = {"informed_entity": [{"route_id": "10"}]}
+    metlink = mock_metlink(lambda stop_id, deadline: departures)
+    metlink.get_service_alerts = AsyncMock(
+        return_value={"entity": [{"alert": alert}, {"alert": other}]}
+    )
+    engine = MetlinkEngine(hass, metlink)
+    sensor = MetlinkSensor(metlink, {CONF_STOP_ID: "WELL"})
+    engine.async_add_sensors([sensor])
+
+    await engine.async_refresh()
+    await engine._alerts_task
+
+    assert 1 == sensor.attrs["alert_count"]
+    assert "Bus replaced" == sensor.attrs["alert_header_0"]
+    assert {"T1": [alert]} == engine._alert_index
+    assert 1 == engine.loop_lag.summary()["samples"]
@@ -0,0 +1,94 @@
+"""Tests for the departure filters."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import homeassistant.util.dt as dt_util
+
+from custom_components.metlink.const import (
+    CONF_ACCESSIBLE,
+    CONF_DEST,
+    CONF_DIRECTION,
+    CONF_GROUP,
+    CONF_MIN_LEAD,
+    CONF_ROUTE,
+    CONF_STOP_ID,
+)
+from custom_components.metlink.filters import DepartureFilter, merge_departures
+from custom_components.metlink.helpers import metlink_unique_id
+
+from .test_sensor import TEST_RESPONSE
+
+DEPARTURES = TEST_RESPONSE[0]["departures"]
+NOW = dt_util.parse_datetime("2021-04-29T21:30:00+12:00")
+
+
+def services(departure_filter):
+    return [
+        (d["service_id"], d["destination"]["stop_id"])
+        for d in departure_filter.select(DEPARTURES, NOW)
+    ]
+
+
+def test_empty_filter():
+    """Test that an empty filter passes every departure."""
+    assert len(DEPARTURES) == len(services(DepartureFilter.from_config({})))
+
+
+def test_route_and_destination_lists():
+    """Test several routes and destinations, by id or name."""
+    departure_filter = DepartureFilter.from_config(
+        {CONF_ROUTE: "HVL, KPL", CONF_DEST: "UPPE,Porirua"}
+    )
+    assert [("HVL", "UPPE"), ("KPL", "PORI"), ("KPL", "PORI")] == services(
+        departure_filter
+    )
+
+
+def test_direction_accessible_and_lead_time():
+    """Test the filters on the other departure fields."""
+    assert [] == services(DepartureFilter.from_config({CONF_DIRECTION: "inbound"}))
+    assert [] == services(DepartureFilter.from_config({CONF_ACCESSIBLE: True}))
+    # The HVL leaves 7 minutes from now, the KPL to WAIK in 14
+    departure_filter = DepartureFilter.from_config({CONF_MIN_LEAD: 10})
+    assert ("KPL", "WAIK") == services(departure_filter)[0]
+
+
+def test_unique_id_unchanged_without_new_filters():
+    """Test unique ids only change when the new filters are used."""
+    stop = {CONF_STOP_ID: "WELL", CONF_ROUTE: "KPL", CONF_DEST: "Porirua"}
+    assert "metlink_WELL_rKPL_dPorirua" == metlink_unique_id(stop)
+    stop[CONF_DIRECTION] = "outbound"
+    stop[CONF_MIN_LEAD] = 5
+    assert "metlink_WELL_rKPL_dPorirua_outbound_l5" == metlink_unique_id(stop)
+
+
+def test_merge_departures():
+    """Test departures from several stops merged in time order, once per trip."""
+    well = [dict(d, trip_id=f"{d['service_id']}-{n}") for n, d in enumerate(DEPARTURES)]
+    # The KPL to Waikanae calls at the opposite platform a minute later.
+    opposite = [
+        dict(DEPARTURES[0], stop_id="OPPO", trip_id="MEL-1", service_id="MEL"),
+        dict(well[1], stop_id="OPPO", departure={"aimed": "2021-04-29T21:45:00+12:00"}),
+    ]
+    merged = merge_departures([well, opposite])
+    assert [("WELL", "HVL"), ("OPPO", "MEL"), ("WELL", "KPL")] == [
+        (d["stop_id"], d["service_id"]) for d in list(merged)[:3]
+    ]
+    assert 5 == len(list(merge_departures([well, opposite])))
+
+
+def test_group_unique_id():
+    """Test that grouped stops are part of the unique id."""
+    stop = {CONF_STOP_ID: "5000", CONF_GROUP: "5001, 5002"}
+    assert "metlink_5000_g5001_5002" == metlink_unique_id(stop)
@@ -0,0 +1,80 @@
+"""Import time benchmarks for the integration."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import subprocess
+import sys
+
+# Modules that must not be loaded just to show the config UI.
+HEAVY_MODULES = [
+    "custom_components.metlink.engine",
+    "custom_components.metlink.sensor",
+    "homeassistant.components.sensor",
+    "isodate",
+]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_in_subprocess(module: str):
+    """Import a module in a fresh interpreter, after Home Assistant core.
+
+    Returns the time taken to import the module, and the modules it loaded.
+    """
+    script = f"""
+import json, sys, time
+import homeassistant.core, homeassistant.config_entries
+import homeassistant.helpers.config_validation
+before = set(sys.modules)
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"time": elapsed, "loaded": sorted(set(sys.modules) - before)}}))
+"""
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def test_config_flow_import_footprint():
+    """Test that the config flow does not load the sensor platform."""
+    result = import_in_subprocess("custom_components.metlink.config_flow")
+    print(f"config_flow imported in {result['time'] * 1000:.1f}ms")
+    for module in HEAVY_MODULES:
+        assert module not in result["loaded"]
+
+
+def test_integration_import_footprint():
+    """Test that the integration itself does not load the sensor platform."""
+    result = import_in_subprocess("custom_components.metlink")
+    print(f"metlink imported in {result['time'] * 1000:.1f}ms")
+    for module in HEAVY_MODULES:
+        assert module not in result["loaded"]
+
+
+def test_client_imports_without_home_assistant():
+    """Test that the standalone client does not need Home Assistant."""
+    script = """
+import sys
+sys.modules["homeassistant"] = None
+import custom_components.metlink.client
+"""
+    subprocess.run([sys.executable, "-c", script], cwd=ROOT, check=True)
@@ -0,0 +1,76 @@
+"""Tests for spreading requests across several API keys."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest.mock import AsyncMock, MagicMock
+
+from aiohttp import ClientResponseError
+import pytest
+
+from custom_components.metlink.key_pool import KeyPool, parse_api_keys
+
+from .test_metlink_api import primed_client
+
+
+def mock_client(side_effect=None):
+    metlink = MagicMock()
+    metlink.get_predictions = AsyncMock(
+        return_value={"departures": []}, side_effect=side_effect
+    )
+    return metlink
+
+
+def test_parse_api_keys():
+    """Test keys are parsed with their weights."""
+    assert {"abc": 2.0, "def": 1.0} == parse_api_keys("abc:2, def")
+    with pytest.raises(ValueError):
+        parse_api_keys("abc:0")
+    with pytest.raises(ValueError):
+        parse_api_keys(" , ")
+
+
+async def test_requests_spread_by_weight():
+    """Test requests are shared out in proportion to the weights."""
+    heavy, light = mock_client(), mock_client()
+    pool = KeyPool([("heavy", heavy, 3), ("light", light, 1)])
+    for _ in range(8):
+        await pool.get_predictions("WELL")
+
+    assert 6 == heavy.get_predictions.await_count
+    assert 2 == light.get_predictions.await_count
+    assert [6, 2] == [u["requests_last_hour"] for u in pool.usage()]
+
+
+async def test_hedged_requests_counted():
+    """Test a hedged duplicate request counts against the key's usage."""
+    pool = KeyPool([("key", primed_client([(5, "slow"), (0, "hedged")]), 1)])
+    assert "hedged" == await pool.get_predictions("WELL", deadline=1)
+    assert 2 == pool.usage()[0]["requests_last_hour"]
+
+
+async def test_throttled_key_rested():
+    """Test a throttled key is retried elsewhere and then avoided."""
+    throttled = mock_client(
+        ClientResponseError(request_info=None, history=(), status=429)
+    )
+    spare = mock_client()
+    pool = KeyPool([("throttled", throttled, 1), ("spare", spare, 1)])
+    for _ in range(3):
+        assert {"departures": []} == await pool.get_predictions("WELL")
+
+    assert 1 == throttled.get_predictions.await_count
+    assert 3 == spare.get_predictions.await_count
+    usage = pool.usage()[0]
+    assert 429 == usage["last_error"]
+    assert usage["rested_for"] > 0
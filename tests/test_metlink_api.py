@@ -0,0 +1,109 @@
+"""Tests for the Metlink API client."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import pytest
+
+from custom_components.metlink import MetlinkAPI
+from custom_components.metlink.MetlinkAPI import (
+    APIKEY_HEADER,
+    HEDGE_MIN_SAMPLES,
+    MAX_POOL_SIZE,
+    PREDICTIONS_URL,
+    LatencyTracker,
+    Metlink,
+    create_session,
+)
+
+
+async def test_get_predictions(hass, aioclient_mock):
+    """Test that predictions are requested with compression enabled."""
+    aioclient_mock.get(PREDICTIONS_URL, json={"departures": []})
+    session = aioclient_mock.create_session(hass.loop)
+    metlink = Metlink(session, "apikey")
+
+    assert {"departures": []} == await metlink.get_predictions("WELL")
+
+    _, url, _, headers = aioclient_mock.mock_calls[0]
+    assert "WELL" == url.query["stop_id"]
+    assert "apikey" == headers[APIKEY_HEADER]
+    assert "gzip" in headers["Accept-Encoding"]
+    await metlink.close()
+    assert not session.closed
+    await session.close()
+
+
+async def test_large_payload_decoded_in_executor(hass, aioclient_mock, monkeypatch):
+    """Test that large responses are still decoded correctly."""
+    monkeypatch.setattr(MetlinkAPI, "LARGE_PAYLOAD", 10)
+    response = {"departures": [{"stop_id": "WELL"}] * 10}
+    aioclient_mock.get(PREDICTIONS_URL, json=response)
+    session = aioclient_mock.create_session(hass.loop)
+    metlink = Metlink(session, "apikey")
+
+    assert response == await metlink.get_predictions("WELL")
+    await session.close()
+
+
+async def test_dedicated_session(hass):
+    """Test that a dedicated session is closed with the client."""
+    session = create_session(100)
+    assert MAX_POOL_SIZE == session.connector.limit
+    metlink = Metlink(session, "apikey", owns_session=True)
+
+    await metlink.close()
+    assert session.closed
+
+
+def primed_client(responses):
+    """Return a hedging client whose requests take the given times."""
+    metlink = Metlink(None, "apikey", hedge=True)
+    tracker = LatencyTracker()
+    for _ in range(HEDGE_MIN_SAMPLES):
+        tracker.record(0.01)
+    metlink.latency[PREDICTIONS_URL] = tracker
+    delays = iter(responses)
+
+    async def get(url, timeout, params=None):
+        delay, result = next(delays)
+        await asyncio.sleep(delay)
+        return result
+
+    metlink._get = get
+    return metlink
+
+
+async def test_hedged_request():
+    """Test that a slow request is hedged, and the fastest answer used."""
+    metlink = primed_client([(5, "slow"), (0, "hedged")])
+    assert "hedged" == await metlink.get_predictions("WELL", deadline=1)
+
+
+async def test_request_deadline():
+    """Test that a request gives up when its deadline passes."""
+    metlink = primed_client([(5, "slow"), (5, "hedged")])
+    with pytest.raises(asyncio.TimeoutError):
+        await metlink.get_predictions("WELL", deadline=0.1)
+
+
+def test_latency_percentile():
+    """Test the latency percentile needs enough samples."""
+    tracker = LatencyTracker()
+    assert tracker.percentile(95) is None
+    for i in range(1, 201):
+        tracker.record(i)
+    # Only the most recent samples are kept
+    assert 198 == tracker.percentile(95)
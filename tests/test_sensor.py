@@ -25,7 +25,10 @@ from custom_components.metlink.const import (
     CONF_ROUTE,
     CONF_STOP_ID,
 )
-from custom_components.metlink.sensor import MetlinkSensor, slug
+from custom_components.metlink.engine import MetlinkEngine
+from custom_components.metlink.helpers import slug
+from custom_components.metlink import sensor as sensor_module
+from custom_components.metlink.sensor import MetlinkSensor
 
 TEST_RESPONSE = [
     {
@@ -113,15 +116,28 @@ TEST_RESPONSE = [
 ]
 
 
+def mock_metlink(**predictions):
+    metlink = MagicMock()
+    metlink.get_predictions = AsyncMock(**predictions)
+    metlink.get_service_alerts = AsyncMock(return_value={"entity": []})
+    return metlink
+
+
+async def refresh(hass, metlink, sensor):
+    """Refresh a sensor through the engine, as the integration does."""
+    engine = MetlinkEngine(hass, metlink)
+    engine.async_add_sensors([sensor])
+    await engine.async_refresh()
+
+
 async def test_async_update_success(hass, aioclient_mock):
     """Tests a fully successful async_update."""
-    metlink = MagicMock()
-    metlink.get_predictions = AsyncMock(side_effect=TEST_RESPONSE)
+    metlink = mock_metlink(side_effect=TEST_RESPONSE)
     sensor = MetlinkSensor(
         metlink,
         {CONF_STOP_ID: "WELL", CONF_ROUTE: "KPL", CONF_DEST: "Porirua"},
     )
-    await sensor.async_update()
+    await refresh(hass, metlink, sensor)
 
     expected = {
         "attribution": ATTRIBUTION,
@@ -135,6 +151,9 @@ async def test_async_update_success(hass, aioclient_mock):
         "destination": "Porirua",
         "delay": 0,
         "wheelchair_accessible": False,
+        "alert_count": 0,
+        "monitored": False,
+        "vehicle_id": None,
     }
 
     assert expected == sensor.attrs
@@ -146,27 +165,25 @@ async def test_async_update_success(hass, aioclient_mock):
     assert sensor.state == dt_util.parse_datetime(expected["departure"])
 
 
-async def test_async_update_failed():
+async def test_async_update_failed(hass):
     """Tests a failed async_update."""
-    metlink = MagicMock()
-    metlink.get_predictions = AsyncMock(
+    metlink = mock_metlink(
         side_effect=ClientResponseError(request_info="dummy", history="")
     )
 
     sensor = MetlinkSensor(metlink, {"stop_id": "WELL"})
-    await sensor.async_update()
+    await refresh(hass, metlink, sensor)
 
     assert sensor.available is False
     assert {"attribution": ATTRIBUTION, "stop_id": "WELL"} == sensor.attrs
 
 
-async def test_async_update_misformatted():
+async def test_async_update_misformatted(hass):
     """Tests a misformatted async_update."""
-    metlink = MagicMock()
-    metlink.get_predictions = AsyncMock(side_effect=TypeError("Test error handling"))
+    metlink = mock_metlink(side_effect=TypeError("Test error handling"))
 
     sensor = MetlinkSensor(metlink, {"stop_id": "WELL"})
-    await sensor.async_update()
+    await refresh(hass, metlink, sensor)
 
     assert sensor.available is False
     assert {"attribution": ATTRIBUTION, "stop_id": "WELL"} == sensor.attrs
@@ -174,13 +191,12 @@ async def test_async_update_misformatted():
 
 async def test_async_update_multiple(hass, aioclient_mock):
     """Tests a fully successful async_update."""
-    metlink = MagicMock()
-    metlink.get_predictions = AsyncMock(side_effect=TEST_RESPONSE)
+    metlink = mock_metlink(side_effect=TEST_RESPONSE)
     sensor = MetlinkSensor(
         metlink,
         {CONF_STOP_ID: "WELL", CONF_ROUTE: "KPL", CONF_NUM_DEPARTURES: 4},
     )
-    await sensor.async_update()
+    await refresh(hass, metlink, sensor)
 
     expected = {
         "attribution": ATTRIBUTION,
@@ -210,6 +226,15 @@ async def test_async_update_multiple(hass, aioclient_mock):
         "destination_3": "Porirua",
         "delay_3": 30,
         "wheelchair_accessible_3": False,
+        "alert_count": 0,
+        "monitored": False,
+        "vehicle_id": None,
+        "alert_count_2": 0,
+        "monitored_2": False,
+        "vehicle_id_2": None,
+        "alert_count_3": 0,
+        "monitored_3": False,
+        "vehicle_id_3": None,
     }
 
     assert expected == sensor.attrs
@@ -221,6 +246,31 @@ async def test_async_update_multiple(hass, aioclient_mock):
     assert sensor.state == dt_util.parse_datetime(expected["departure"])
 
 
+
+def test_unchanged_alerts_not_rewritten(monkeypatch):
+    """Test alert text is only copied into the attributes when it changes."""
+    translated = []
+
+    def get_translation(text):
+        translated.append(text)
+        return "Bus replaced"
+
+    monkeypatch.setattr(sensor_module, "get_translation", get_translation)
+    departure = {**TEST_RESPONSE[0]["departures"][0], "trip_id": "T1"}
+    alert = {"header_text": {}, "description_text": {}, "url": {}}
+    sensor = MetlinkSensor(MagicMock(), {CONF_STOP_ID: "WELL"})
+    now = dt_util.utcnow()
+    for _ in range(2):
+        sensor.show_departures({}, [departure], False, now, {"T1": [alert]})
+
+    assert 3 == len(translated)
+    assert "Bus replaced" == sensor.attrs["alert_header_0"]
+
+    sensor.show_departures({}, [departure], False, now, {})
+    assert 0 == sensor.attrs["alert_count"]
+    assert "alert_header_0" not in sensor.attrs
+
+
 def test_slug():
     """Test the slug function"""
     assert "abc_def" == slug("abc def")
@@ -0,0 +1,74 @@
+"""Tests for the learned service hours."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timedelta
+
+import homeassistant.util.dt as dt_util
+
+from custom_components.metlink.service_hours import (
+    MIN_OBSERVED_DAYS,
+    SERVICE_LEAD,
+    ServiceHours,
+    service_day,
+)
+
+
+def local_time(*args):
+    tz = dt_util.as_local(dt_util.utcnow()).tzinfo
+    return datetime(*args, tzinfo=tz)
+
+
+def observe_weeks(service_hours, weeks):
+    """Observe daily service from 05:30 to 00:30 for a number of weeks."""
+    start = local_time(2024, 5, 6)
+    for day in range(weeks * 7):
+        date = start + timedelta(days=day)
+        service_hours.async_observe(
+            "WELL",
+            [
+                date.replace(hour=5, minute=30),
+                date.replace(hour=12),
+                date.replace(hour=0, minute=30) + timedelta(days=1),
+            ],
+        )
+
+
+def test_late_departures_belong_to_previous_day():
+    """Test that a departure after midnight extends the previous day."""
+    day, minute = service_day(local_time(2024, 5, 7, 0, 30))
+    assert local_time(2024, 5, 6) == day
+    assert 24 * 60 + 30 == minute
+
+
+async def test_suspend_outside_service_hours(hass):
+    """Test polling resumes shortly before the first departure."""
+    service_hours = ServiceHours(hass)
+    observe_weeks(service_hours, MIN_OBSERVED_DAYS)
+
+    now = local_time(2024, 6, 4, 1, 0)
+    expected = local_time(2024, 6, 4, 5, 30) - SERVICE_LEAD
+    assert expected == service_hours.resume_time("WELL", now)
+    # During service hours polling is not suspended
+    assert service_hours.resume_time("WELL", local_time(2024, 6, 4, 13, 0)) is None
+    assert service_hours.resume_time("WELL", local_time(2024, 6, 4, 0, 15)) is None
+
+
+async def test_no_suspend_until_hours_known(hass):
+    """Test that hours seen on too few days are not trusted."""
+    service_hours = ServiceHours(hass)
+    observe_weeks(service_hours, MIN_OBSERVED_DAYS - 1)
+
+    assert service_hours.resume_time("WELL", local_time(2024, 6, 4, 1, 0)) is None
+    assert service_hours.resume_time("5000", local_time(2024, 6, 4, 1, 0)) is None
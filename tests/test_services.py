@@ -0,0 +1,72 @@
+"""Tests for the Metlink services."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+from custom_components.metlink.const import DOMAIN
+from custom_components.metlink.engine import MetlinkEngine
+from custom_components.metlink.services import async_setup_services
+
+from .test_engine import mock_metlink
+from .test_sensor import TEST_RESPONSE
+
+
+async def setup_engine(hass, predictions):
+    metlink = mock_metlink(predictions)
+    engine = MetlinkEngine(hass, metlink)
+    stop = engine.async_start()
+    async_setup_services(hass)
+    return metlink, stop
+
+
+async def test_get_departures_from_cache(hass):
+    """Test departures are filtered, and fetched once while fresh."""
+
+    async def slow(stop_id, deadline):
+        await asyncio.sleep(0.01)
+        return TEST_RESPONSE[0]
+
+    metlink, stop = await setup_engine(hass, slow)
+    call = {"stop_id": "WELL", "route": "KPL", "num_departures": 2}
+    responses = await asyncio.gather(
+        *(
+            hass.services.async_call(
+                DOMAIN, "get_departures", call, blocking=True, return_response=True
+            )
+            for _ in range(3)
+        )
+    )
+    await hass.services.async_call(
+        DOMAIN, "get_departures", call, blocking=True, return_response=True
+    )
+
+    metlink.get_predictions.assert_awaited_once()
+    departures = responses[0]["stops"]["WELL"]["departures"]
+    assert ["WAIK", "PORI"] == [d["destination_id"] for d in departures]
+    assert "WgtnStn" == responses[0]["stops"]["WELL"]["stop_name"]
+    stop()
+
+
+async def test_refresh_bypasses_cache(hass):
+    """Test the refresh service fetches stops even if recently fetched."""
+    metlink, stop = await setup_engine(hass, lambda stop_id, deadline: TEST_RESPONSE[0])
+    call = {"stop_id": "WELL"}
+    await hass.services.async_call(
+        DOMAIN, "get_departures", call, blocking=True, return_response=True
+    )
+    await hass.services.async_call(DOMAIN, "refresh", call, blocking=True)
+
+    assert 2 == metlink.get_predictions.await_count
+    stop()
@@ -0,0 +1,98 @@
+"""Tests for the staggered startup."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from datetime import timedelta
+from unittest.mock import AsyncMock, MagicMock
+
+import homeassistant.util.dt as dt_util
+
+from custom_components.metlink.startup import HOLD, StaggeredStartup
+
+
+def mock_sensor(stop_id, departure):
+    sensor = MagicMock()
+    sensor.stop_id = stop_id
+    sensor.state = departure
+    return sensor
+
+
+def mock_engine(refreshed):
+    engine = MagicMock()
+
+    async def refresh(sensors):
+        refreshed.append([s.stop_id for s in sensors])
+
+    engine.async_refresh = AsyncMock(side_effect=refresh)
+    return engine
+
+
+async def test_imminent_stops_refresh_first(hass):
+    """Test that sensors are refreshed in order of their departure."""
+    now = dt_util.utcnow()
+    refreshed = []
+    sensors = [
+        mock_sensor("unknown", None),
+        mock_sensor("later", now + timedelta(hours=1)),
+        mock_sensor("soon", now + timedelta(minutes=2)),
+    ]
+    startup = StaggeredStartup(hass, mock_engine(refreshed), sensors, 0, concurrency=1)
+    assert all(s.update_time == HOLD for s in sensors)
+
+    for sensor in sensors:
+        startup.async_queue(sensor)
+    await startup._task
+
+    assert [["soon"], ["later"], ["unknown"]] == refreshed
+    assert all(s.update_time != HOLD for s in sensors)
+    assert all(s.warm_up is None for s in sensors)
+
+
+async def test_sensors_on_same_stop_share_refresh(hass):
+    """Test that sensors watching the same stop are refreshed together."""
+    refreshed = []
+    sensors = [mock_sensor("WELL", None), mock_sensor("5000", None)]
+    sensors.append(mock_sensor("WELL", None))
+    startup = StaggeredStartup(hass, mock_engine(refreshed), sensors, 0)
+
+    for sensor in sensors:
+        startup.async_queue(sensor)
+    await startup._task
+
+    assert [["WELL", "WELL"], ["5000"]] == refreshed
+
+
+async def test_sensor_queued_during_last_refresh(hass):
+    """Test that a sensor queued while the last batch is in flight is refreshed."""
+    refreshed = []
+    first = mock_sensor("WELL", None)
+    late = mock_sensor("5000", None)
+    engine = MagicMock()
+    startup = StaggeredStartup(hass, engine, [first, late], 0)
+
+    async def refresh(sensors):
+        if not refreshed:
+            # Added by a later add_entities call, before this batch is done.
+            startup.async_queue(late)
+            await asyncio.sleep(0)
+        refreshed.append([s.stop_id for s in sensors])
+
+    engine.async_refresh = AsyncMock(side_effect=refresh)
+    startup.async_queue(first)
+    await startup._task
+
+    assert [["WELL"], ["5000"]] == refreshed
+    assert late.update_time != HOLD
+    assert startup._task is None
@@ -0,0 +1,173 @@
+"""Tests for deriving predictions from other stops on the same trips."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from copy import deepcopy
+from datetime import timedelta
+from unittest.mock import AsyncMock, MagicMock
+
+import homeassistant.util.dt as dt_util
+
+from custom_components.metlink.const import CONF_STOP_ID
+from custom_components.metlink.engine import MetlinkEngine
+from custom_components.metlink.sensor import MetlinkSensor
+from custom_components.metlink.trips import (
+    StopPredictions,
+    TripIndex,
+    derive_predictions,
+)
+
+
+def predictions(stop_id, aimed, expected=None, trip_id="T1"):
+    return {
+        "departures": [
+            {
+                "stop_id": stop_id,
+                "trip_id": trip_id,
+                "service_id": "2",
+                "operator": "NBM",
+                "name": stop_id,
+                "destination": {"stop_id": "5000", "name": "Wellington"},
+                "delay": "PT0S",
+                "vehicle_id": None,
+                "departure": {
+                    "aimed": aimed.isoformat(),
+                    "expected": expected.isoformat() if expected else None,
+                },
+                "status": None,
+                "monitored": True,
+                "wheelchair_accessible": True,
+            }
+        ]
+    }
+
+
+def test_downstream_stops():
+    """Test that only later stops on a trip are downstream."""
+    now = dt_util.now()
+    index = TripIndex()
+    index.index("A", predictions("A", now))
+    index.index("B", predictions("B", now + timedelta(minutes=5)))
+
+    assert ["B"] == index.downstream("A", "T1")
+    assert [] == index.downstream("B", "T1")
+    index.index("B", {"departures": []})
+    assert [] == index.downstream("A", "T1")
+
+
+def test_derive_delay():
+    """Test that the delay at one stop is carried to the next."""
+    now = dt_util.now()
+    source = predictions("A", now, now + timedelta(minutes=3))
+    target = StopPredictions(predictions("B", now + timedelta(minutes=5)), now)
+
+    original = deepcopy(target.data)
+    derived = derive_predictions(source, target, ["T1"], "A", now)
+    departure = derived.data["departures"][0]
+    assert (now + timedelta(minutes=8)).isoformat() == departure["departure"][
+        "expected"
+    ]
+    assert "PT180S" == departure["delay"]
+    assert "A" == derived.derived_from
+    assert original == target.data
+    assert target.derived_from is None
+    again = derive_predictions(source, derived, ["T1"], "A", now)
+    assert again.data is derived.data
+    assert derive_predictions(source, target, ["T2"], "A", now) is None
+
+
+def test_derived_departures_kept_in_order():
+    """Test a delay that moves a departure past the next one re-sorts them."""
+    now = dt_util.now()
+    source = predictions("A", now, now + timedelta(minutes=10))
+    data = predictions("B", now + timedelta(minutes=5))
+    data["departures"] += predictions("B", now + timedelta(minutes=8), trip_id="T2")[
+        "departures"
+    ]
+    target = StopPredictions(data, now)
+
+    derived = derive_predictions(source, target, ["T1"], "A", now)
+    assert ["T2", "T1"] == [d["trip_id"] for d in derived.data["departures"]]
+
+
+async def test_downstream_stop_not_fetched(hass):
+    """Test that a stop kept fresh from an earlier stop is not fetched."""
+    now = dt_util.now()
+    responses = {
+        "A": predictions("A", now + timedelta(minutes=1)),
+        "B": predictions("B", now + timedelta(minutes=6)),
+    }
+    metlink = MagicMock()
+    metlink.get_predictions = AsyncMock(
+        side_effect=lambda stop_id, deadline: responses[stop_id]
+    )
+    metlink.get_service_alerts = AsyncMock(return_value={"entity": []})
+    engine = MetlinkEngine(hass, metlink)
+    a = MetlinkSensor(metlink, {CONF_STOP_ID: "A"})
+    b = MetlinkSensor(metlink, {CONF_STOP_ID: "B"})
+    engine.async_add_sensors([a, b])
+    await engine.async_refresh()
+    assert 2 == metlink.get_predictions.await_count
+
+    # The trip is now running 2 minutes late at A
+    responses["A"] = predictions(
+        "A", now + timedelta(minutes=1), now + timedelta(minutes=3)
+    )
+    b.update_time = a.update_time = dt_util.now()
+    adapted = []
+    adapt = engine._async_adapt
+    engine._async_adapt = lambda sensor, when: adapted.append(sensor) or adapt(
+        sensor, when
+    )
+    await engine.async_refresh()
+    # A was fetched again, but B was updated from it
+    assert 3 == metlink.get_predictions.await_count
+    assert b.state == now + timedelta(minutes=8)
+    # and scheduled as if it had been fetched, without changing the
+    # response it was fetched in
+    assert b in adapted
+    assert responses["B"]["departures"][0]["departure"]["expected"] is None
+
+
+async def test_stops_upstream_of_each_other_both_fetched(hass):
+    """Test a stop is fetched when its next departure does not pass upstream."""
+    now = dt_util.now()
+    # T1 runs from A to B, T2 from B to A, and T3 starts at A.
+    a_data = predictions("A", now + timedelta(minutes=2), trip_id="T3")
+    a_data["departures"] += predictions("A", now + timedelta(minutes=4))["departures"]
+    a_data["departures"] += predictions("A", now + timedelta(minutes=9), trip_id="T2")[
+        "departures"
+    ]
+    b_data = predictions("B", now + timedelta(minutes=6))
+    b_data["departures"] += predictions("B", now + timedelta(minutes=7), trip_id="T2")[
+        "departures"
+    ]
+    responses = {"A": a_data, "B": b_data}
+    metlink = MagicMock()
+    metlink.get_predictions = AsyncMock(
+        side_effect=lambda stop_id, deadline: responses[stop_id]
+    )
+    metlink.get_service_alerts = AsyncMock(return_value={"entity": []})
+    engine = MetlinkEngine(hass, metlink)
+    a = MetlinkSensor(metlink, {CONF_STOP_ID: "A"})
+    b = MetlinkSensor(metlink, {CONF_STOP_ID: "B"})
+    engine.async_add_sensors([a, b])
+    await engine.async_refresh()
+
+    b.update_time = a.update_time = dt_util.now()
+    await engine.async_refresh()
+    # B's next departure calls at A first, but A's does not call at B.
+    assert ["A", "B", "A"] == [
+        call.args[0] for call in metlink.get_predictions.await_args_list
+    ]
@@ -0,0 +1,76 @@
+"""Tests for the departure board HTTP endpoint."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from copy import deepcopy
+import json
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+from custom_components.metlink.engine import MetlinkEngine
+from custom_components.metlink.views import BOARD_URL, MetlinkBoardView
+
+from .test_engine import mock_metlink
+from .test_sensor import TEST_RESPONSE
+
+
+def board_request(hass, query, etag=None):
+    app = web.Application()
+    app["hass"] = hass
+    headers = {} if etag is None else {"If-None-Match": etag}
+    return make_mocked_request("GET", f"{BOARD_URL}?{query}", headers, app=app)
+
+
+async def test_board_etag_and_long_poll(hass):
+    """Test unchanged boards are not resent, and waits end on a change."""
+    view = MetlinkBoardView()
+    responses = [TEST_RESPONSE[0]]
+    metlink = mock_metlink(lambda stop_id, deadline: responses[-1])
+    engine = MetlinkEngine(hass, metlink)
+    stop = engine.async_start()
+
+    response = await view.get(board_request(hass, "stops=WELL"))
+    assert 200 == response.status
+    board = json.loads(response.body)
+    assert 4 == len(board["stops"]["WELL"]["departures"])
+    etag = response.headers["ETag"]
+
+    response = await view.get(board_request(hass, "stops=WELL", etag))
+    assert 304 == response.status
+    metlink.get_predictions.assert_awaited_once()
+
+    # Fetching the same departures again leaves the ETag as it was.
+    await engine.async_force_refresh(["WELL"])
+    assert 2 == metlink.get_predictions.await_count
+    response = await view.get(board_request(hass, "stops=WELL", etag))
+    assert 304 == response.status
+
+    # A waiting request returns as soon as the departures change.
+    waiting = asyncio.ensure_future(
+        view.get(board_request(hass, "stops=WELL&wait=30", etag))
+    )
+    await asyncio.sleep(0.1)
+    await engine.async_force_refresh(["WELL"])
+    await asyncio.sleep(0.1)
+    assert not waiting.done()
+    changed = deepcopy(TEST_RESPONSE[0])
+    del changed["departures"][0]
+    responses.append(changed)
+    await engine.async_force_refresh(["WELL"])
+    response = await asyncio.wait_for(waiting, 5)
+    assert 200 == response.status
+    assert etag != response.headers["ETag"]
+    stop()
@@ -0,0 +1,72 @@
+"""Tests for the prediction volatility model."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import timedelta
+
+import homeassistant.util.dt as dt_util
+
+from custom_components.metlink import volatility
+from custom_components.metlink.volatility import (
+    MAX_FACTOR,
+    MIN_FACTOR,
+    VolatilityModel,
+)
+
+
+def response(trip_id, service_id, expected):
+    return {
+        "departures": [
+            {
+                "trip_id": trip_id,
+                "service_id": service_id,
+                "departure": {"aimed": None, "expected": expected.isoformat()},
+            }
+        ]
+    }
+
+
+def test_volatile_and_stable_routes():
+    """Test volatile routes are polled more often, and stable ones less."""
+    model = VolatilityModel()
+    now = dt_util.utcnow()
+    expected = now + timedelta(minutes=10)
+    for minute in range(3):
+        when = now + timedelta(minutes=minute)
+        model.observe("WELL", response("rail", "HVL", expected), when)
+        moved = expected + timedelta(minutes=minute * 2)
+        model.observe("5000", response("bus", "2", moved), when)
+
+    assert model.drift("WELL", "HVL") == 0
+    assert MAX_FACTOR == model.factor("WELL", "HVL")
+    assert 120 == model.drift("5000", "2")
+    assert MIN_FACTOR == model.factor("5000", "2")
+    assert 1 == model.factor("5000", "unknown")
+
+
+def test_model_is_bounded(monkeypatch):
+    """Test the least recently seen trips and routes are dropped."""
+    monkeypatch.setattr(volatility, "MAX_TRIPS", 5)
+    monkeypatch.setattr(volatility, "MAX_ROUTES", 2)
+    model = VolatilityModel()
+    now = dt_util.utcnow()
+    for route in range(10):
+        for minute in range(2):
+            when = now + timedelta(minutes=minute)
+            model.observe("WELL", response(f"t{route}", str(route), when), when)
+
+    assert 5 == len(model._trips)
+    assert 2 == len(model._routes)
+    assert model.drift("WELL", "9") is not None
+    assert model.drift("WELL", "0") is None
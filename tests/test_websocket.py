@@ -0,0 +1,60 @@
+"""Tests for the websocket departure subscriptions."""
+# Copyright 2021 Jason Rumney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from copy import deepcopy
+from unittest.mock import MagicMock
+
+from custom_components.metlink.engine import MetlinkEngine
+from custom_components.metlink.websocket import ws_subscribe_departures
+
+from .test_engine import mock_metlink
+from .test_sensor import TEST_RESPONSE
+
+
+async def test_snapshot_then_diffs(hass):
+    """Test a subscription gets a snapshot, then only what changed."""
+    response = deepcopy(TEST_RESPONSE[0])
+    metlink = mock_metlink(lambda stop_id, deadline: deepcopy(response))
+    engine = MetlinkEngine(hass, metlink)
+    stop = engine.async_start()
+    connection = MagicMock()
+    connection.subscriptions = {}
+
+    await ws_subscribe_departures.__wrapped__(
+        hass,
+        connection,
+        {"id": 5, "type": "metlink/subscribe_departures", "stop_id": ["WELL"]},
+    )
+    connection.send_result.assert_called_once_with(5)
+    snapshot = connection.send_message.call_args[0][0]["event"]["snapshot"]
+    assert 4 == len(snapshot["WELL"])
+
+    # The first train leaves, and the next one is delayed
+    departed = response["departures"].pop(0)
+    response["departures"][0]["departure"]["expected"] = "2021-04-29T21:46:00+12:00"
+    await engine.async_force_refresh(["WELL"])
+    diff = connection.send_message.call_args[0][0]["event"]
+    assert "WELL" == diff["stop_id"]
+    assert [] == diff["added"]
+    assert ["2021-04-29T21:46:00+12:00"] == [d["expected"] for d in diff["changed"]]
+    assert [f"HVL@{departed['departure']['aimed']}"] == diff["removed"]
+
+    # Nothing is sent when nothing changed
+    sent = connection.send_message.call_count
+    await engine.async_force_refresh(["WELL"])
+    assert sent == connection.send_message.call_count
+
+    connection.subscriptions[5]()
+    stop()